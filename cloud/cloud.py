@@ -3,8 +3,14 @@ Fichero que implementa las clases principales de la capa Cloud.
 
 De momento, implementamos la capa Cloud como un modelo atómico.  En el futuro
 tendremos que considerarlo como un modelo acoplado.
+
+Las peticiones REST al servidor (Esp32) no bloquean la simulación: se encolan en
+una cola acotada que atiende un hilo en segundo plano con una sesión HTTP
+persistente, y sus resultados se recogen en la siguiente transición del modelo.
 """
 import logging
+import queue
+import threading
 import pandas as pd
 from time import strftime, localtime
 from xdevs.models import Atomic, Port
@@ -13,7 +19,8 @@ import requests
 from datetime import datetime
 from time import perf_counter 
 from util.event import CommandEvent, CommandEventId, Event, DataEventColumns
-from util.reports import CloudReportService
+from util.columns import ColumnStore
+from util.reports import CloudReportService, shutdown_reports, submit_report, wait_reports
 
 logger = get_logger(__name__, logging.DEBUG)
 
@@ -23,7 +30,7 @@ class Cloud(Atomic):
     #PHASE_GET   = "GET data from server" 
     #PHASE_POST  = "POST data to server"
 
-    def __init__(self, name: str, base_folder: str = 'output', thing_names:list = [], thing_event_ids:list = [], host='http://localhost:80',  log_Time=False, log_Data=False):
+    def __init__(self, name: str, base_folder: str = 'output', thing_names:list = [], thing_event_ids:list = [], host='http://localhost:80',  log_Time=False, log_Data=False, queue_size=8, background=True):
         """Función de inicialización de atributos."""
         super().__init__(name)
         self.base_folder     = base_folder
@@ -34,6 +41,10 @@ class Cloud(Atomic):
         self.host            = host
         self.log_Time        = log_Time
         self.log_Data        = log_Data 
+        # Tamaño de la cola de peticiones pendientes
+        self.queue_size      = queue_size
+        # Informes en segundo plano (util.reports.submit_report)
+        self.background      = background
 
         self.iport_cmd = Port(CommandEvent, "cmd")
         self.add_in_port(self.iport_cmd)
@@ -52,115 +63,166 @@ class Cloud(Atomic):
         self.db_cache    = {}
         self.db_path     = {}
         self.counter     = {}
+        self.reports     = []
         time_mark        = strftime("%Y%m%d%H%M%S", localtime())
         
         for thing_name in self.thing_names:
-            self.db[thing_name]       = pd.DataFrame(columns=DataEventColumns.get_all_columns(self.thing_event_ids[thing_name]))
+            self.db[thing_name]       = ColumnStore(DataEventColumns.get_all_columns(self.thing_event_ids[thing_name]))
             self.db_cache[thing_name] = pd.DataFrame(columns=DataEventColumns.get_all_columns(self.thing_event_ids[thing_name]))
             self.db_path[thing_name]  = "datacloud/" + self.parent.name + "." + thing_name + "_" + time_mark
             # offset
-            self.counter[thing_name] = pd.DataFrame(columns=DataEventColumns.get_all_columns(self.thing_event_ids[thing_name]))
-
+            self.counter[thing_name] = 0
+
+        # Cliente REST: sesión keep-alive y un hilo que atiende la cola de peticiones
+        self.data_out_get  = None
+        self.data_out_post = None
+        self.coalesced     = 0
+        self.session       = requests.Session()
+        self.jobs          = queue.Queue(maxsize=self.queue_size)
+        self.results       = queue.Queue()
+        self.worker        = threading.Thread(target=self.work, name=self.name + "-rest", daemon=True)
+        self.worker.start()
         self.passivate()
 
     def exit(self):
         """Función de salida de la simulación."""
         # Aquí tenemos que guardar la base de datos.
         for thing_name in self.thing_names:
-            self.db[thing_name].to_csv(self.db_path[thing_name] + ".csv")
-        pass
+            self.db[thing_name].to_dataframe().to_csv(self.db_path[thing_name] + ".csv")
+        # Se atienden las peticiones pendientes y se para el hilo
+        self.submit(None)
+        self.worker.join(timeout=2*self.queue_size*self.timeout)
+        self.collect()
+        self.session.close()
+        # Se espera a los informes que siguen en curso
+        wait_reports(self.reports)
+        shutdown_reports()
 
     def lambdaf(self):
         """Función DEVS de salida."""
         if self.phase == self.PHASE_REQUEST:  
-            try:
-                self.data_out_get  = self.getvar(var="voltage")
-                self.pos = round( -1.25*(self.max_time.hour)**2+30*(self.max_time.hour))
-                self.data_out_post = self.postvar(type="angle",value=self.pos,unit="degrees")
-
-                if self.log_Time is True: logger.info("CLOUD->{ }: DataTime = %s" %(self.max_time))
-                if self.log_Data is True: logger.info("SERVER->CLOUD: Data = %s" %(self.data_out_get))
-                if self.log_Data is True: logger.info("CLOUD->SERVER: Data = %s" %(self.data_out_post))
-
-            except requests.exceptions.Timeout:   
-                if self.log_Time is True: logger.info("CLOUD->{ }: DataTime = NONE, 'Connection timed out'")
-                if self.log_Data is True: logger.info("SERVER->CLOUD: Data = NONE, 'Connection timed out'")
-                if self.log_Data is True: logger.info("CLOUD->SERVER: Data = NONE, 'Connection timed out'")
-
-            self.passivate()
+            # La petición se hace en segundo plano: el tiempo simulado no espera a la red
+            self.submit(self.max_time)
 
     def deltint(self):
         """Función DEVS de transición interna."""
+        self.collect()
         self.passivate()
 
     def deltext(self, e):
         """Función DEVS de transición externa."""
         self.continuef(e)
+        self.collect()
+        received = False
         for thing_name in self.thing_names:
             # Se recoge la información de cada uno de los sensores:
-            if self.get_in_port("i_" + thing_name).empty() is False:
-                self.msg[thing_name]= self.get_in_port("i_" + thing_name).get()
-                self.max_time = max(self.max_time,self.msg[thing_name].timestamp)
-            # Una vez se tiene la información de todos los sensores:
-            if len(self.msg) == len(self.thing_names):
-                for thing_name in self.thing_names:
-                    msg_list = list()
-                    msg_list.append(self.msg[thing_name].id)
-                    msg_list.append(self.msg[thing_name].source)
-                    msg_list.append(self.msg[thing_name].timestamp)
-                    for value in self.msg[thing_name].payload:
-                        msg_list.append(value)
-                    self.db[thing_name].loc[len(self.db[thing_name])] = msg_list
+            for msg in self.get_in_port("i_" + thing_name).values:
+                self.max_time = max(self.max_time, msg.timestamp)
+                if 'columns' in msg.payload:
+                    # Bloque de n_offset filas del GCS: una única inserción vectorizada
+                    self.db[thing_name].extend(msg.payload['columns'])
+                    self.counter[thing_name] += msg.payload['rows']
+                else:
+                    msg_list = [msg.id, msg.source, msg.timestamp]
+                    msg_list.extend(msg.payload.values())
+                    self.db[thing_name].append(msg_list)
                     self.counter[thing_name] += 1
-                #self.msgout=Event(id=self.msgin_usv.id,source=self.name,timestamp=self.msg,payload=self.msgin_usv.payload)
-                self.msg = {}   
-                super().activate(self.PHASE_REQUEST)
+                received = True
+        if received:
+            super().activate(self.PHASE_REQUEST)
         # Command input port                
         if self.iport_cmd.empty() is False:
             cmd: CommandEvent = self.iport_cmd.get()
             if cmd.cmd == CommandEventId.CMD_CLOUD_REPORT:
                 logger.debug("Cloud::deltext: Generating report...")
                 report: CloudReportService = CloudReportService(self.base_folder)
-                report.run()
-                logger.debug("Cloud::deltext: Report generated.")
+                if self.background:
+                    self.reports.append(submit_report(report))
+                    logger.debug("Cloud::deltext: Report submitted.")
+                else:
+                    report.run()
+                    logger.debug("Cloud::deltext: Report generated.")
+
 
-                
+    def submit(self, job):
+        """Encola una petición sin bloquear. Si la cola está llena se descarta la más antigua."""
+        while True:
+            try:
+                self.jobs.put_nowait(job)
+                return
+            except queue.Full:
+                try:
+                    self.jobs.get_nowait()
+                    self.coalesced += 1
+                except queue.Empty:
+                    pass
+
+    def work(self):
+        """Hilo que atiende las peticiones (None para terminar)."""
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                return
+            try:
+                data_out_get  = self.getvar(var="voltage")
+                pos = round( -1.25*(job.hour)**2+30*(job.hour))
+                data_out_post = self.postvar(type="angle",value=pos,unit="degrees")
+                self.results.put((job, data_out_get, data_out_post, None))
+            except Exception as error:
+                # Cualquier fallo de una petición se registra sin parar el hilo
+                logger.warning("Cloud::work: request failed: %s", error)
+                self.results.put((job, None, None, error))
+
+    def collect(self):
+        """Recoge los resultados de las peticiones ya atendidas."""
+        while True:
+            try:
+                job, data_out_get, data_out_post, error = self.results.get_nowait()
+            except queue.Empty:
+                return
+            if error is None:
+                self.data_out_get  = data_out_get
+                self.data_out_post = data_out_post
+                if self.log_Time is True: logger.info("CLOUD->{ }: DataTime = %s" %(job))
+                if self.log_Data is True: logger.info("SERVER->CLOUD: Data = %s" %(self.data_out_get))
+                if self.log_Data is True: logger.info("CLOUD->SERVER: Data = %s" %(self.data_out_post))
+            else:
+                if self.log_Time is True: logger.info("CLOUD->{ }: DataTime = NONE, '%s'" %(error))
+                if self.log_Data is True: logger.info("SERVER->CLOUD: Data = NONE, '%s'" %(error))
+                if self.log_Data is True: logger.info("CLOUD->SERVER: Data = NONE, '%s'" %(error))
 
-    # Funciones implementadas con la librería requests
+    # Funciones implementadas con la librería requests (se llaman desde el hilo:
+    # no modifican el modelo, sus resultados se recogen en collect())
     def getvar(self, var: str)->dict:
         t_start = perf_counter()  
-        self.var = var
         params = dict(
             type_in='None',
             value_in='None',
             unit_in='None'
         )
-        self.get_petition  = requests.get(self.host+'/'+self.var, params=params, timeout=self.timeout)
+        get_petition = self.session.get(self.host+'/'+var, params=params, timeout=self.timeout)
         t_stop = perf_counter()
         data_out = {
-            'data': self.get_petition.json(),
+            'data': get_petition.json(),
             'time_request': t_stop-t_start,
-            'petition_info': self.get_petition
+            'petition_info': get_petition
         }
         return data_out
 
 
     def postvar(self, type:str, value:float, unit:str)->dict:
         t_start    = perf_counter()  
-        self.type  = type
-        self.value = value
-        self.unit  = unit
         data_json  = {
-            'type' : self.type, 
-            'value': self.value, 
-            'unit' : self.unit 
+            'type' : type, 
+            'value': value, 
+            'unit' : unit 
         }
-        self.post_petition = requests.post(self.host+'/'+self.type, json=data_json,timeout=self.timeout)
+        post_petition = self.session.post(self.host+'/'+type, json=data_json,timeout=self.timeout)
         t_stop = perf_counter()
         data_out = {
             'data': data_json,
             'time_request': t_stop-t_start,
-            'petition_info': self.post_petition
+            'petition_info': post_petition
         }
         return data_out
 
@@ -3,6 +3,7 @@ import netCDF4
 import numpy as np
 from scipy.interpolate import griddata
 from scipy.spatial import KDTree
+from util.body import TimeIndex
 #from math import floor
 
 #from site import addsitedir   #Para añadir la ruta del proyecto
@@ -33,6 +34,7 @@ class SimBody:
     #self.vars=dict({'latfalt':latflat,'lonfalt':lonflat,'inan':inan})
 
     self.vars={'time':time,'latflat':latflat,'lonflat':lonflat,'inan':inan}
+    self.timeindex=TimeIndex(time)         #Time index service (days)
     for var in vars:
       tempvar=np.array(simbody[var])
       #tempvar[tempvar == simbody[var].FillValue]= np.NaN # Remove fill values
@@ -93,7 +95,7 @@ class SimBody2:
     #mylat= latitude (deg)
     #mylon= longitude (deg)
     #mydepth= depth(-meters)
-    t=round(np.nanargmin(np.absolute(self.vars['time']-mytime)))
+    t=self.timeindex.nearest(mytime)
     rj=len(self.vars['bottom'][1])
     ind =round(np.nanargmin(np.sqrt((self.vars['lat']-mylat)*(self.vars['lat']-mylat)+(self.vars['lon']-mylon)*(self.vars['lon']-mylon))))
     i=round(ind/rj) 
@@ -138,6 +140,7 @@ class SimBody3:
     print('BodySim EndDateTime:',self.dtend)
     print('BodySim Loading...')
     self.time=(self.time-self.time[0])*24*3600             
+    self.timeindex=TimeIndex(self.time)
     self.vars={}
     for var in vars:
       tempvar=np.array(simbody[var])
@@ -159,7 +162,7 @@ class SimBody3:
     #mydepth= depth(-meters)
     mytime=mytime-self.dtini
     mytime=mytime.total_seconds()
-    t=round(np.argmin(np.absolute(self.time-mytime)))   #Nearest time index
+    t=self.timeindex.nearest(mytime)                    #Nearest time index
     if np.absolute(self.time[t]-mytime)>31:             #Time resolution <30s
       return np.nan,np.nan,np.nan,np.nan,np.nan
     dd,ii=self.lonlattree.query([mylon,mylat])
@@ -216,6 +219,7 @@ class SimBody4:
     print('BodySim IniDateTime:',self.dtini)
     print('BodySim EndDateTime:',self.dtend)
     self.time=(self.time-self.time[0])*24*3600      #Time in seconds from 0.       
+    self.timeindex=TimeIndex(self.time)             #Nearest time index service
     
   def __exit__(self):       
     self.simbody.close()
@@ -234,7 +238,7 @@ class SimBody4:
     l=np.nan
     mytime=mytime-self.dtini
     mytime=mytime.total_seconds()
-    t=round(np.argmin(np.absolute(self.time-mytime)))   #Nearest time index
+    t=self.timeindex.nearest(mytime)                    #Nearest time index
     if np.absolute(self.time[t]-mytime)<=60:            #Time resolution <=60s
       dd,ii=self.lonlattree.query([mylon,mylat])
       if dd<0.003:                                      #Spatial relosution < 0.003deg
@@ -295,6 +299,7 @@ class SimBody5:
         self.dtend=refdate+dt.timedelta(seconds=self.time[-1]*24*3600)
         self.T=(self.time[1]-self.time[0])*24*3600      #Period
         self.time=(self.time-self.time[0])*24*3600      #Time in seconds from [0..end]. 
+        self.timeindex=TimeIndex(self.time)             #Nearest time index service
         if log==True:
             print('BodySim IniDateTime:',self.dtini)
             print('BodySim EndDateTime:',self.dtend)
@@ -337,7 +342,7 @@ class SimBody5:
         ij=np.nan
         l=np.nan
         mytime=mytime
-        t=round(np.argmin(np.absolute(self.time-mytime)))       #Nearest time index
+        t=self.timeindex.nearest(mytime)                        #Nearest time index
         if np.absolute(self.time[t]-mytime)<=self.T*1.1:        #Time resolution 30m*60s*1.1
             if np.isnan(mylat):
                 value=float(self.simbody[myvar][t].data) 
@@ -1,58 +1,304 @@
-from flask import Flask, request, jsonify
-from flask.json import JSONEncoder
-from edge.body import SimBody4 as Sensor
-from datetime import datetime
-import numpy as np
-
-class CustomJSONEncoder(JSONEncoder):
-
-    def default(self, obj):
-      try:
-        if isinstance(obj, np.generic):
-          return obj.item()
-      except TypeError:
-          pass
-      return JSONEncoder.default(self, obj)
-
-
-app = Flask(__name__)
-app.json_encoder = CustomJSONEncoder
-
-def create_sensor(bodyfile: str, vars:list=('WQ_O','WQ_N','WQ_ALG')):
-  print(f'Loading BodySim file: {bodyfile}')
-  return Sensor('SimWater', bodyfile, vars)
-
-simbody = create_sensor('/POOL/data/devs-bloom/dataedge/Washington-1d-2008-09-12_compr.nc')
-
-@app.route('/', methods=['POST'])
-def sensor():
-  try:
-    data = request.get_json()
-    measure = [data['payload'][k] for k in ('var', 'time', 'lat', 'lon', 'depth')]
-    measure[1] = datetime.fromtimestamp(measure[1])
-    measurement = data['payload'].copy()
-    measurement.update({
-      measure[0]: [v for v in simbody.readvar(*measure)],
-    })
-    result = jsonify(measurement)
-  except Exception as e:
-    print(e)
-    result = jsonify(error='invalid params')
-  return result
-
-
-def test():
-  simbody = create_sensor('/POOL/data/devs-bloom/dataedge/Washington-1d-2008-09-12_compr.nc')
-  print('Solicitando Datos')
-  O2 = simbody.readvar("WQ_O", 50, 47.6, -122.27, 5)
-  print("WQ_O: ", O2)
-  N = simbody.readvar("WQ_N", 50, 47.6, -122.27, 5)
-  print("WQ_N: ", N)
-  print('Fin')
-
-  
-if __name__ == "__main__":
-  test()
-
-# To run as flask application:
-#   FLASK_APP=body_rest flask run --host=0.0.0.0 --port=8080
+'''REST service of a simulated body.
+
+Endpoints:
+  POST /        one measurement: {'payload': {'var', 'time', 'lat', 'lon', 'depth'}}
+  POST /batch   arrays of queries (see util/rest.py, RestBody)
+  GET  /health  body being served
+  GET  /metrics request rate, latency percentiles and cache hit rate of the worker
+
+The body class and file are configurable. 'time' is a POSIX timestamp for the bodies
+that read at a datetime (SimBody..SimBody4) and seconds from the start of the body for
+SimBody5 and SimBody6 (timebase 'epoch' or 'seconds').
+
+Development server (one process, BODY_CLASS defaults to util.body.SimBody6):
+  BODY_FILE=dataedge/Washington-1m-2008-09_UGRID.nc FLASK_APP=edge.body_rest flask run
+Serving mode (the body is loaded once, published in shared memory if it supports it,
+and N worker processes answer on the same port with SO_REUSEPORT):
+  python -m edge.body_rest dataedge/Washington-1m-2008-09_UGRID.nc --body util.body.SimBody6 --workers 4 --port 5000
+'''
+import argparse
+import importlib
+import multiprocessing as mp
+import os
+import signal
+import socket
+import sys
+import threading
+from collections import deque
+from time import perf_counter, time
+from flask import Flask, Response, g, request, jsonify
+from flask.json import JSONEncoder
+from werkzeug.exceptions import HTTPException
+from werkzeug.serving import make_server
+from edge.body import SimBody4
+from util.body import SimBody6
+from util.rest import CONTENT_TYPES, QUERY, decode, encode
+from datetime import datetime
+import numpy as np
+
+class CustomJSONEncoder(JSONEncoder):
+
+    def default(self, obj):
+      try:
+        if isinstance(obj, np.generic):
+          return obj.item()
+      except TypeError:
+          pass
+      return JSONEncoder.default(self, obj)
+
+
+def load_class(path: str):
+  '''Body class from its import path (module.Class).'''
+  module, name = path.rsplit('.', 1)
+  return getattr(importlib.import_module(module), name)
+
+
+def create_sensor(bodyfile: str, vars:list=('WQ_O','WQ_N','WQ_ALG'), bodyclass=SimBody6):
+  print(f'Loading BodySim file: {bodyfile}')
+  if bodyclass is SimBody4:
+    return SimBody4('SimWater', bodyfile, vars)
+  return bodyclass('SimWater', bodyfile)
+
+
+def flatten(reading) -> list:
+  '''Values returned by readvar (value, time index, cell indices, layer) as a flat list.'''
+  return [x for v in reading for x in np.ravel(v).tolist()]
+
+
+ROW = 7   # Values of a /batch row: value, t, ij[4], l (the layout of readvar_batch)
+
+
+def row(reading) -> list:
+  '''readvar reading as a /batch row of ROW values: value, t, ij[4], l, NaN where not resolved.
+  The cell indices are the 4 nearest cells (SimBody5, SimBody6) or i, j (SimBody..SimBody4).'''
+  value, t, *ij, l = reading
+  ij = flatten(ij)
+  return flatten([value, t]) + (ij + [np.nan] * 4)[:4] + flatten([l])
+
+
+class Metrics:
+  '''Request metrics of a worker: rate and latency percentiles of the last requests.'''
+
+  def __init__(self, maxlen: int=10000, window: float=60):
+    self.start = time()
+    self.window = window                    # Window of the request rate (s)
+    self.requests = 0
+    self.errors = 0
+    self.latencies = deque(maxlen=maxlen)   # (end time, seconds)
+    self.lock = threading.Lock()
+
+  def observe(self, seconds: float, error: bool) -> None:
+    with self.lock:
+      self.requests += 1
+      self.errors += error
+      self.latencies.append((time(), seconds))
+
+  def report(self, body) -> dict:
+    now = time()
+    with self.lock:
+      latencies = np.array([s for t, s in self.latencies]) * 1000
+      recent = sum(1 for t, s in self.latencies if now - t <= self.window)
+    neighbours = getattr(body, 'neighbours', None)
+    lookups = neighbours.hits + neighbours.misses if neighbours is not None else 0
+    return {
+      'pid': os.getpid(),
+      'uptime': now - self.start,
+      'requests': self.requests,
+      'errors': self.errors,
+      'rate': recent / min(self.window, max(now - self.start, 1e-9)),
+      'latency_ms': {f'p{q}': float(np.percentile(latencies, q)) if len(latencies) else None for q in (50, 90, 99)},
+      'cache_hit_rate': neighbours.hits / lookups if lookups else None,
+    }
+
+
+def create_app(body=None, bodyclass: str=None, bodyfile: str=None, timebase: str=None) -> Flask:
+  '''Flask application serving body (or a new body of bodyclass from bodyfile).
+  By default the class and file are read from BODY_CLASS and BODY_FILE.'''
+  if body is None:
+    bodyclass = load_class(bodyclass or os.environ.get('BODY_CLASS', 'util.body.SimBody6'))
+    bodyfile = bodyfile or os.environ.get('BODY_FILE')
+    if bodyfile is None:
+      raise ValueError('A body file is needed (bodyfile or BODY_FILE)')
+    body = create_sensor(bodyfile, bodyclass=bodyclass)
+  if timebase is None:
+    timebase = 'seconds' if type(body).__module__ == 'util.body' else 'epoch'
+  lock = threading.Lock()                   # Bodies are not thread safe
+  metrics = Metrics()
+
+  app = Flask(__name__)
+  app.json_encoder = CustomJSONEncoder
+
+  def totime(t):
+    return datetime.fromtimestamp(t) if timebase == 'epoch' else t
+
+  def read(queries: list) -> np.ndarray:
+    '''Read (var, time, lat, lon, depth) queries; one row of ROW values per query.'''
+    readings = {}
+    if hasattr(body, 'readvars'):
+      # Every variable asked at the same time and place is read at once
+      points = {}
+      for var, *point in queries:
+        points.setdefault(tuple(point), []).append(var)
+      for point, myvars in points.items():
+        myvars = list(dict.fromkeys(myvars))
+        t, lat, lon, depth = point
+        with lock:
+          values, *indices = body.readvars(myvars, totime(t), lat, lon, depth)
+        for var, value in zip(myvars, values):
+          readings[(var,) + point] = row([value] + indices)
+    else:
+      # Repeated queries (several sensors at the same point) are read once
+      for query in dict.fromkeys(queries):
+        var, t, lat, lon, depth = query
+        with lock:
+          readings[query] = row(body.readvar(var, totime(t), lat, lon, depth))
+    return np.array([readings[query] for query in queries], dtype=np.float64).reshape(len(queries), ROW)
+
+  @app.before_request
+  def start():
+    g.start = perf_counter()
+
+  @app.after_request
+  def observe(response):
+    if request.endpoint in ('sensor', 'batch'):
+      metrics.observe(perf_counter() - g.start, response.status_code >= 400)
+    return response
+
+  @app.errorhandler(Exception)
+  def error(e):
+    if isinstance(e, HTTPException):
+      return e
+    app.logger.exception(e)
+    return jsonify(error=f'{type(e).__name__}: {e}'), 500
+
+  @app.route('/', methods=['POST'])
+  def sensor():
+    try:
+      data = request.get_json()
+      measure = [data['payload'][k] for k in QUERY]
+    except (KeyError, TypeError) as e:
+      return jsonify(error=f'invalid params: {e}'), 400
+    measure[1] = totime(measure[1])
+    measurement = data['payload'].copy()
+    with lock:
+      measurement.update({
+        measure[0]: flatten(body.readvar(*measure)),
+      })
+    return jsonify(measurement)
+
+  @app.route('/batch', methods=['POST'])
+  def batch():
+    '''Bulk read: the request has one array per query field (var, time, lat, lon, depth)
+    and the response one row of ROW values per query (value, t, ij[4], l), encoded as
+    asked in the Accept header.'''
+    try:
+      queries = decode(request.get_data(), request.mimetype)
+      queries = list(zip(*[queries[k] for k in QUERY]))
+    except (KeyError, TypeError, ValueError) as e:
+      return jsonify(error=f'invalid params: {e}'), 400
+    values = read(queries)
+    content_type = request.headers.get('Accept', CONTENT_TYPES['json'])
+    if content_type not in CONTENT_TYPES.values():
+      content_type = CONTENT_TYPES['json']
+    if content_type != CONTENT_TYPES['npy']:
+      values = {'values': values.tolist()}
+    return Response(encode(values, content_type), content_type=content_type)
+
+  @app.route('/health', methods=['GET'])
+  def health():
+    return jsonify(status='ok', pid=os.getpid(), body=type(body).__name__,
+                   bodyfile=getattr(body, 'bodyfile', None), timebase=timebase,
+                   dtini=str(body.dtini), dtend=str(body.dtend))
+
+  @app.route('/metrics', methods=['GET'])
+  def report():
+    return jsonify(metrics.report(body))
+
+  return app
+
+
+def listen(host: str, port: int, reuseport: bool) -> socket.socket:
+  '''Listening socket; with reuseport several processes can bind the same port.'''
+  sock = socket.socket(socket.AF_INET6 if ':' in host else socket.AF_INET, socket.SOCK_STREAM)
+  sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+  if reuseport:
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+  sock.bind((host, port))
+  sock.listen(128)
+  return sock
+
+
+def run(body, host: str, port: int, timebase: str, reuseport: bool) -> None:
+  '''Serve body in this process until it is terminated.'''
+  app = create_app(body, timebase=timebase)
+  sock = listen(host, port, reuseport)
+  server = make_server(host, port, app, threaded=True, fd=sock.fileno())
+  print(f'BodySim worker {os.getpid()} serving on {host}:{port}')
+  server.serve_forever()
+
+
+def attach_worker(handle, bodyclass: str, host: str, port: int, timebase: str) -> None:
+  '''Worker serving a body published in shared memory (SharedBody handle).'''
+  run(load_class(bodyclass).attach(handle), host, port, timebase, True)
+
+
+def load_worker(bodyfile: str, bodyclass: str, host: str, port: int, timebase: str) -> None:
+  '''Worker that loads its own copy of a body that cannot be shared.'''
+  run(create_sensor(bodyfile, bodyclass=load_class(bodyclass)), host, port, timebase, True)
+
+
+def serve(bodyfile: str, bodyclass: str='util.body.SimBody6', host: str='0.0.0.0', port: int=5000,
+          workers: int=1, timebase: str=None) -> None:
+  '''Load the body once and serve it with workers processes.
+  Bodies with share()/attach() (SimBody6) are published in shared memory; otherwise
+  every worker loads its own copy.'''
+  if workers > 1 and not hasattr(socket, 'SO_REUSEPORT'):
+    raise OSError('Several workers need SO_REUSEPORT')
+  body = create_sensor(bodyfile, bodyclass=load_class(bodyclass))
+  if timebase is None:
+    timebase = 'seconds' if type(body).__module__ == 'util.body' else 'epoch'
+  if workers == 1:
+    run(body, host, port, timebase, False)
+    return
+  handle = body.share() if hasattr(body, 'share') else None
+  signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))    # Release the shared body
+  ctx = mp.get_context('spawn')
+  processes = []
+  try:
+    for n in range(workers):
+      if handle is not None:
+        p = ctx.Process(target=attach_worker, args=(handle, bodyclass, host, port, timebase), daemon=True)
+      else:
+        p = ctx.Process(target=load_worker, args=(bodyfile, bodyclass, host, port, timebase), daemon=True)
+      p.start()
+      processes.append(p)
+    for p in processes:
+      p.join()
+  except KeyboardInterrupt:
+    pass
+  finally:
+    for p in processes:
+      p.terminate()
+      p.join()
+    if handle is not None:
+      handle.unlink()
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description='Serve a simulated body over REST.')
+  parser.add_argument('bodyfile', help='netCDF body file')
+  parser.add_argument('--body', default='util.body.SimBody6', help='body class (module.Class)')
+  parser.add_argument('--host', default='0.0.0.0')
+  parser.add_argument('--port', type=int, default=5000)
+  parser.add_argument('--workers', type=int, default=1, help='worker processes')
+  parser.add_argument('--timebase', choices=('epoch', 'seconds'), default=None,
+                      help="'time' as a POSIX timestamp or as seconds from the start of the body")
+  args = parser.parse_args(argv)
+  serve(args.bodyfile, args.body, args.host, args.port, args.workers, args.timebase)
+
+
+if __name__ == "__main__":
+  main()
+
+# To run as flask application (development server):
+#   BODY_FILE=<body file> FLASK_APP=edge.body_rest flask run --host=0.0.0.0 --port=8080
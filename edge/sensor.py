@@ -68,12 +68,8 @@ class SimSensor(Atomic):
     #Hago coincidir el inicio de nuestra Simulación con el inicio de SimBody
     simtime=msg.timestamp-dt.datetime(2021,8,1,0,0,0)
     fdays=simtime.seconds/(24.0*60.0*60.0)
-    times=self.simbody.vars['time']
     #times0=times -times[0]   #Lo he restado en SimBody     
-    ind=0                     #Indice de tiempo
-    while times[ind]<fdays:  #Busco el siguiente tiempo
-      ind=ind+1
-    myt=ind
+    myt=self.simbody.timeindex.next(fdays)   #Busco el siguiente tiempo
     #myt=50  #Indice del tiempo de prueba    
     self.myvar=msg.id
     #Asumimos que la profundidad es layer. Realmente habrá que hacer alguna corrección con Sigma.
@@ -321,7 +317,7 @@ class SimSensor5(Atomic):
         if msg.id == self.sensorinfo.id.value:
             self.msgin=msg
             delt=(dt.datetime.fromisoformat(self.msgin.timestamp)-self.simbody.dtini)
-            myt  = delt.seconds #Seconds from 0                   
+            myt  = int(delt.total_seconds()) #Seconds from 0 (delt.seconds wraps every day)                   
             mylat=self.msgin.payload['Lat']
             mylon=self.msgin.payload['Lon']
             mydepth=self.msgin.payload['Depth']
@@ -381,7 +377,7 @@ class SimSensor6(Atomic):
         if msg.id == self.sensorinfo.id.value:
             self.msgin=msg
             delt=(dt.datetime.fromisoformat(self.msgin.timestamp)-self.simbody.dtini)
-            myt  = delt.seconds #Seconds from 0                   
+            myt  = int(delt.total_seconds()) #Seconds from 0 (delt.seconds wraps every day)                   
             mylat=self.msgin.payload['Lat']
             mylon=self.msgin.payload['Lon']
             mydepth=self.msgin.payload['Depth']
@@ -401,6 +397,88 @@ class SimSensor6(Atomic):
             if self.log_Data is True: logger.info("Sensor: %s, Value = %s" %(self.msgout.id, self.msgout.payload['Value']))
             self.passivate()
 
+class SimSensorBank(Atomic):
+    '''Bank of simulated sensors reading a simulated Body6 (SimBody6.readvars).
+    It stands for a set of SimSensor6 on the same platform: the requests of all the sensors
+    received at the same time and position are served with one body access, and each sensor
+    still emits its own Event by its o_<name> port, sensorinfo.delay seconds later.
+    sensors is a dict {name: SensorInfo}.'''
+    PHASE_OFF = "off"         #Standby, wating for a resquet
+    PHASE_WORK = "work"       #Taking measurements
+
+    def __init__(self,name,simbody,sensors, log_Time=False, log_Data=False):       
+        super().__init__(name)
+        self.i_in = Port(Event, "i_int")    #Event to aks the mesaurements  
+        self.add_in_port(self.i_in)         
+        self.simbody=simbody                #Simulated Body in NetHFC4 format
+        self.sensors=sensors                #{name: SensorInfo}
+        self.names={}                       #{SensorEventId value: name}
+        for sensor_name,sensorinfo in sensors.items():
+            self.names[sensorinfo.id.value]=sensor_name
+            self.add_out_port(Port(Event, "o_" + sensor_name))  #Event includes the measurements
+        self.log_Time=log_Time
+        self.log_Data=log_Data
+    
+    def initialize(self):
+        # Wait for a resquet
+        self.clock=0.0                      #Seconds from initialize
+        self.pending=[]                     #[(due time, port name, Event)] ordered by due time
+        self.passivate(self.PHASE_OFF)
+      
+    def exit(self):
+        pass
+        
+    def deltint(self):
+        """DEVS internal transition function."""
+        self.clock=self.pending[0][0]       #Measurements sent in lambdaf
+        self.pending=[p for p in self.pending if p[0]>self.clock]
+        self.schedule()
+
+    def deltext(self, e: Any):
+        self.clock+=e
+        #First request of each sensor, grouped by time, position and depth
+        groups={}
+        asked=set()
+        for msg in self.i_in.values:
+            sensor_name=self.names.get(msg.id)
+            if sensor_name is None or sensor_name in asked:
+                continue
+            asked.add(sensor_name)
+            delt=(dt.datetime.fromisoformat(msg.timestamp)-self.simbody.dtini)
+            myt  = int(delt.total_seconds()) #Seconds from 0 (delt.seconds wraps every day)                   
+            where=(myt,msg.payload['Lat'],msg.payload['Lon'],msg.payload['Depth'])
+            key=tuple(None if x!=x else x for x in where)      #NaN==NaN in the key
+            groups.setdefault(key,([],[],where))
+            groups[key][0].append(sensor_name)
+            groups[key][1].append(msg)
+        for sensor_names,msgs,(myt,mylat,mylon,mydepth) in groups.values():
+            myvars=[msg.payload['Sensor'] for msg in msgs]
+            values,t,ij,l=self.simbody.readvars(myvars,myt,mylat,mylon,mydepth)
+            for sensor_name,msg,value in zip(sensor_names,msgs,values):
+                delay=self.sensors[sensor_name].delay
+                datetime=dt.datetime.fromisoformat(msg.timestamp)+dt.timedelta(seconds=delay)
+                data = {'Time':myt,'Lat':mylat,'Lon':mylon,'Depth':mydepth, 'Value': value}
+                self.pending.append((self.clock+delay,"o_" + sensor_name,Event(id=msg.id,source=sensor_name,timestamp=datetime,payload=data)))
+        self.pending.sort(key=lambda p: p[0])
+        self.schedule()
+
+    def schedule(self):
+        #Wait for the next measurement
+        if self.pending:
+            self.hold_in(self.PHASE_WORK,self.pending[0][0]-self.clock)
+        else:
+            self.passivate(self.PHASE_OFF)
+                
+    def lambdaf(self):            
+        if self.phase==self.PHASE_WORK:
+            due=self.pending[0][0]
+            for p in self.pending:
+                if p[0]>due:
+                    break
+                self.get_out_port(p[1]).add(p[2])
+                if self.log_Time is True:  logger.info("Sensor: %s: DateTime: %s" %(p[2].id,p[2].timestamp))
+                if self.log_Data is True: logger.info("Sensor: %s, Value = %s" %(p[2].id, p[2].payload['Value']))
+
 '''if __name__ == "__main__":
   
   #Simulación Test3, para mostrar funcionamiento de SimSensor3 y Simbody3 
@@ -33,6 +33,23 @@ PHASE_STARTING = "starting"
 PHASE_STOPPING = "stopping"
 PHASE_UPDATE = "update"
 
+# Sensor column of the Sensor2008_*.csv files -> event id of the telemetry
+SENSOR_IDS = {
+  'ALG': SensorEventId.ALG,
+  'DOX': SensorEventId.DOX,
+  'NOX': SensorEventId.NOX,
+  'sun': SensorEventId.SUN,
+  'temperature': SensorEventId.WTE,
+  'U': SensorEventId.WFU,
+  'V': SensorEventId.WFV,
+  'wind_x': SensorEventId.WFX,
+  'wind_y': SensorEventId.WFY,
+}
+
+# One row of the USV telemetry timeline
+TIMELINE_DTYPE = np.dtype([('time', 'datetime64[s]'), ('stamp', 'U32'), ('row', np.int32), ('file', np.int16),
+                           ('lat', np.float64), ('lon', np.float64), ('depth', np.float64)])
+
 
 class Processor(PoweredComponent):
   '''A model of a component that can process incoming data and generate clean/processed data'''
@@ -300,14 +317,19 @@ class USV_Simple(Atomic):
     DateTime	          Lat	        Lon	          Depth	        Sensor
     2008-09-12 00:30:30	47,5	      -122,3	      0	            DOX
     2008-09-12 00:31:30	47,50015983	-122,2999521	-0,010423905	NOX
+
+    start_cell es la celda del mapa (0..199) donde empieza el barco; con None
+    empieza donde lo sitúa el Inference_Service. Los barcos de una flota
+    comparten el reloj de la telemetría, pero cada uno sigue su propio rumbo.
     """
     PHASE_INIT    = "init"             # Iinitializing USV
     PHASE_SENDING = "sending"          # Sending Data
     PHASE_END     = "end"              # End USV process
 
-    def __init__(self, name, datapath, simbody, delay,  log_Time=False, log_Data=False):
+    def __init__(self, name, datapath, simbody, delay,  log_Time=False, log_Data=False, start_cell: int = None):
         """Instancia la clase."""
         super().__init__(name)
+        self.start_cell = start_cell
         
         self.datapath = datapath
         self.simbody = simbody 
@@ -348,20 +370,43 @@ class USV_Simple(Atomic):
         self.electronic_consume  = -0.003  # USV electronic consume
 
         # Let's read a value from alls sensor files
-        self.mydata={}
-        self.datetimes={} 
-
-        for self.file_name in self.files:   
+        # Las telemetrías de todos los ficheros se compilan en una única línea de
+        # tiempo (TIMELINE_DTYPE) ordenada por tick: la fila i de cada fichero es el
+        # tick i, aunque sus fechas difieran unos segundos, y un fichero más corto deja
+        # de enviar al acabarse. El reloj del USV es la primera fecha de cada tick.
+        tables = []
+        self.sensor_names = []
+        self.sensor_ids = []
+        self.sources = []
+        for self.file_name in self.files:
           if (self.file_name[-1]) == 'x':
-              self.mydata[self.file_name] = pd.read_excel(self.datapath+self.file_name, parse_dates=True)
-              self.datetimes[self.file_name]=(self.mydata[self.file_name])['DateTime']
-
-          if (self.file_name[-1]) == 'v':
-              self.mydata[self.file_name]  = pd.read_csv(self.datapath+self.file_name, parse_dates=True)  # Sensor data loading
-              self.datetimes[self.file_name] = [dt.datetime.fromisoformat(s) for s in (self.mydata[self.file_name])['DateTime']] #Para CSV
-
-        # Al tener archivos con las mismas dimensiones, se puede simplificar las siguientes definiciones,
-        # (tener en cuenta en futuras versiones):
+              mydata = pd.read_excel(self.datapath+self.file_name, parse_dates=True)
+          elif (self.file_name[-1]) == 'v':
+              mydata = pd.read_csv(self.datapath+self.file_name, parse_dates=True)  # Sensor data loading
+          else:
+              continue
+          sensor = mydata['Sensor'].iloc[0] if len(mydata) > 0 else None
+          if sensor not in SENSOR_IDS:
+              continue
+          table = np.empty(len(mydata), dtype=TIMELINE_DTYPE)
+          table['stamp'] = mydata['DateTime'].astype(str)
+          table['time'] = pd.to_datetime(mydata['DateTime']).to_numpy(dtype='datetime64[s]')
+          table['row'] = np.arange(len(mydata))
+          table['file'] = len(self.sensor_names)
+          table['lat'] = mydata['Lat']
+          table['lon'] = mydata['Lon']
+          table['depth'] = mydata['Depth']
+          tables.append(table)
+          self.sensor_names.append(sensor)
+          self.sensor_ids.append(SENSOR_IDS[sensor])
+          self.sources.append(self.datapath+self.file_name)
+        timeline = np.concatenate(tables) if tables else np.empty(0, dtype=TIMELINE_DTYPE)
+        self.timeline = timeline[np.argsort(timeline['row'], kind='stable')]
+        # Filas de la línea de tiempo de cada tick: timeline[bounds[i]:bounds[i+1]]
+        ticks = np.arange(self.timeline['row'][-1] + 1 if len(self.timeline) else 0)
+        self.bounds = np.searchsorted(self.timeline['row'], ticks, side='left').tolist() + [len(self.timeline)]
+        clock = np.minimum.reduceat(self.timeline['time'], self.bounds[:-1]) if len(ticks) else self.timeline['time']
+        self.datetimes = clock.astype(dt.datetime).tolist()
 
         # Load the data into variables
         self.zonal_lon      = self.simbody.lonc    # Zonal longitude
@@ -382,13 +427,17 @@ class USV_Simple(Atomic):
         self.SensorsOn         = True
         self.bloom             = False
 
-        self.N                 = self.mydata[self.file_name].DateTime.count() # N = 721
+        self.N                 = len(self.datetimes) # N = 721
         self.ind               = -1
         self.lyers             = range(1,55,1)
 
         data = {'zonal_lon':self.zonal_lon, 'zonal_lat':self.zonal_lat, 'nodal_lon':self.nodal_lon, 'nodal_lat':self.nodal_lat,
                 'bottom_elev': self.bottom_elev,'w_surf_elev': self.w_surf_elev, 'nodes': self.nodes, 'time':self.time, 'sigma': self.sigma, 
                 'maptree':self.maptree, 'SensorsOn':self.SensorsOn, 'bloom':self.bloom}
+        if self.start_cell is not None:
+            # Posición inicial del barco (para el Usv_Planner)
+            data['usv_lon'] = float(self.map[self.start_cell, 0])
+            data['usv_lat'] = float(self.map[self.start_cell, 1])
         self.msgout_init=Event(id='USV_Init',source=self.name, payload=data)
         super().passivate()
 
@@ -410,32 +459,8 @@ class USV_Simple(Atomic):
 
           self.passivate()
           if self.msgout_init.payload['SensorsOn'] == True:
-            # Mensaje de salida para los sensores  
-            for self.file_name in self.files:
-              row = self.mydata[self.file_name].iloc[self.ind]   # Telemetría
-              payload = row.to_dict() #{'DateTime': '', 'Lat': , 'Lon': , 'Depth': , 'Sensor': ''}
-              self.datetime_sensor = payload.pop('DateTime')
-              match(payload['Sensor']):
-                case 'ALG':
-                    self.dataid = SensorEventId.ALG
-                case 'DOX':
-                    self.dataid = SensorEventId.DOX
-                case 'NOX':
-                    self.dataid = SensorEventId.NOX
-                case 'temperature':
-                    self.dataid = SensorEventId.WTE
-                case 'U':
-                    self.dataid = SensorEventId.WFU
-                case 'V':
-                    self.dataid = SensorEventId.WFV
-                case 'wind_x':
-                    self.dataid = SensorEventId.WFX
-                case 'wind_y':
-                    self.dataid = SensorEventId.WFY
-                case _:
-                      continue  
-              self.o_sensor.add(Event(id=self.dataid.value, source=self.datapath+self.file_name, timestamp=self.datetime_sensor, payload=payload))
-          
+            # Mensaje de salida para los sensores (el SUN no se manda en el arranque)
+            self.send_sensors(skip=(SensorEventId.SUN,))
 
         if self.phase == self.PHASE_SENDING and self.ind < self.N:
           # Mensaje de salida del barco
@@ -450,33 +475,18 @@ class USV_Simple(Atomic):
           self.passivate()
 
           if self.msgout.payload['SensorsOn'] == True:
-            # Mensaje de salida para los sensores  
-            for self.file_name in self.files:
-              row = self.mydata[self.file_name].iloc[self.ind]   # Telemetría
-              payload = row.to_dict() #{'DateTime': '', 'Lat': , 'Lon': , 'Depth': , 'Sensor': ''}
-              self.datetime = payload.pop('DateTime')
-              match(payload['Sensor']):
-                case 'ALG':
-                    self.dataid = SensorEventId.ALG
-                case 'DOX':
-                    self.dataid = SensorEventId.DOX
-                case 'NOX':
-                    self.dataid = SensorEventId.NOX
-                case 'sun':
-                    self.dataid = SensorEventId.SUN
-                case 'temperature':
-                    self.dataid = SensorEventId.WTE
-                case 'U':
-                    self.dataid = SensorEventId.WFU
-                case 'V':
-                    self.dataid = SensorEventId.WFV
-                case 'wind_x':
-                    self.dataid = SensorEventId.WFX
-                case 'wind_y':
-                    self.dataid = SensorEventId.WFY
-                case _:
-                      continue  
-              self.o_sensor.add(Event(id=self.dataid.value, source=self.datapath+self.file_name, timestamp=self.datetime, payload=payload))
+            # Mensaje de salida para los sensores
+            self.send_sensors()
+
+    def send_sensors(self, skip: tuple = ()):
+        """Envía a los sensores las telemetrías del tick actual, salvo las de los ids de skip."""
+        if not 0 <= self.ind < self.N:
+          return
+        for _, stamp, _, file, lat, lon, depth in self.timeline[self.bounds[self.ind]:self.bounds[self.ind+1]].tolist():
+          if self.sensor_ids[file] in skip:
+            continue
+          payload = {'Lat': lat, 'Lon': lon, 'Depth': depth, 'Sensor': self.sensor_names[file]}
+          self.o_sensor.add(Event(id=self.sensor_ids[file].value, source=self.sources[file], timestamp=stamp, payload=payload))
 
     def deltint(self):
         """DEVS internal transition function."""
@@ -485,9 +495,9 @@ class USV_Simple(Atomic):
         if self.ind >= self.N:
             self.passivate()
         else:
-            # Refrencia del último fichero:
-            delta = self.datetimes[self.file_name][self.ind] - self.datetimes[self.file_name][self.ind-1]
-            self.datetime = (self.datetimes[self.file_name][self.ind])
+            # Reloj común de todos los ficheros:
+            delta = self.datetimes[self.ind] - self.datetimes[self.ind-1]
+            self.datetime = (self.datetimes[self.ind])
             self.hold_in(PHASE_ACTIVE, delta.seconds)
 
     def deltext(self,e: Any):
@@ -535,16 +545,16 @@ class USV_Simple(Atomic):
             cmd: CommandEvent = self.i_cmd.get()
             if cmd.cmd == CommandEventId.CMD_START_SIM:
                 start: np.datetime = cmd.date
-                delstart = [s-start for s in self.datetimes[self.file_name]]
+                delstart = [s-start for s in self.datetimes]
                 self.ind = round(np.nanargmin(np.absolute(delstart)))  # Nearest time index
-                delta = (self.datetimes[self.file_name][self.ind] - start).total_seconds()
-                self.datetime = self.datetimes[self.file_name][self.ind]
+                delta = (self.datetimes[self.ind] - start).total_seconds()
+                self.datetime = self.datetimes[self.ind]
                 if (delta >= 0):
                     super().hold_in(self.PHASE_INIT, delta)
                     
                 elif (delta < 0)& (self.ind>0):
                     self.ind = self.ind-1
-                    delta = (self.datetimes[self.file_name][self.ind] - start).total_seconds()
+                    delta = (self.datetimes[self.ind] - start).total_seconds()
                     super().hold_in(self.PHASE_INIT, delta)
                 else:
                     print('Error Start Time does not agree with FileInVar Times')
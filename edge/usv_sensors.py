@@ -37,6 +37,8 @@ class PoweredSimSensor(PoweredComponent):
                start_time: datetime=datetime.now()):
     super().__init__(name, period=period, mA=mA, start_time=start_time)
     self.body = body
+    # Bodies that batch reads (RestBody) are told in advance what will be read
+    self.submit = getattr(body, 'submit', None)
     self.buffer = []
     self.delay = 0
 
@@ -50,13 +52,16 @@ class PoweredSimSensor(PoweredComponent):
     if self.phase == PHASE_MEASURING or self.phase == PHASE_ON:
       for msg in self.i_data.values:
         if msg.target != self.name: continue
-        self.buffer.append([
+        info = [
           msg.payload['var'],
           msg.payload['time'],
           msg.payload['lat'],
           msg.payload['lon'],
           msg.payload['depth'],
-        ])
+        ]
+        self.buffer.append(info)
+        if self.submit is not None:
+          self.submit(*info)
         self.hold_in(PHASE_MEASURING, self.delay)
  
   def lambdaf(self) -> None:
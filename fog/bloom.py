@@ -0,0 +1,231 @@
+"""
+Modelo del bloom del Inference_Service.
+
+La dinámica del bloom es una función de paso pura sobre arrays de NumPy. El
+Inference_Service da un paso por cada mensaje del USV, y replay aplica el mismo
+paso a una tabla completa de sensores del GCS (los ficheros FogServer.*.csv)
+para obtener la serie FogServer.InferenceService.csv sin la pila DEVS. Todos
+los campos del estado y los parámetros pueden ser arrays: replay(table,
+k_growth=np.linspace(...)) evalúa una rejilla entera de parámetros en una sola
+pasada, y Ensemble sigue con un único paso muchos blooms candidatos, sembrados
+en las celdas del mapa.
+"""
+import glob
+import os
+from dataclasses import dataclass
+import numpy as np
+import pandas as pd
+
+# Default parameters of the model
+PARAMS = {
+    'k_breath': 0.05,       # Breath
+    'k_photo': 5,           # Photosynthesis
+    'k_decrease': 1/6,      # Decrease
+    'k_growth': 1,          # Growth
+    'k_2d_dis_bloom': 1/60, # Bloom 2D displacement
+}
+
+MAX_SIZE = 10               # Size control
+DOX_ON = 20                 # Dissolved oxygen that starts a bloom
+DOX_OFF = 15                # Dissolved oxygen that ends a bloom
+
+# Sensor id -> model variable
+SENSORS = {
+    'NOX': 'nox',           # Nitrate
+    'DOX': 'dox',           # Dissolved oxygen
+    'ALG': 'algae',         # Algae
+    'WTE': 'water_temp',    # Water temperature
+    'WFU': 'water_x',       # Water speed x axis
+    'WFV': 'water_y',       # Water speed y axis
+    'WFX': 'wind_x',        # Wind speed x axis
+    'WFY': 'wind_y',        # Wind speed y axis
+    'SUN': 'sun',           # Sun radiation
+}
+
+# Model variable -> variable of the body (SimBody6) read by the Ensemble
+BODY_VARS = {'nox': 'NOX', 'dox': 'DOX', 'sun': 'sun', 'water_x': 'U', 'water_y': 'V'}
+
+# Fields of the Inference_Service messages (FogServer.InferenceService.csv)
+FIELDS = ["id", "source", "timestamp", "usv_power", "usv_lon", "usv_lat", "lon_usv_error", "lat_usv_error",
+          "sun_radiation", "water_x", "water_y", "water_temp", "bloom_detection", "bloom_size", "bloom_lon", "bloom_lat", "SensorsOn"]
+
+
+@dataclass
+class BloomState:
+    """State of one or several blooms (scalars or arrays of the same shape)."""
+
+    size: np.ndarray
+    lon: np.ndarray
+    lat: np.ndarray
+    bloom: np.ndarray
+
+    @classmethod
+    def start(cls, lon, lat, bloom=False, shape=()):
+        """Blooms of size 0 at their initial position."""
+        return cls(np.zeros(shape), np.broadcast_to(lon, shape) + 0.0,
+                   np.broadcast_to(lat, shape) + 0.0, np.full(shape, bloom, dtype=bool))
+
+
+def step(state: BloomState, ini_lon, ini_lat, nox, dox, sun, water_x, water_y, restart=False,
+         k_breath=PARAMS['k_breath'], k_photo=PARAMS['k_photo'], k_decrease=PARAMS['k_decrease'],
+         k_growth=PARAMS['k_growth'], k_2d_dis_bloom=PARAMS['k_2d_dis_bloom']) -> BloomState:
+    """Next state of the blooms. Inputs and parameters broadcast against the state.
+
+    restart (the day begins) takes the blooms back to their initial position
+    before the step."""
+    size = np.where(restart, 0, state.size)
+    lon = np.where(restart, ini_lon, state.lon)
+    lat = np.where(restart, ini_lat, state.lat)
+    bloom = np.where(restart, False, state.bloom)
+
+    # Variable calculations
+    food = k_breath * (nox * dox) + k_photo * (nox * sun)
+
+    # Bloom logic (hysteresis on the dissolved oxygen)
+    bloom = np.where(dox > DOX_ON, True, bloom)
+    bloom = np.where(dox < DOX_OFF, False, bloom)
+
+    # Bloom dynamic
+    size = size + k_growth * food - k_decrease * size
+    lon = np.where(bloom, lon + k_2d_dis_bloom * water_x, ini_lon)
+    lat = np.where(bloom, lat + k_2d_dis_bloom * water_y, ini_lat)
+    # Size control (NaN sizes are kept, as in the scalar model)
+    size = np.where(size > MAX_SIZE, MAX_SIZE, size)
+    return BloomState(size, lon, lat, bloom)
+
+
+class Ensemble:
+    """Candidate blooms seeded on the cells of a map (the maptree KDTree of the USV).
+
+    seeds are the map cells of the blooms: None for every cell, an int N for N
+    cells spread over the map or an array of cell indices. Every tick the
+    fields are read at the cells of the blooms (one readvar_batch per variable
+    over the distinct cells), the blooms advance one step and the drifted
+    positions are re-indexed on the map with a single batch query."""
+
+    def __init__(self, maptree, seeds=None, bloom=False, depth=0.0, **params):
+        self.maptree = maptree
+        self.depth = depth
+        self.params = {**PARAMS, **params}
+        n = len(maptree.data)
+        if seeds is None:
+            seeds = np.arange(n)
+        elif np.isscalar(seeds):
+            seeds = np.unique(np.linspace(0, n - 1, min(int(seeds), n)).astype(int))
+        self.seeds = np.asarray(seeds, dtype=int)
+        self.ini_lon = maptree.data[self.seeds, 0]
+        self.ini_lat = maptree.data[self.seeds, 1]
+        self.cell = self.seeds.copy()
+        self.state = BloomState.start(self.ini_lon, self.ini_lat, bloom, self.seeds.shape)
+
+    def __len__(self):
+        return len(self.seeds)
+
+    def read(self, simbody, mytime: float) -> dict:
+        """Model inputs at the cells of the blooms (mytime in seconds of the body)."""
+        cells, inverse = np.unique(self.cell, return_inverse=True)
+        lon, lat = self.maptree.data[cells, 0], self.maptree.data[cells, 1]
+        inputs = {}
+        for var, bodyvar in BODY_VARS.items():
+            if var == 'sun':
+                inputs[var] = simbody.readvar_batch(bodyvar, mytime)[0][0]
+            else:
+                inputs[var] = simbody.readvar_batch(bodyvar, mytime, lat, lon, self.depth)[0][inverse]
+        return inputs
+
+    def step(self, nox, dox, sun, water_x, water_y, restart=False) -> BloomState:
+        """Advance every bloom one step and re-index their cells on the map."""
+        self.state = step(self.state, self.ini_lon, self.ini_lat, nox, dox, sun, water_x, water_y,
+                          restart, **self.params)
+        points = np.column_stack([self.state.lon, self.state.lat])
+        found = np.isfinite(points).all(axis=1)
+        if found.any():
+            _, self.cell[found] = self.maptree.query(points[found])
+        return self.state
+
+    def top(self, k: int) -> dict:
+        """The k largest blooms detected (bloom flag on), largest first."""
+        score = np.where(self.state.bloom & np.isfinite(self.state.size), self.state.size, -np.inf)
+        k = min(k, len(score))
+        best = np.argpartition(-score, k - 1)[:k] if k > 0 else np.array([], dtype=int)
+        best = best[np.argsort(-score[best], kind='stable')]
+        best = best[np.isfinite(score[best])]
+        return {'seed': self.seeds[best], 'cell': self.cell[best], 'bloom_size': self.state.size[best],
+                'bloom_lon': self.state.lon[best], 'bloom_lat': self.state.lat[best]}
+
+
+def read_table(base_folder: str, prefix: str = 'FogServer') -> pd.DataFrame:
+    """GCS sensor table: one row per GCS tick and one column per sensor id.
+
+    timestamp is the time the GCS forwards the tick to the Inference_Service
+    (the latest sensor timestamp)."""
+    columns = {}
+    timestamps = []
+    for path in sorted(glob.glob(os.path.join(base_folder, prefix + '.*.csv'))):
+        df = pd.read_csv(path, index_col=0, float_precision='round_trip')
+        if 'id' not in df.columns or len(df) == 0 or df['id'].iloc[0] not in SENSORS:
+            continue
+        sensor_id = df['id'].iloc[0]
+        columns[sensor_id] = df[sensor_id].to_numpy(dtype=np.float64)
+        timestamps.append(pd.to_datetime(df['timestamp']).to_numpy())
+    if not columns:
+        raise FileNotFoundError(f'No sensor data in {base_folder}/{prefix}.*.csv')
+    table = pd.DataFrame(columns)
+    table.insert(0, 'timestamp', np.max(timestamps, axis=0))
+    return table
+
+
+def replay(table: pd.DataFrame, ini_lon: float, ini_lat: float, bloom: bool = False,
+           delay: float = 0, source: str = 'InferenceService', **params):
+    """Inference_Service series of a GCS sensor table (see read_table).
+
+    The USV columns (usv_power, usv_lon, usv_lat, SensorsOn) are taken from the
+    table if present; otherwise the USV stays at the initial bloom position.
+    With scalar parameters the result has the FIELDS columns of
+    FogServer.InferenceService.csv; if some parameter is an array the result
+    is a dict of (time, *parameters shape) arrays: size, lon, lat and bloom.
+    Only the size is sequential (the size control caps it), so the pass is a
+    loop over the rows vectorized over the parameters."""
+    params = {**PARAMS, **params}
+    shape = np.broadcast(*params.values()).shape
+    n = len(table)
+    timestamp = pd.to_datetime(table['timestamp'])
+    restart = ((timestamp.dt.hour == 0) & (timestamp.dt.minute == 0)).to_numpy()
+    sensors = {var: table[sensor_id].to_numpy(dtype=np.float64)
+               for sensor_id, var in SENSORS.items() if sensor_id in table}
+    nox, dox, sun = sensors['nox'], sensors['dox'], sensors['sun']
+    water_x, water_y = sensors['water_x'], sensors['water_y']
+
+    series = {key: np.empty((n,) + shape, dtype=bool if key == 'bloom' else np.float64)
+              for key in ('size', 'lon', 'lat', 'bloom')}
+    state = BloomState.start(ini_lon, ini_lat, bloom, shape)
+    for i in range(n):
+        state = step(state, ini_lon, ini_lat, nox[i], dox[i], sun[i], water_x[i], water_y[i], restart[i], **params)
+        series['size'][i] = state.size
+        series['lon'][i] = state.lon
+        series['lat'][i] = state.lat
+        series['bloom'][i] = state.bloom
+    if shape:
+        return series
+
+    usv_lon = table['usv_lon'].to_numpy() if 'usv_lon' in table else np.full(n, ini_lon)
+    usv_lat = table['usv_lat'].to_numpy() if 'usv_lat' in table else np.full(n, ini_lat)
+    return pd.DataFrame({
+        'id': ['USV_Init'] + ['USV'] * (n - 1),
+        'source': source,
+        'timestamp': timestamp + pd.Timedelta(seconds=delay),
+        'usv_power': table['usv_power'].to_numpy() if 'usv_power' in table else 0.5,
+        'usv_lon': usv_lon,
+        'usv_lat': usv_lat,
+        'lon_usv_error': series['lon'] - usv_lon,
+        'lat_usv_error': series['lat'] - usv_lat,
+        'sun_radiation': 0.04 * sun,
+        'water_x': water_x,
+        'water_y': water_y,
+        'water_temp': sensors.get('water_temp', np.nan),
+        'bloom_detection': series['bloom'],
+        'bloom_size': series['size'],
+        'bloom_lon': series['lon'],
+        'bloom_lat': series['lat'],
+        'SensorsOn': table['SensorsOn'].to_numpy() if 'SensorsOn' in table else True,
+    }, columns=FIELDS)
@@ -1,14 +1,16 @@
 """
 Fichero que implementa las clases principales para la capa Fog.
 
-TODO: Hay un margen de mejora. El Cloud guarda datos de n_offset en n_offset,
-lo que significa que el remanente final no queda guardado. Hay que modificar
-esta clase para que guarde el remanente de datos final. Una forma sería enviar
-una señal stop cuando la simulación termina, de forma que la función de
-transición externa de GCS, al detectar este final, guarde los datos
-remanentes.
+El GCS guarda los datos de cada sensor en disco de forma incremental, cada
+n_offset filas o cada flush_seconds segundos simulados, y guarda el remanente
+final con CMD_SAVE_DATA, CMD_STOP_SIM y al salir de la simulación.
+
+Las lecturas de los sensores se fusionan por tick del USV (fog.fusion): la
+política 'all', 'quorum' o 'timeout' decide cuándo se envía el tick al
+Inference_Service, con NaN en las lecturas que faltan.
 """
 import math
+from collections import deque
 from queue import Empty
 import pandas as pd
 import numpy as np
@@ -27,8 +29,12 @@ from xdevs import get_logger, PHASE_ACTIVE
 from xdevs.models import Atomic, Coupled, Port
 from edge.sensor import SensorEventId, SensorInfo
 from util.util import DevsCsvFile
+from util.columns import ColumnStore, StreamWriter
 from util.event import CommandEvent, CommandEventId, DataEventId, EnergyEventId, Event, DataEventColumns, SensorEventId
-from util.reports import FogReportService
+from util.reports import FogReportService, shutdown_reports, submit_report, wait_reports
+from fog.bloom import FIELDS as ISV_FIELDS, PARAMS, SENSORS, BloomState, Ensemble, step
+from fog.fusion import FusionBuffer
+from fog.planner import assign as assign_usvs, cost as cost_matrix
 
 logger = get_logger(__name__, logging.DEBUG)
 
@@ -39,18 +45,26 @@ class GCS(Atomic):
     PHASE_PLANNER = "sending_to_USV_PLANNER"   # Sending Data to USV planner
     PHASE_SUN = "sensing_to_sensor_sun"    # Sending Comand to Sun sensor
     PHASE_CLOUD = "sending_to_cloud"         # Sending Data to Cloud
+    PHASE_FUSION = "waiting_for_sensors"     # Waiting for the end of a fusion window
     PHASE_INIT = "delt_int"
 
-    def __init__(self, name: str, usv_name: str, thing_names: list, thing_event_ids: list, base_folder: str = 'datafog', log_Time=False, log_Data=False, n_offset: int = 100):
+    def __init__(self, name: str, usv_name: str, thing_names: list, thing_event_ids: list, base_folder: str = 'datafog', log_Time=False, log_Data=False, n_offset: int = 100, flush_seconds: float = None, db_format: str = 'csv',
+                 fusion: str = 'all', quorum: int = None, timeout: float = None):
         """Función de inicialización de atributos."""
         super().__init__(name)
         self.thing_names = thing_names
         self.thing_event_ids = {}
+        # Fusión de los sensores (fog.fusion.FusionBuffer): política, quorum y timeout (segundos simulados)
+        self.fusion_policy = fusion
+        self.quorum = quorum
+        self.timeout = timeout
 
         self.base_folder = base_folder
         self.log_Time = log_Time
         self.log_Data = log_Data
-        self.n_offset = n_offset
+        self.n_offset = n_offset                # Filas por bloque guardado
+        self.flush_seconds = flush_seconds      # Segundos simulados por bloque guardado
+        self.db_format = db_format              # 'csv', 'parquet' o 'arrow'
 
         # Puertos de entrada de comandos
         self.i_cmd = Port(CommandEvent, "i_cmd")
@@ -107,143 +121,223 @@ class GCS(Atomic):
             id=self.dataid.value, source=self.name, timestamp=self.datetime, payload=payload)
 
         self.msgin_usv = None
-        self.msg = {}
+        # Periodo de la telemetría: las lecturas de un tick llegan antes del siguiente
+        period = min((b - a).total_seconds() for a, b in zip(self.datetimes, self.datetimes[1:])) if self.N > 1 else math.inf
+        self.fusion = FusionBuffer(self.thing_names, self.thing_event_ids, self.fusion_policy, self.quorum, self.timeout, period)
+        self.sun_name = next((thing_name for thing_name, event_id in self.thing_event_ids.items()
+                              if event_id == SensorEventId.SUN.value), None)
+        self.queue_isv = deque()    # Ticks para el Inference_Service
+        self.queue_sun = deque()    # Peticiones al sensor SUN
+        self.queue_usvp = deque()   # Respuestas del Inference_Service para el planificador
+        self.clock = 0              # Tiempo simulado
         self.db = {}
         self.db_cache = {}
         self.db_path = {}
+        self.db_writer = {}
+        self.batch = {}
+        self.last_flush = {}
         self.counter = {}
         for thing_name in self.thing_names:
-            self.db[thing_name] = pd.DataFrame(
-                columns=DataEventColumns.get_all_columns(self.thing_event_ids[thing_name]))
+            self.db[thing_name] = ColumnStore(
+                DataEventColumns.get_all_columns(self.thing_event_ids[thing_name]))
             self.db_cache[thing_name] = pd.DataFrame(
                 columns=DataEventColumns.get_all_columns(self.thing_event_ids[thing_name]))
             self.db_path[thing_name] = self.base_folder + "/" + \
                 self.parent.name + "." + thing_name
+            self.db_writer[thing_name] = StreamWriter(self.db_path[thing_name], self.db_format)
+            self.last_flush[thing_name] = None
             # offset
-            self.counter[thing_name] = pd.DataFrame(
-                columns=DataEventColumns.get_all_columns(self.thing_event_ids[thing_name]))
+            self.counter[thing_name] = 0
 
-        self.db["ExtSenS"] = pd.DataFrame(
-            columns=DataEventColumns.get_all_columns(self.thing_event_ids["SimSenS"]))
+        self.db["ExtSenS"] = ColumnStore(
+            DataEventColumns.get_all_columns(self.thing_event_ids["SimSenS"]))
         self.db_path["ExtSenS"] = self.base_folder + "/" + \
             self.parent.name + "." + "ExtSenS"
         self.passivate()
 
     def exit(self):
         """Función de salida de la simulación."""
-        pass
+        self.flush(force=True)
+        for thing_name in self.thing_names:
+            self.db_writer[thing_name].close()
+
+    def flush(self, timestamp: dt.datetime = None, force: bool = False):
+        """Guarda las filas nuevas de cada sensor cada n_offset filas o cada flush_seconds (force: todas)."""
+        for thing_name in self.thing_names:
+            if self.counter[thing_name] == 0:
+                if force:
+                    # Sensor sin filas: el fichero se crea igualmente (sólo la cabecera)
+                    db = self.db[thing_name]
+                    self.db_writer[thing_name].write(db.to_dataframe(len(db)))
+                continue
+            if self.last_flush[thing_name] is None:
+                self.last_flush[thing_name] = timestamp
+            due = force or self.counter[thing_name] >= self.n_offset
+            if not due and self.flush_seconds is not None and timestamp is not None:
+                due = (timestamp - self.last_flush[thing_name]).total_seconds() >= self.flush_seconds
+            if due:
+                db = self.db[thing_name]
+                self.db_writer[thing_name].write(db.to_dataframe(len(db) - self.counter[thing_name]))
+                # Bloque de columnas para la capa CLOUD (se acumula hasta que se envía)
+                block = {column: db.column(column)[-self.counter[thing_name]:].copy() for column in db.columns}
+                pending = self.batch.get(thing_name)
+                if pending is not None:
+                    block = {column: np.concatenate((pending[column], block[column])) for column in db.columns}
+                self.batch[thing_name] = block
+                db.discard(len(db))
+                self.counter[thing_name] = 0
+                self.last_flush[thing_name] = timestamp
 
     def lambdaf(self):
-        # Enviando el mensaje correspondiente al planificador o a los servicios necesarios
+        # Enviando el primer mensaje pendiente de la fase (deltint lo saca de su cola)
         if self.phase == self.PHASE_SUN and self.ind < self.N:
-            self.o_sensor_s.add(self.msgout_sensor)
-            self.passivate()
+            self.o_sensor_s.add(self.queue_sun[0])
 
         if self.phase == self.PHASE_ISV and self.ind < self.N:
-            self.o_isv.add(self.msgout_isv)
+            msgout_isv = self.queue_isv[0]
+            self.o_isv.add(msgout_isv)
             if self.log_Time is True:
                 logger.info("GCS->ISV: DataTime = %s" %
-                            (self.msgout_isv.timestamp))
+                            (msgout_isv.timestamp))
             if self.log_Data is True:
                 logger.info("GCS->ISV: Data = Sensors + msg_usv")
 
-            # EJEMPLO DE ENVÍO A LA CAPA CLOUD
-            for thing_name in self.thing_names:
-                self.get_out_port("o_" + thing_name).add(self.data[thing_name])
-            if self.log_Time is True:
-                logger.info("GCS->CLOUD: DataTime = %s" %
-                            (self.msgout_isv.timestamp))
-            if self.log_Data is True:
-                logger.info("GCS->CLOUD: Data = Sensors")
-            ###
-            self.passivate()
+            # Envío a la capa CLOUD de los bloques de n_offset filas
+            self.send_batches()
 
         if self.phase == self.PHASE_PLANNER and self.ind < self.N:
-            self.o_usvp.add(self.msgout_usvp)
+            msgout_usvp = self.queue_usvp[0]
+            self.o_usvp.add(msgout_usvp)
             if self.log_Time is True:
                 logger.info("GCS->USV_P: DataTime = %s" %
-                            (self.msgout_usvp.timestamp))
+                            (msgout_usvp.timestamp))
             if self.log_Data is True:
                 logger.info("GCS->USV_P: Data = %s" %
-                            (self.msgout_usvp.payload))
-            self.passivate()
-
-        if self.phase == self.PHASE_CLOUD and self.ind < self.N:
-            for thing_name in self.thing_names:
-                if self.counter[thing_name] >= self.n_offset:
-                    #df = self.db[thing_name].tail(self.n_offset)
-                    self.get_out_port("o_" + thing_name).add(df)
-            self.passivate()
+                            (msgout_usvp.payload))
+
+        if self.phase == self.PHASE_CLOUD:
+            self.send_batches()
+
+    def send_batches(self):
+        """Envía a la capa CLOUD un evento por sensor con las columnas guardadas desde el último envío."""
+        for thing_name, columns in self.batch.items():
+            rows = len(columns[self.db[thing_name].columns[0]])
+            self.get_out_port("o_" + thing_name).add(Event(
+                id=self.thing_event_ids[thing_name], source=thing_name, timestamp=self.max_time,
+                payload={'rows': rows, 'columns': columns}))
+        if len(self.batch) > 0:
+            if self.log_Time is True:
+                logger.info("GCS->CLOUD: DataTime = %s" % (self.max_time))
+            if self.log_Data is True:
+                logger.info("GCS->CLOUD: Data = %s blocks" % (len(self.batch)))
+        self.batch = {}
 
     def deltint(self):
         """DEVS internal transition function."""
-        # Calcula delta tiempo hasta siguiente Telemetría
-        self.passivate()
+        self.clock += self.sigma
+        # Se saca de su cola el mensaje enviado en lambdaf
+        if self.phase == self.PHASE_SUN:
+            self.queue_sun.popleft()
+        if self.phase == self.PHASE_ISV:
+            self.queue_isv.popleft()
+            if self.ind >= self.N:
+                self.queue_isv.clear()
+        if self.phase == self.PHASE_PLANNER:
+            self.queue_usvp.popleft()
+        self.schedule()
+
+    def schedule(self):
+        """Siguiente transición interna: un mensaje pendiente o el fin de la ventana de fusión más antigua."""
+        window = self.fusion.expired(self.clock)
+        while window is not None:
+            self.send_window(window)
+            window = self.fusion.expired(self.clock)
+        if len(self.queue_sun) > 0:
+            super().activate(self.PHASE_SUN)
+        elif len(self.queue_usvp) > 0:
+            super().activate(self.PHASE_PLANNER)
+        elif len(self.queue_isv) > 0:
+            super().activate(self.PHASE_ISV)
+        elif len(self.batch) > 0:
+            super().activate(self.PHASE_CLOUD)
+        elif self.fusion.deadline() < math.inf:
+            super().hold_in(self.PHASE_FUSION, self.fusion.deadline() - self.clock)
+        else:
+            super().passivate()
+
+    def request_sun(self, window):
+        """Pide la lectura del sensor SUN del tick."""
+        if window.ind >= self.N:
+            return
+        self.datetime = window.max_time.strftime(
+            "%Y-%m-%d %H:%M:%S")
+        row = self.mydata.iloc[window.ind]   # Telemetría
+        # {'DateTime': '', 'Lat': , 'Lon': , 'Depth': , 'Sensor': ''}
+        payload = row.to_dict()
+        self.dataid = SensorEventId.SUN
+        self.queue_sun.append(Event(
+            id=self.dataid.value, source=self.name, timestamp=self.datetime, payload=payload))
+
+    def check_window(self, window):
+        """Envía la ventana si está lista o pide el sensor SUN si es la única lectura que falta."""
+        if self.fusion.ready(window, self.clock):
+            self.send_window(window)
+        # Si falta únicamente el valor del sensor SUN
+        elif len(window.msgs) == len(self.thing_names)-1 and self.sun_name not in window.msgs:
+            self.request_sun(window)
+
+    def send_window(self, window):
+        """Cierra la ventana del tick, guarda sus lecturas y la encola para el Inference_Service."""
+        frame, missing = self.fusion.close(window)
+        self.max_time = window.max_time
+        for thing_name in self.thing_names:
+            msg_list = list()
+            msg_list.append(frame[thing_name].id)
+            msg_list.append(frame[thing_name].source)
+            msg_list.append(frame[thing_name].timestamp)
+            for value in frame[thing_name].payload.values():
+                msg_list.append(value)
+            self.db[thing_name].append(msg_list)
+            self.counter[thing_name] += 1
+        # Guardado de los datos cada self.n_offset
+        self.flush(self.max_time)
+        self.data = frame
+        if missing and self.log_Data is True:
+            logger.info("GCS->ISV: missing %s" % (missing))
+        window.usv.payload.update({'db': self.data, 'missing': missing})
+        self.queue_isv.append(Event(
+            id=window.usv.id, source=self.name, timestamp=self.max_time, payload=window.usv.payload))
 
     def deltext(self, e: Any):
         """Función DEVS de transición externa."""
         self.continuef(e)
+        self.clock += e
         # Procesamos primero el puerto del barco:
         if self.i_usv:
             self.msgin_usv = self.i_usv.get()
             self.max_time = self.msgin_usv.timestamp
-        if (self.msgin_usv != None):
             if self.msgin_usv.payload['SensorsOn'] == True:
-                # Se comprueban si todos los puertos de los sensores tienen mensajes de entrada:
-                for thing_name in self.thing_names:
-                    if self.get_in_port("i_" + thing_name).empty() is False:
-                        self.msg[thing_name] = self.get_in_port(
-                            "i_" + thing_name).get()
-                        self.max_time = max(
-                            self.max_time, self.msg[thing_name].timestamp)
-                # Si falta únicamente el valor del sensor SUN
-                if len(self.msg) == len(self.thing_names)-1:
-                    self.ind = self.ind + 1              # Actualizo indice a siguiente
-                    if self.ind >= self.N:
-                        self.passivate()
-                    else:
-                        self.datetime = self.max_time.strftime(
-                            "%Y-%m-%d %H:%M:%S")
-                        row = self.mydata.iloc[self.ind]   # Telemetría
-                        # {'DateTime': '', 'Lat': , 'Lon': , 'Depth': , 'Sensor': ''}
-                        payload = row.to_dict()
-                        self.dataid = SensorEventId.SUN
-                        self.msgout_sensor = Event(
-                            id=self.dataid.value, source=self.name, timestamp=self.datetime, payload=payload)
-                        self.activate(self.PHASE_SUN)
-
-                # Cuando se tiene la información de todos los sensores:
-                if len(self.msg) == len(self.thing_names):
-                    for thing_name in self.thing_names:
-                        msg_list = list()
-                        msg_list.append(self.msg[thing_name].id)
-                        msg_list.append(self.msg[thing_name].source)
-                        msg_list.append(self.msg[thing_name].timestamp)
-                        for value in self.msg[thing_name].payload.values():
-                            msg_list.append(value)
-                        self.db[thing_name].loc[len(
-                            self.db[thing_name])] = msg_list
-                        self.counter[thing_name] += 1
-                        # Envío de los datos hacia la capa CLOUD cada self.n_offset
-                        # if self.counter[thing_name] == self.n_offset:
-                        #    super().activate(self.PHASE_CLOUD)
-                    self.data = self.msg
-                    # Se activa la salida del módulo GCS, se actualizan los mensajes de salida(bypass temporal) y se eliminan todos los mensajes de entrada:
-                    self.msgin_usv.payload.update({'db': self.data})
-                    self.msgout_isv = Event(
-                        id=self.msgin_usv.id, source=self.name, timestamp=self.max_time, payload=self.msgin_usv.payload)
-                    self.msg = {}
-                    super().activate(self.PHASE_ISV)
+                # Se abre la ventana de fusión del tick (con las lecturas que llegaron antes)
+                self.ind = self.ind + 1              # Actualizo indice a siguiente
+                window = self.fusion.open(self.msgin_usv.timestamp, self.clock, self.msgin_usv, self.ind)
+                if window.msgs:
+                    self.check_window(window)
             else:
-                self.msgout_isv = Event(id=self.msgin_usv.id, source=self.name,
-                                        timestamp=self.msgin_usv.timestamp, payload=self.msgin_usv.payload)
-                super().activate(self.PHASE_ISV)
+                self.queue_isv.append(Event(id=self.msgin_usv.id, source=self.name,
+                                            timestamp=self.msgin_usv.timestamp, payload=self.msgin_usv.payload))
+        # Cada lectura se une a la ventana de su tick:
+        for thing_name in self.thing_names:
+            for msg in self.get_in_port("i_" + thing_name).values:
+                window = self.fusion.add(thing_name, msg)
+                if window is None:
+                    continue
+                self.max_time = max(self.max_time, msg.timestamp)
+                self.check_window(window)
 
         if self.i_isv.empty() is False:
             self.msgin_isv = self.i_isv.get()
-            self.msgout_usvp = Event(id=self.msgin_usv.id, source=self.name,
-                                     timestamp=self.max_time, payload=self.msgin_isv.payload)
-            super().activate(self.PHASE_PLANNER)
+            self.queue_usvp.append(Event(id=self.msgin_usv.id, source=self.name,
+                                         timestamp=self.max_time, payload=self.msgin_isv.payload))
 
         if self.i_cmd.empty() is False:
             cmd: CommandEvent = self.i_cmd.get()
@@ -279,12 +373,16 @@ class GCS(Atomic):
             if cmd.cmd == CommandEventId.CMD_SAVE_DATA:
                 # Aquí tenemos que guardar la base de datos.
                 logger.debug("GCS::deltext: Saving data...")
-                for thing_name in self.thing_names:
-                    self.db[thing_name].to_csv(
-                        self.db_path[thing_name] + ".csv")
-                    # self.db["ExtSenS"].to_csv(self.db_path["ExtSenS"] + ".csv")
+                # Se guarda y se envía el remanente de datos
+                self.flush(force=True)
                 logger.debug("GCS::deltext: done.")
 
+            if cmd.cmd == CommandEventId.CMD_STOP_SIM:
+                self.flush(force=True)
+
+        # Los mensajes pendientes salen de uno en uno (ver schedule)
+        self.schedule()
+
     def fit_outlayers(self, edge_device):
         """
         Función que se encarga de reparar los outliers.
@@ -324,16 +422,27 @@ class Usv_Planner(Atomic):
         PHASE_ON = "on"           #Initialited, wating for a resquet
         PHASE_WORK = "work"       #Providing Service
         PHASE_DONE = "done"       #Send Service data
+
+        Planificador de la flota: con cada dato del Inference_Service asigna los
+        USVs a los blooms candidatos (los top-k del modo ensemble o, si no hay,
+        el bloom del servicio) con fog.planner.assign, y envía a cada USV por su
+        puerto o_<usv> los errores de posición hasta su bloom. El primer USV es
+        el del GCS; su estado viene en el dato del servicio, el del resto en sus
+        propios mensajes (i_<usv>), empezando en la posición de su USV_Init si
+        la trae. cost es la función de coste de la asignación. Cada USV recibe
+        únicamente su dato, por su puerto o_<usv>, y su info, por o_info_<usv>.
     '''
     PHASE_SENDING = "sending"  # Sending Data
 
-    def __init__(self, name: str, delay: float, log_Time=False, log_Data=False):
+    def __init__(self, name: str, delay: float, log_Time=False, log_Data=False, usv_names: list = (), cost=cost_matrix):
         """Instancia la clase."""
         super().__init__(name)
 
         self.delay = delay
         self.log_Time = log_Time
         self.log_Data = log_Data
+        self.usv_names = list(usv_names)
+        self.cost = cost
         self.input_buffer = []
         self.data_buffer = []
 
@@ -341,11 +450,15 @@ class Usv_Planner(Atomic):
         self.i_in = Port(Event, "i_in")
         self.add_in_port(self.i_in)
 
-        # Puertos de salida para el FogServer
-        self.o_out = Port(Event, "o_out")
-        self.add_out_port(self.o_out)
-        self.o_info = Port(Event, "o_info")
-        self.add_out_port(self.o_info)
+        # Puerto de entrada de los blooms candidatos (desde el Inference_Service)
+        self.i_targets = Port(Event, "i_targets")
+        self.add_in_port(self.i_targets)
+
+        # Puertos de entrada-salida (datos e info) de cada USV
+        for usv_name in self.usv_names:
+            self.add_in_port(Port(Event, "i_" + usv_name))
+            self.add_out_port(Port(Event, "o_" + usv_name))
+            self.add_out_port(Port(Event, "o_info_" + usv_name))
 
     def initialize(self):
         """Función de inicialización."""
@@ -353,7 +466,11 @@ class Usv_Planner(Atomic):
         self.maxspeed = 0.002   # USV max speed
         self.electronic_consume = -0.003  # USV electronic consume
         self.SensorsOn = False   # Sensors boolean
-        self.msgout = None    # Message out
+        self.msgout = {}      # Messages out (by USV)
+        self.targets = None   # Last top-k candidate blooms
+        self.fleet = {}       # Last (usv_power, usv_lon, usv_lat) of each USV
+        self.starts = {}      # Initial (usv_lon, usv_lat) of the USVs that give one
+        self.assignment = {}  # Bloom (index in the targets) of each USV
         super().passivate()
 
     def exit(self):
@@ -364,12 +481,13 @@ class Usv_Planner(Atomic):
         """DEVS output function."""
         # if self.boolean == True:
         if self.phase == self.PHASE_SENDING:
-            self.o_out.add(self.msgout)
-            if self.log_Time is True:
-                logger.info("PLANNER->USV: datetime = %s" %
-                            (self.msgout.timestamp))
-            if self.log_Data is True:
-                logger.info("PLANNER->USV: Data = %s" % (self.msgout.payload))
+            for usv_name, msgout in self.msgout.items():
+                self.get_out_port("o_" + usv_name).add(msgout)
+                if self.log_Time is True:
+                    logger.info("PLANNER->%s: datetime = %s" %
+                                (usv_name, msgout.timestamp))
+                if self.log_Data is True:
+                    logger.info("PLANNER->%s: Data = %s" % (usv_name, msgout.payload))
             self.passivate()
 
     def deltint(self):
@@ -380,15 +498,47 @@ class Usv_Planner(Atomic):
         """Función DEVS de transición externa."""
         self.continuef(e)
         """DEVS external transition function."""
+        if (self.i_targets.empty() is False):
+            self.targets = self.i_targets.get().payload
+        for usv_name in self.usv_names:
+            for msg in self.get_in_port("i_" + usv_name).values:
+                if msg.id == 'USV':
+                    self.fleet[usv_name] = (msg.payload['usv_power'], msg.payload['usv_lon'], msg.payload['usv_lat'])
+                elif msg.id == 'USV_Init' and 'usv_lon' in msg.payload:
+                    self.starts[usv_name] = (msg.payload['usv_lon'], msg.payload['usv_lat'])
         if (self.i_in.empty() is False):
             self.msgin = self.i_in.get()
             self.datetime = self.msgin.timestamp + \
                 dt.timedelta(seconds=self.delay)
-            # bypass temporal
-            self.msgout = Event(id=self.msgin.id, source=self.name,
-                                timestamp=self.datetime, payload=self.msgin.payload)
+            self.msgout = {usv_name: Event(id=self.msgin.id, source=self.name, timestamp=self.datetime, payload=payload)
+                           for usv_name, payload in self.plan(self.msgin.payload).items()}
             super().activate(self.PHASE_SENDING)
 
+    def plan(self, payload: dict) -> dict:
+        """Dato para cada USV: el del servicio con el estado del USV y los errores hasta su bloom."""
+        if self.targets is not None and len(self.targets['bloom_lon']) > 0:
+            targets = self.targets
+        else:
+            targets = {key: [payload[key]] for key in ('bloom_lon', 'bloom_lat', 'bloom_size')}
+        # El USV del GCS tiene su estado en el dato; los USVs sin mensajes todavía parten
+        # de su posición inicial o, si no la tienen, del mismo punto
+        state = (payload['usv_power'], payload['usv_lon'], payload['usv_lat'])
+        self.fleet[self.usv_names[0]] = state
+        fleet = [self.fleet.get(usv_name, (state[0],) + self.starts.get(usv_name, state[1:]))
+                 for usv_name in self.usv_names]
+        power, lon, lat = np.array(fleet, dtype=np.float64).T
+        usv, bloom = assign_usvs(self.cost(lon, lat, power, targets['bloom_lon'], targets['bloom_lat'], targets['bloom_size']))
+        self.assignment = {self.usv_names[i]: int(j) for i, j in zip(usv, bloom)}
+        payloads = {}
+        for usv_name, (usv_power, usv_lon, usv_lat) in zip(self.usv_names, fleet):
+            # Los USVs sin bloom se quedan donde están
+            j = self.assignment.get(usv_name)
+            lon_error = targets['bloom_lon'][j] - usv_lon if j is not None else 0.0
+            lat_error = targets['bloom_lat'][j] - usv_lat if j is not None else 0.0
+            payloads[usv_name] = {**payload, 'usv_power': usv_power, 'usv_lon': usv_lon, 'usv_lat': usv_lat,
+                                  'lon_usv_error': lon_error, 'lat_usv_error': lat_error}
+        return payloads
+
 
 class Inference_Service(Atomic):
     ''' Fases útiles para futuras implementaciones
@@ -400,12 +550,19 @@ class Inference_Service(Atomic):
     '''
     PHASE_SENDING = "sending"     # Sending Data
 
-    def __init__(self, name: str, usv_name: str, thing_names, delay: float, log_Time=False, log_Data=False):
+    def __init__(self, name: str, usv_name: str, thing_names, delay: float, log_Time=False, log_Data=False, simbody=None, seeds=None, top_k: int = 5):
         super().__init__(name)
         self.thing_names = thing_names
         self.delay = delay
         self.log_Time = log_Time
         self.log_Data = log_Data
+        # Ensemble mode (fog.bloom.Ensemble): candidate blooms on the map cells
+        # given by seeds (None: off, 'all', N or cell indices), read from simbody
+        self.simbody = simbody
+        self.seeds = seeds
+        self.top_k = top_k
+        if seeds is not None and simbody is None:
+            raise ValueError('The ensemble mode needs the simbody')
 
         # Puerto de entrada de comandos(desde el Generador)
         self.i_cmd = Port(CommandEvent, "i_cmd")
@@ -423,29 +580,36 @@ class Inference_Service(Atomic):
         self.o_info = Port(Event, "o_info")
         self.add_out_port(self.o_info)
 
+        # Puerto de salida de los blooms candidatos (hacia el planificador)
+        self.o_targets = Port(Event, "o_targets")
+        self.add_out_port(self.o_targets)
+
     def initialize(self):
         # Wait for a resquet
 
         self.tau = 100       # Time
         self.lyr = 54        # Depth layers (54 = surface)
         self.ip = 9         # Bloom particle position index on map
-        self.k_breath = 0.05      # Breath
-        self.k_photo = 5         # Photosynthesis
-        self.k_decrease = 1/6       # Decrease
-        self.k_growth = 1         # Growth
-        self.k_2d_dis_bloom = 1/60      # Bloom 2D displacement
-
-        self.nox = list()    # Nitrate
-        self.dox = list()    # Dissolved oxygen
-        self.algae = list()    # Algae
-        self.water_temp = list()    # Water temperature
-        self.water_x = list()    # Water speed x axis
-        self.water_y = list()    # Water speed y axis
-        self.wind_x = list()    # Wind speed x axis
-        self.wind_y = list()    # Wind speed y axis
-        self.sun = list()    # Sun radiation
+        self.k_breath = PARAMS['k_breath']              # Breath
+        self.k_photo = PARAMS['k_photo']                # Photosynthesis
+        self.k_decrease = PARAMS['k_decrease']          # Decrease
+        self.k_growth = PARAMS['k_growth']              # Growth
+        self.k_2d_dis_bloom = PARAMS['k_2d_dis_bloom']  # Bloom 2D displacement
+
+        # Sensors (NaN until their first reading)
+        self.nox = np.nan    # Nitrate
+        self.dox = np.nan    # Dissolved oxygen
+        self.algae = np.nan    # Algae
+        self.water_temp = np.nan    # Water temperature
+        self.water_x = np.nan    # Water speed x axis
+        self.water_y = np.nan    # Water speed y axis
+        self.wind_x = np.nan    # Wind speed x axis
+        self.wind_y = np.nan    # Wind speed y axis
+        self.sun = np.nan    # Sun radiation
         self.frame = 0         # Frame
         self.msgout = None      # Message out
+        self.ensemble = None    # Candidate blooms
+        self.msgout_targets = None  # Top-k blooms out
 
         self.passivate()
 
@@ -499,159 +663,75 @@ class Inference_Service(Atomic):
                 self.usv_power = 0.5
                 self.usv_lon = self.ini_bloom_lon
                 self.usv_lat = self.ini_bloom_lat
-
-                # Load the sensors data into variables
-                for thing_name in self.thing_names:
-                    if self.db[thing_name].id == 'NOX':
-                        self.nox = self.db[thing_name].payload['Value']
-                    if self.db[thing_name].id == 'DOX':
-                        self.dox = self.db[thing_name].payload['Value']
-                    if self.db[thing_name].id == 'ALG':
-                        self.algae = self.db[thing_name].payload['Value']
-                    if self.db[thing_name].id == 'WTE':
-                        self.water_temp = self.db[thing_name].payload['Value']
-                    if self.db[thing_name].id == 'WFU':
-                        self.water_x = self.db[thing_name].payload['Value']
-                    if self.db[thing_name].id == 'WFV':
-                        self.water_y = self.db[thing_name].payload['Value']
-                    if self.db[thing_name].id == 'WFX':
-                        self.wind_x = self.db[thing_name].payload['Value']
-                    if self.db[thing_name].id == 'WFY':
-                        self.wind_y = self.db[thing_name].payload['Value']
-                    if self.db[thing_name].id == 'SUN':
-                        self.sun = self.db[thing_name].payload['Value']
-
-                # When the day begins it restarts
-                if self.datetime.hour == 0 and self.datetime.minute == 0:
-                    self.bloom_size = self.ini_bloom_size
-                    self.bloom_lon = self.ini_bloom_lon
-                    self.bloom_lat = self.ini_bloom_lat
-                    self.bloom = False
-
-                # Recalculate USV ip
-                _, self.ip = self.maptree.query([self.usv_lon, self.usv_lat])
-
-                # Variable calculations
-                self.breath = self.nox * self.dox
-                self.photosynthesis = self.nox * self.sun
-                self.food = self.k_breath * self.breath + self.k_photo * self.photosynthesis
-                self.sun_radiation = 0.04 * self.sun
-
-                # Bloom logic
-                if self.dox > 20:
-                    self.bloom = True
-                if self.dox < 15:
-                    self.bloom = False
-
-                # Bloom dynamic
-                self.bloom_size = self.bloom_size + self.k_growth * \
-                    self.food - self.k_decrease * self.bloom_size
-                if self.bloom:
-                    self.bloom_lon = self.bloom_lon + self.k_2d_dis_bloom * self.water_x
-                    self.bloom_lat = self.bloom_lat + self.k_2d_dis_bloom * self.water_y
-                else:
-                    self.bloom_lon = self.ini_bloom_lon
-                    self.bloom_lat = self.ini_bloom_lat
-                # Size control
-                if self.bloom_size > 10:
-                    self.bloom_size = 10
-
-                # USV position error
-                self.lon_usv_error = self.bloom_lon - self.usv_lon
-                self.lat_usv_error = self.bloom_lat - self.usv_lat
-
-                # Se construye la trama de datos a enviar:
-                self.datetime += dt.timedelta(seconds=self.delay)
-                data = {'usv_power': self.usv_power, 'usv_lon': self.usv_lon, 'usv_lat': self.usv_lat, 'lon_usv_error': self.lon_usv_error,
-                        'lat_usv_error': self.lat_usv_error, 'sun_radiation': self.sun_radiation, 'water_x': self.water_x, 'water_y': self.water_y,
-                        'water_temp': self.water_temp, 'bloom_detection': self.bloom, 'bloom_size': self.bloom_size, 'bloom_lon': self.bloom_lon, 'bloom_lat': self.bloom_lat, 'SensorsOn': self.SensorsOn}
-                self.msgout = Event(
-                    id=self.msgin.id, source=self.name, timestamp=self.datetime, payload=data)
-                self.frame += 1
-                super().activate(self.PHASE_SENDING)
+                if self.seeds is not None:
+                    self.ensemble = Ensemble(self.maptree, None if isinstance(self.seeds, str) else self.seeds, self.bloom,
+                                             k_breath=self.k_breath, k_photo=self.k_photo, k_decrease=self.k_decrease,
+                                             k_growth=self.k_growth, k_2d_dis_bloom=self.k_2d_dis_bloom)
 
             # The other messages only contain the USV and sensors info
-            if self.msgin.id == 'USV':
+            elif self.msgin.id == 'USV':
                 # Load the payload data into variables
                 self.usv_power = self.msgin.payload['usv_power']   # USV power
                 # USV longitude
                 self.usv_lon = self.msgin.payload['usv_lon']
                 self.usv_lat = self.msgin.payload['usv_lat']     # USV latitude
 
-                # Load the sensors data into variables
-                for thing_name in self.thing_names:
-                    if self.db[thing_name].id == 'NOX':
-                        self.nox = self.db[thing_name].payload['Value']
-                    if self.db[thing_name].id == 'DOX':
-                        self.dox = self.db[thing_name].payload['Value']
-                    if self.db[thing_name].id == 'ALG':
-                        self.algae = self.db[thing_name].payload['Value']
-                    if self.db[thing_name].id == 'WTE':
-                        self.water_temp = self.db[thing_name].payload['Value']
-                    if self.db[thing_name].id == 'WFU':
-                        self.water_x = self.db[thing_name].payload['Value']
-                    if self.db[thing_name].id == 'WFV':
-                        self.water_y = self.db[thing_name].payload['Value']
-                    if self.db[thing_name].id == 'WFX':
-                        self.wind_x = self.db[thing_name].payload['Value']
-                    if self.db[thing_name].id == 'WFY':
-                        self.wind_y = self.db[thing_name].payload['Value']
-                    if self.db[thing_name].id == 'SUN':
-                        self.sun = self.db[thing_name].payload['Value']
-
-                # When the day begins it restarts
-                if self.datetime.hour == 0 and self.datetime.minute == 0:
-                    self.bloom_size = self.ini_bloom_size
-                    self.bloom_lon = self.ini_bloom_lon
-                    self.bloom_lat = self.ini_bloom_lat
-                    self.bloom = False
-
-                # Recalculate USV ip
-                _, self.ip = self.maptree.query([self.usv_lon, self.usv_lat])
-
-                # Variable calculations
-                self.breath = self.nox * self.dox
-                self.photosynthesis = self.nox * self.sun
-                self.food = self.k_breath * self.breath + self.k_photo * self.photosynthesis
-                self.sun_radiation = 0.04 * self.sun
-
-                # Bloom logic
-                if self.dox > 20:
-                    self.bloom = True
-                if self.dox < 15:
-                    self.bloom = False
-
-                # Bloom dynamic
-                self.bloom_size = self.bloom_size + self.k_growth * \
-                    self.food - self.k_decrease * self.bloom_size
-                if self.bloom:
-                    self.bloom_lon = self.bloom_lon + self.k_2d_dis_bloom * self.water_x
-                    self.bloom_lat = self.bloom_lat + self.k_2d_dis_bloom * self.water_y
-                else:
-                    self.bloom_lon = self.ini_bloom_lon
-                    self.bloom_lat = self.ini_bloom_lat
-                # Size control
-                if self.bloom_size > 10:
-                    self.bloom_size = 10
-
-                # USV position error
-                self.lon_usv_error = self.bloom_lon - self.usv_lon
-                self.lat_usv_error = self.bloom_lat - self.usv_lat
-
-                # Se construye la trama de datos a enviar:
-                self.datetime += dt.timedelta(seconds=self.delay)
-                data = {'usv_power': self.usv_power, 'usv_lon': self.usv_lon, 'usv_lat': self.usv_lat, 'lon_usv_error': self.lon_usv_error,
-                        'lat_usv_error': self.lat_usv_error, 'sun_radiation': self.sun_radiation, 'water_x': self.water_x, 'water_y': self.water_y,
-                        'water_temp': self.water_temp, 'bloom_detection': self.bloom, 'bloom_size': self.bloom_size, 'bloom_lon': self.bloom_lon, 'bloom_lat': self.bloom_lat, 'SensorsOn': self.SensorsOn}
-                self.msgout = Event(
-                    id=self.msgin.id, source=self.name, timestamp=self.datetime, payload=data)
-                self.frame += 1
-                super().activate(self.PHASE_SENDING)
+            else:
+                return
+
+            # Load the sensors data into variables (the readings missing in
+            # the fusion window keep their last value)
+            missing = self.msgin.payload.get('missing', ())
+            for thing_name in self.thing_names:
+                var = SENSORS.get(self.db[thing_name].id)
+                if var is not None and thing_name not in missing:
+                    setattr(self, var, self.db[thing_name].payload['Value'])
+
+            # Recalculate USV ip
+            _, self.ip = self.maptree.query([self.usv_lon, self.usv_lat])
+
+            # Bloom dynamic (fog.bloom.step); when the day begins it restarts
+            restart = self.datetime.hour == 0 and self.datetime.minute == 0
+            state = step(BloomState(self.bloom_size, self.bloom_lon, self.bloom_lat, self.bloom),
+                         self.ini_bloom_lon, self.ini_bloom_lat, self.nox, self.dox, self.sun,
+                         self.water_x, self.water_y, restart,
+                         k_breath=self.k_breath, k_photo=self.k_photo, k_decrease=self.k_decrease,
+                         k_growth=self.k_growth, k_2d_dis_bloom=self.k_2d_dis_bloom)
+            self.bloom_size = state.size.item()
+            self.bloom_lon = state.lon.item()
+            self.bloom_lat = state.lat.item()
+            self.bloom = state.bloom.item()
+            self.sun_radiation = 0.04 * self.sun
+
+            # Candidate blooms: the same step over the fields at their cells
+            if self.ensemble is not None:
+                # Segundos desde el inicio del cuerpo, como los sensores (edge/sensor.py)
+                mytime = (self.datetime - self.simbody.dtini).total_seconds()
+                self.ensemble.step(**self.ensemble.read(self.simbody, mytime), restart=restart)
+                self.msgout_targets = Event(id='Targets', source=self.name,
+                                            timestamp=self.datetime + dt.timedelta(seconds=self.delay),
+                                            payload=self.ensemble.top(self.top_k))
+
+            # USV position error
+            self.lon_usv_error = self.bloom_lon - self.usv_lon
+            self.lat_usv_error = self.bloom_lat - self.usv_lat
+
+            # Se construye la trama de datos a enviar:
+            self.datetime += dt.timedelta(seconds=self.delay)
+            data = {'usv_power': self.usv_power, 'usv_lon': self.usv_lon, 'usv_lat': self.usv_lat, 'lon_usv_error': self.lon_usv_error,
+                    'lat_usv_error': self.lat_usv_error, 'sun_radiation': self.sun_radiation, 'water_x': self.water_x, 'water_y': self.water_y,
+                    'water_temp': self.water_temp, 'bloom_detection': self.bloom, 'bloom_size': self.bloom_size, 'bloom_lon': self.bloom_lon, 'bloom_lat': self.bloom_lat, 'SensorsOn': self.SensorsOn}
+            self.msgout = Event(
+                id=self.msgin.id, source=self.name, timestamp=self.datetime, payload=data)
+            self.frame += 1
+            super().activate(self.PHASE_SENDING)
 
     def lambdaf(self):
         """DEVS output function."""
         if self.phase == self.PHASE_SENDING:
             self.o_out.add(self.msgout)
+            if self.msgout_targets is not None:
+                self.o_targets.add(self.msgout_targets)
             if self.log_Time is True:
                 logger.info("ISV->GCS: datetime = %s" %
                             (self.msgout.timestamp))
@@ -666,20 +746,28 @@ class Inference_Service(Atomic):
 class FogReport(Atomic):
     """Atomic class FogReport, to generate the report of the simulation."""
 
-    def __init__(self, name, base_folder: str = 'datafog'):
+    def __init__(self, name, base_folder: str = 'datafog', background: bool = True, db_format: str = 'csv'):
         """Inicialización de atributos."""
         super().__init__(name)
         self.iport_cmd = Port(Event, "i_cmd")
         self.add_in_port(self.iport_cmd)
         self.base_folder = base_folder
+        # Informes en segundo plano (util.reports.submit_report): la copia de los
+        # ficheros sólo vale para CSV, un Parquet o Arrow a medias no tiene pie
+        if background and db_format != 'csv':
+            raise ValueError(f'Background reports need the csv format, not {db_format}')
+        self.background = background
 
     def initialize(self):
         """Initialization function."""
+        self.reports = []
         self.passivate()
 
     def exit(self):
         """Exit function."""
-        pass
+        # Se espera a los informes que siguen en curso
+        wait_reports(self.reports)
+        shutdown_reports()
 
     def lambdaf(self):
         """DEVS output function."""
@@ -697,23 +785,35 @@ class FogReport(Atomic):
             if cmd.cmd == CommandEventId.CMD_FOG_REPORT:
                 logger.debug("FogReport::deltext: Generating report...")
                 report: FogReportService = FogReportService(self.base_folder)
-                report.run()
-                logger.debug("FogReport::deltext: Report generated.")
+                if self.background:
+                    self.reports.append(submit_report(report))
+                    logger.debug("FogReport::deltext: Report submitted.")
+                else:
+                    report.run()
+                    logger.debug("FogReport::deltext: Report generated.")
 
 
 class FogServer(Coupled):
-    """Clase acoplada FogServer."""
+    """Clase acoplada FogServer.
+
+    usv_name es el nombre de un USV o una lista de USVs. El primero es el que
+    lleva los sensores del GCS; el planificador reparte la flota entera entre
+    los blooms (ver Usv_Planner)."""
 
-    def __init__(self, name, usv_name: str, thing_names: list, thing_event_ids: list, sensor_s, base_folder: str = 'datafog', log_Data=False, log_Time=False, n_offset: int = 100):
+    def __init__(self, name, usv_name: str | list, thing_names: list, thing_event_ids: list, sensor_s, base_folder: str = 'datafog', log_Data=False, log_Time=False, n_offset: int = 100, flush_seconds: float = None, db_format: str = 'csv', simbody=None, seeds=None, top_k: int = 5,
+                 fusion: str = 'all', quorum: int = None, timeout: float = None):
         """Inicialización de atributos."""
         super().__init__(name)
         self.i_cmd = Port(CommandEvent, "i_cmd")
         self.add_in_port(self.i_cmd)
 
-        # Puerto de entrada de la conexión con el USV
-        self.add_in_port(Port(Event, "i_" + usv_name))
-        # Puerto de salida de la conexión con el USV
-        self.add_out_port(Port(Event, "o_" + usv_name))
+        self.usv_names = [usv_name] if isinstance(usv_name, str) else list(usv_name)
+        usv_name = self.usv_names[0]
+        for name_usv in self.usv_names:
+            # Puerto de entrada de la conexión con el USV
+            self.add_in_port(Port(Event, "i_" + name_usv))
+            # Puerto de salida de la conexión con el USV
+            self.add_out_port(Port(Event, "o_" + name_usv))
         # Puerto de salida de la conexión con el sensor S
         self.o_sensor = Port(Event, "o_sensor")
         self.add_out_port(self.o_sensor)
@@ -724,7 +824,9 @@ class FogServer(Coupled):
             self.add_out_port(Port(Event, "o_" + thing_name))
 
         gcs = GCS("GCS", usv_name, thing_names, thing_event_ids, base_folder=base_folder,
-                  log_Time=log_Time, log_Data=log_Data, n_offset=n_offset)
+                  log_Time=log_Time, log_Data=log_Data, n_offset=n_offset,
+                  flush_seconds=flush_seconds, db_format=db_format,
+                  fusion=fusion, quorum=quorum, timeout=timeout)
         self.add_component(gcs)
         self.add_coupling(self.i_cmd, gcs.i_cmd)
         # Conexión del puerto de entrad del USV con la entrada del GCS
@@ -743,25 +845,28 @@ class FogServer(Coupled):
 
         # USVs planner
         USVp = Usv_Planner("USVs_Planner", delay=0,
-                           log_Time=log_Time, log_Data=log_Data)
+                           log_Time=log_Time, log_Data=log_Data, usv_names=self.usv_names)
         self.add_component(USVp)
         # Conexión de salida del puerto del GCS con el puerto de entrada del planificador
         self.add_coupling(gcs.o_usvp, USVp.i_in)
-        # Conexión de salida del planificador con el puerto de salida del FogServer
-        self.add_coupling(USVp.o_out, self.get_out_port("o_" + usv_name))
-        self.add_coupling(USVp.o_info, self.get_out_port("o_" + usv_name))
+        for name_usv in self.usv_names:
+            # Estado de cada USV y salida del planificador hacia cada USV
+            self.add_coupling(self.get_in_port("i_" + name_usv), USVp.get_in_port("i_" + name_usv))
+            self.add_coupling(USVp.get_out_port("o_" + name_usv), self.get_out_port("o_" + name_usv))
+            self.add_coupling(USVp.get_out_port("o_info_" + name_usv), self.get_out_port("o_" + name_usv))
 
         # Inference Service
         isv = Inference_Service("InferenceService", usv_name,
-                                thing_names, delay=0, log_Time=log_Time, log_Data=log_Data)
+                                thing_names, delay=0, log_Time=log_Time, log_Data=log_Data,
+                                simbody=simbody, seeds=seeds, top_k=top_k)
         self.add_component(isv)
         self.add_coupling(self.i_cmd, isv.i_cmd)
         self.add_coupling(gcs.o_isv, isv.i_in)
         self.add_coupling(isv.o_out, gcs.i_isv)
+        self.add_coupling(isv.o_targets, USVp.i_targets)
 
         # Save data of the inference service:
-        isv_fields: list = ["id", "source", "timestamp", "usv_power", "usv_lon", "usv_lat", "lon_usv_error", "lat_usv_error",
-                            "sun_radiation", "water_x", "water_y", "water_temp", "bloom_detection", "bloom_size", "bloom_lon", "bloom_lat", "SensorsOn"]
+        isv_fields: list = ISV_FIELDS
         isv_csv = DevsCsvFile(name=self.name + "." + isv.name,
                               source_name=isv.name, fields=isv_fields, base_folder=base_folder)
         self.add_component(isv_csv)
@@ -769,7 +874,7 @@ class FogServer(Coupled):
         self.add_coupling(isv.o_out, isv_csv.iport_data)
 
         # Reports
-        report: FogReport = FogReport("FogReport", base_folder=base_folder)
+        report: FogReport = FogReport("FogReport", base_folder=base_folder, background=db_format == 'csv', db_format=db_format)
         self.add_component(report)
         self.add_coupling(self.i_cmd, report.iport_cmd)
 
@@ -0,0 +1,166 @@
+"""
+Fusión de las lecturas de los sensores por tick del USV.
+
+Cada mensaje del USV abre una ventana del FusionBuffer, y cada lectura se une
+a la ventana de su tick: la de clave k con k <= timestamp < k + period, siendo
+period el periodo de muestreo de la telemetría. Una ventana está lista cuando
+tiene todas las lecturas ('all'), al menos quorum lecturas ('quorum') o, si
+se da un timeout, cuando han pasado timeout segundos simulados desde que se
+abrió ('timeout'). La trama de una ventana lista lleva una lectura NaN por
+cada sensor que falta, de modo que una lectura retrasada o perdida nunca
+bloquea el flujo.
+
+Las lecturas de ventanas ya cerradas y las repetidas (un sensor que ya tiene
+lectura en su ventana) se cuentan como tardías y se descartan. Las lecturas
+que llegan antes que el mensaje del USV de su tick se guardan hasta que se
+abre su ventana. El GCS pide la lectura del sensor SUN cuando han llegado las
+demás, así que con un quorum menor que el número de sensores la lectura SUN
+suele faltar.
+"""
+import math
+import datetime as dt
+from util.event import DataEventColumns, Event
+
+POLICIES = ('all', 'quorum', 'timeout')
+
+
+class FusionWindow:
+    """Lecturas de un tick del USV."""
+
+    __slots__ = ('key', 'opened', 'usv', 'msgs', 'max_time', 'ind')
+
+    def __init__(self, key: dt.datetime, opened: float, usv: Event, ind: int = None):
+        self.key = key              # Timestamp del mensaje del USV
+        self.opened = opened        # Tiempo simulado de apertura
+        self.usv = usv              # Mensaje del USV
+        self.msgs = {}              # thing_name -> lectura del sensor
+        self.max_time = key         # Último timestamp de la ventana
+        self.ind = ind              # Fila de la telemetría del sol
+
+
+class FusionBuffer:
+    """Buffer de unión de las lecturas de los sensores de cada tick del USV."""
+
+    def __init__(self, thing_names: list, thing_event_ids: dict, policy: str = 'all', quorum: int = None, timeout: float = None,
+                 period: float = math.inf):
+        if policy not in POLICIES:
+            raise ValueError(f'Unknown fusion policy: {policy}')
+        if policy == 'quorum' and (quorum is None or not 0 < quorum <= len(thing_names)):
+            raise ValueError('The quorum policy needs 0 < quorum <= number of sensors')
+        if policy == 'timeout' and timeout is None:
+            raise ValueError('The timeout policy needs a timeout')
+        self.thing_names = thing_names
+        self.thing_event_ids = thing_event_ids
+        self.policy = policy
+        self.quorum = quorum if policy == 'quorum' else len(thing_names)
+        self.timeout = timeout
+        self.period = period        # Periodo de muestreo (segundos)
+        self.windows = {}           # Ventanas abiertas por clave, en orden de apertura
+        self.slots = {}             # Ventanas abiertas por hueco de period segundos (ver slot)
+        self.origin = None          # Clave de la primera ventana: origen de los huecos
+        self.early = []             # Lecturas (thing_name, msg) de ticks aún sin ventana
+        self.last_key = None        # Clave de la última ventana abierta
+        self.late = 0               # Lecturas descartadas (ventana cerrada o repetidas)
+        self.partial = 0            # Tramas enviadas con lecturas que faltan
+
+    def __len__(self):
+        return len(self.windows)
+
+    def tick(self, key: dt.datetime, timestamp: dt.datetime) -> bool:
+        """La lectura de timestamp pertenece al tick de clave key."""
+        return 0 <= (timestamp - key).total_seconds() < self.period
+
+    def slot(self, timestamp: dt.datetime) -> int:
+        """Hueco de period segundos, contados desde origin, en el que cae timestamp."""
+        return math.floor((timestamp - self.origin).total_seconds() / self.period)
+
+    def open(self, key: dt.datetime, now: float, usv: Event, ind: int = None) -> FusionWindow:
+        """Abre la ventana de un tick del USV (un tick repetido reutiliza su ventana).
+        Las lecturas que llegaron antes que el mensaje del USV se unen a ella."""
+        window = self.windows.get(key)
+        if window is None:
+            if self.origin is None:
+                self.origin = key
+            window = self.windows[key] = self.slots[self.slot(key)] = FusionWindow(key, now, usv, ind)
+        else:
+            window.usv = usv
+        if self.last_key is None or key > self.last_key:
+            self.last_key = key
+        early, self.early = self.early, []
+        for thing_name, msg in early:
+            if self.tick(key, msg.timestamp):
+                self.join(window, thing_name, msg)
+            elif msg.timestamp < key:
+                self.late += 1      # Su tick no llegó a abrirse
+            else:
+                self.early.append((thing_name, msg))
+        return window
+
+    def add(self, thing_name: str, msg: Event) -> FusionWindow:
+        """Une una lectura a la ventana de su tick (None si es tardía o se guarda para después)."""
+        if self.origin is not None:
+            # Las claves distan al menos period: el tick de la lectura es el de su hueco o el anterior
+            slot = self.slot(msg.timestamp)
+            for window in (self.slots.get(slot), self.slots.get(slot - 1)):
+                if window is not None and self.tick(window.key, msg.timestamp):
+                    return window if self.join(window, thing_name, msg) else None
+        if self.last_key is None or msg.timestamp >= self.last_key + dt.timedelta(seconds=self.period):
+            self.early.append((thing_name, msg))
+        else:
+            self.late += 1
+        return None
+
+    def join(self, window: FusionWindow, thing_name: str, msg: Event) -> bool:
+        """Guarda la lectura en la ventana; la repetida de un sensor cuenta como tardía."""
+        if thing_name in window.msgs:
+            self.late += 1
+            return False
+        window.msgs[thing_name] = msg
+        window.max_time = max(window.max_time, msg.timestamp)
+        return True
+
+    def ready(self, window: FusionWindow, now: float) -> bool:
+        """La ventana se puede enviar, según la política."""
+        if len(window.msgs) >= self.quorum:
+            return True
+        return self.timeout is not None and now >= window.opened + self.timeout
+
+    def deadline(self) -> float:
+        """Tiempo simulado en el que vence la ventana abierta más antigua."""
+        if self.timeout is None or not self.windows:
+            return math.inf
+        return next(iter(self.windows.values())).opened + self.timeout
+
+    def expired(self, now: float) -> FusionWindow:
+        """La ventana más antigua que ha vencido, si la hay."""
+        if self.timeout is not None and self.windows:
+            window = next(iter(self.windows.values()))
+            if now >= window.opened + self.timeout:
+                return window
+        return None
+
+    def close(self, window: FusionWindow) -> tuple:
+        """Cierra la ventana: (trama con una lectura por sensor, sensores que faltan)."""
+        self.windows.pop(window.key, None)
+        slot = self.slot(window.key)
+        if self.slots.get(slot) is window:
+            del self.slots[slot]
+        frame = {}
+        missing = []
+        for thing_name in self.thing_names:
+            msg = window.msgs.get(thing_name)
+            if msg is None:
+                msg = self.missing(thing_name, window.max_time)
+                missing.append(thing_name)
+            frame[thing_name] = msg
+        if missing:
+            self.partial += 1
+        return frame, missing
+
+    def missing(self, thing_name: str, timestamp: dt.datetime) -> Event:
+        """Lectura de un sensor que falta: NaN en todas las columnas de datos."""
+        event_id = self.thing_event_ids[thing_name]
+        columns = DataEventColumns.get_data_columns(event_id)
+        payload = {column: math.nan for column in columns[:-1]}
+        payload['Value'] = math.nan
+        return Event(id=event_id, source=thing_name, timestamp=timestamp, payload=payload)
@@ -0,0 +1,36 @@
+"""
+Asignación de la flota de USVs a los blooms candidatos.
+
+cost construye la matriz de costes (USVs x blooms) en una única expresión
+vectorizada y assign la resuelve con scipy.optimize.linear_sum_assignment.
+Usv_Planner (fog/fog.py) recibe la función de coste como parámetro, así que
+se pueden usar otras políticas con la misma firma.
+"""
+import numpy as np
+from scipy.optimize import linear_sum_assignment
+
+K_POWER = 1.0       # Weight of the battery used (usv_power 1 is a full battery)
+K_SIZE = 0.01       # Weight of the bloom size (degrees per unit of size)
+UNREACHABLE = 1e6   # Cost of the positions that are not known (NaN)
+
+
+def cost(usv_lon, usv_lat, usv_power, bloom_lon, bloom_lat, bloom_size, k_power=K_POWER, k_size=K_SIZE) -> np.ndarray:
+    """Cost of sending each USV (rows) to each bloom (columns).
+
+    The distance to the bloom, longer for the boats with less battery, minus a
+    bonus for the bigger blooms."""
+    usv_lon, usv_lat, usv_power = (np.asarray(x, dtype=np.float64)[:, None] for x in (usv_lon, usv_lat, usv_power))
+    bloom_lon, bloom_lat, bloom_size = (np.asarray(x, dtype=np.float64)[None, :] for x in (bloom_lon, bloom_lat, bloom_size))
+    distance = np.hypot(bloom_lon - usv_lon, bloom_lat - usv_lat)
+    battery = 1 + k_power * (1 - np.clip(usv_power, 0, 1))
+    costs = distance * battery - k_size * np.nan_to_num(bloom_size)
+    return np.where(np.isnan(costs), UNREACHABLE, costs)
+
+
+def assign(costs: np.ndarray):
+    """USV (rows) and bloom (columns) of every assignment of minimum total cost.
+
+    With more USVs than blooms some USVs get no bloom, and the other way round."""
+    if costs.size == 0:
+        return np.array([], dtype=int), np.array([], dtype=int)
+    return linear_sum_assignment(costs)
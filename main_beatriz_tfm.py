@@ -3,7 +3,7 @@
 from xdevs.models import Coupled
 from util.body import SimBody6
 from util.util import Generator
-from edge.sensor import SimSensor6, SensorEventId, SensorInfo
+from edge.sensor import SimSensor6, SimSensorBank, SensorEventId, SensorInfo
 from edge.usv import USV_Simple
 from fog.fog import FogServer
 from cloud.cloud import Cloud
@@ -14,7 +14,7 @@ import os
 class ModelBeatrizTFM(Coupled):
     """Clase que implementa un modelo de la pila IoT como entidad virtual."""
     
-    def __init__(self, name: str, commands_path: str, simbody: SimBody6, base_folder: str, log_Time=False, log_Data=False):
+    def __init__(self, name: str, commands_path: str, simbody: SimBody6, base_folder: str, log_Time=False, log_Data=False, sensor_bank=False, n_usv=1, seeds=None):
         """Función de inicialización."""
         super().__init__(name)
         # Simulation file
@@ -31,65 +31,60 @@ class ModelBeatrizTFM(Coupled):
         sensor_info_s = SensorInfo(id=SensorEventId.SUN, description="Sun radiation (n.u.)", delay=2, max=1.0, min=0, precision=0.01, noisebias=0.001, noisesigma=0.001)
         sensor_info_x = SensorInfo(id=SensorEventId.WFX, description="East wind flow (m/s)", delay=3, max=0.1, min=-0.1, precision=0.01, noisebias=0.001, noisesigma=0.001)
         sensor_info_y = SensorInfo(id=SensorEventId.WFY, description="Nord wind flow (m/s)", delay=3, max=0.1, min=-0.1, precision=0.01, noisebias=0.001, noisesigma=0.001)
-        sensor_n = SimSensor6("SimSenN", simbody, sensor_info_n, log_Time=log_Time, log_Data=log_Data)
-        sensor_o = SimSensor6("SimSenO", simbody, sensor_info_o, log_Time=log_Time, log_Data=log_Data)
-        sensor_a = SimSensor6("SimSenA", simbody, sensor_info_a, log_Time=log_Time, log_Data=log_Data)
-        sensor_t = SimSensor6("SimSenT", simbody, sensor_info_t, log_Time=log_Time, log_Data=log_Data)
-        sensor_u = SimSensor6("SimSenU", simbody, sensor_info_u, log_Time=log_Time, log_Data=log_Data)
-        sensor_v = SimSensor6("SimSenV", simbody, sensor_info_v, log_Time=log_Time, log_Data=log_Data)
-        sensor_s = SimSensor6("SimSenS", simbody, sensor_info_s, log_Time=log_Time, log_Data=log_Data)
-        sensor_x = SimSensor6("SimSenX", simbody, sensor_info_x, log_Time=log_Time, log_Data=log_Data)
-        sensor_y = SimSensor6("SimSenY", simbody, sensor_info_y, log_Time=log_Time, log_Data=log_Data)
+        sensors = {"SimSenN": sensor_info_n, "SimSenO": sensor_info_o, "SimSenA": sensor_info_a,
+                   "SimSenT": sensor_info_t, "SimSenU": sensor_info_u, "SimSenV": sensor_info_v,
+                   "SimSenS": sensor_info_s, "SimSenX": sensor_info_x, "SimSenY": sensor_info_y}
+        if sensor_bank:
+            # Un único modelo lee todas las variables del SimBody en cada posición
+            bank = SimSensorBank("SimSensors", simbody, sensors, log_Time=log_Time, log_Data=log_Data)
+            sensor_s = bank
+        else:
+            sim_sensors = {name: SimSensor6(name, simbody, info, log_Time=log_Time, log_Data=log_Data)
+                           for name, info in sensors.items()}
+            sensor_s = sim_sensors["SimSenS"]
 
-        thing_names = [sensor_n.name, sensor_o.name, sensor_a.name, sensor_t.name, sensor_u.name,
-                       sensor_v.name, sensor_s.name, sensor_x.name, sensor_y.name]
-        thing_event_ids = [sensor_info_n.id.value, sensor_info_o.id.value, sensor_info_a.id.value,
-                           sensor_info_t.id.value, sensor_info_u.id.value, sensor_info_v.id.value,
-                           sensor_info_s.id.value, sensor_info_x.id.value, sensor_info_y.id.value]
+        thing_names = list(sensors.keys())
+        thing_event_ids = [info.id.value for info in sensors.values()]
          
         # Se crea la clase provisionar del barco
-        usv1 = USV_Simple("USV_1",'./dataedge/', simbody, delay=0, log_Time=log_Time, log_Data=log_Data)
+        # (n_usv > 1: flota de barcos; sólo el primero lleva los sensores y el resto
+        # empieza repartido por las celdas 0..199 del mapa)
+        usvs = [USV_Simple("USV_" + str(i + 1),'./dataedge/', simbody, delay=0, log_Time=log_Time, log_Data=log_Data,
+                           start_cell=None if i == 0 else i * 200 // n_usv)
+                for i in range(n_usv)]
+        usv1 = usvs[0]
         
-        # Capa fog
-        fog = FogServer("FogServer", usv1.name, thing_names, thing_event_ids, sensor_s, base_folder=base_folder, log_Time=log_Time, log_Data=log_Data)
+        # Capa fog (seeds: modo ensemble del Inference_Service)
+        fog = FogServer("FogServer", [usv.name for usv in usvs], thing_names, thing_event_ids, sensor_s, base_folder=base_folder, log_Time=log_Time, log_Data=log_Data,
+                        simbody=simbody, seeds=seeds)
                 
         # Components:
         self.add_component(generator)
-        self.add_component(sensor_n)
-        self.add_component(sensor_o)
-        self.add_component(sensor_a)
-        self.add_component(sensor_t)
-        self.add_component(sensor_u)
-        self.add_component(sensor_v)
-        self.add_component(sensor_s)
-        self.add_component(sensor_x)
-        self.add_component(sensor_y)
-        self.add_component(usv1)
+        for usv in usvs:
+            self.add_component(usv)
         self.add_component(fog)
         # Coupling relations:
         self.add_coupling(generator.o_cmd, fog.i_cmd)
-        self.add_coupling(generator.o_cmd, usv1.i_cmd)
-        self.add_coupling(usv1.o_sensor, sensor_n.i_in)
-        self.add_coupling(usv1.o_sensor, sensor_o.i_in)
-        self.add_coupling(usv1.o_sensor, sensor_a.i_in)
-        self.add_coupling(usv1.o_sensor, sensor_t.i_in)
-        self.add_coupling(usv1.o_sensor, sensor_u.i_in)
-        self.add_coupling(usv1.o_sensor, sensor_v.i_in)
-        self.add_coupling(usv1.o_sensor, sensor_x.i_in)
-        self.add_coupling(usv1.o_sensor, sensor_y.i_in)
-        self.add_coupling(fog.o_sensor, sensor_s.i_in)
-        self.add_coupling(usv1.o_out,  fog.get_in_port("i_" + usv1.name))
-        #self.add_coupling(usv1.o_info, fog.get_in_port("i_" + usv1.name))
-        self.add_coupling(sensor_n.o_out, fog.get_in_port("i_" + sensor_n.name))
-        self.add_coupling(sensor_o.o_out, fog.get_in_port("i_" + sensor_o.name))
-        self.add_coupling(sensor_a.o_out, fog.get_in_port("i_" + sensor_a.name))
-        self.add_coupling(sensor_t.o_out, fog.get_in_port("i_" + sensor_t.name))
-        self.add_coupling(sensor_u.o_out, fog.get_in_port("i_" + sensor_u.name))
-        self.add_coupling(sensor_v.o_out, fog.get_in_port("i_" + sensor_v.name))
-        self.add_coupling(sensor_s.o_out, fog.get_in_port("i_" + sensor_s.name))
-        self.add_coupling(sensor_x.o_out, fog.get_in_port("i_" + sensor_x.name))
-        self.add_coupling(sensor_y.o_out, fog.get_in_port("i_" + sensor_y.name))
-        self.add_coupling(fog.get_out_port("o_" + usv1.name), usv1.i_in)
+        for usv in usvs:
+            self.add_coupling(generator.o_cmd, usv.i_cmd)
+        if sensor_bank:
+            self.add_component(bank)
+            self.add_coupling(usv1.o_sensor, bank.i_in)
+            self.add_coupling(fog.o_sensor, bank.i_in)
+            for name in sensors:
+                self.add_coupling(bank.get_out_port("o_" + name), fog.get_in_port("i_" + name))
+        else:
+            for name, sensor in sim_sensors.items():
+                self.add_component(sensor)
+                if name == "SimSenS":
+                    self.add_coupling(fog.o_sensor, sensor.i_in)
+                else:
+                    self.add_coupling(usv1.o_sensor, sensor.i_in)
+                self.add_coupling(sensor.o_out, fog.get_in_port("i_" + name))
+        for usv in usvs:
+            self.add_coupling(usv.o_out,  fog.get_in_port("i_" + usv.name))
+            #self.add_coupling(usv.o_info, fog.get_in_port("i_" + usv.name))
+            self.add_coupling(fog.get_out_port("o_" + usv.name), usv.i_in)
 
 
         # Capa Cloud:
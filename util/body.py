@@ -3,17 +3,420 @@ import netCDF4
 import numpy as np
 from scipy.interpolate import griddata
 from scipy.spatial import KDTree
+from collections import OrderedDict
+from time import perf_counter
+import json
+import os
+import pickle
+import warnings
+from multiprocessing import shared_memory, resource_tracker
 #from math import floor
 
 #from site import addsitedir   #Para añadir la ruta del proyecto
 #addsitedir("C:/Users/segu2/OneDrive - Universidad Complutense de Madrid (UCM)/devs-bloom") 
 
+class VarCache:
+    '''In-memory cache of the variables of a NetHFC4 body.
+    Each variable is loaded once as a contiguous float32 array with the fill values
+    already masked to NaN (for ALG only the second algae is kept). The least recently
+    used variables are released when the cache grows over maxbytes.'''
+
+    def __init__(self, simbody, maxbytes, myvars=()):
+        self.simbody=simbody                    #netCDF4.Dataset of the body
+        self.maxbytes=maxbytes                  #Max size of the cached arrays (bytes)
+        self.nbytes=0
+        self.vars=OrderedDict()
+        for myvar in myvars:
+            self.get(myvar)
+
+    def get(self,myvar):
+        #Cached array of myvar, or None when the variable does not fit in the cache
+        data=self.vars.get(myvar)
+        if data is not None:
+            self.vars.move_to_end(myvar)
+            return data
+        var=self.simbody[myvar]
+        shape=var.shape[:1]+var.shape[2:] if myvar=='ALG' else var.shape
+        size=int(np.prod(shape))*np.dtype(np.float32).itemsize
+        if size>self.maxbytes:
+            return None
+        while self.nbytes+size>self.maxbytes:
+            _,old=self.vars.popitem(last=False)
+            self.nbytes-=old.nbytes
+        data=var[:,1] if myvar=='ALG' else var[:]
+        data=np.ascontiguousarray(np.ma.filled(np.ma.asarray(data,dtype=np.float32),np.nan))
+        self.vars[myvar]=data
+        self.nbytes+=data.nbytes
+        return data
+
+
+class ChunkCache:
+    '''On-disk cache of the variables of a NetHFC4 body, split in time chunks.
+    The first time a chunk of a variable is needed it is converted from the netCDF file
+    into a float32 .npy file (fill values as NaN, second algae for ALG) inside cachedir.
+    Chunks are then opened with np.memmap, so only the time slabs that are touched are
+    mapped. At most maxchunks chunks are kept open.'''
+
+    def __init__(self, simbody, bodyfile, cachedir=None, chunksteps=48, maxchunks=64):
+        self.simbody=simbody                    #netCDF4.Dataset of the body
+        self.cachedir=cachedir if cachedir is not None else bodyfile+'.chunks'
+        self.chunksteps=chunksteps              #Time steps per chunk
+        self.maxchunks=maxchunks                #Max open (mapped) chunks
+        self.chunks=OrderedDict()
+        self.vars={}
+        os.makedirs(self.cachedir,exist_ok=True)
+        #The cache is rebuilt if the body file or the chunk size change
+        stat=os.stat(bodyfile)
+        meta={'size':stat.st_size,'mtime':stat.st_mtime,'chunksteps':chunksteps}
+        metafile=os.path.join(self.cachedir,'meta.json')
+        if not os.path.exists(metafile) or json.load(open(metafile))!=meta:
+            for f in os.listdir(self.cachedir):
+                if f.endswith('.npy'):
+                    os.remove(os.path.join(self.cachedir,f))
+            with open(metafile,'w') as f:
+                json.dump(meta,f)
+
+    def get(self,myvar):
+        #Chunked view of myvar, indexed as the full (TIME,...) array
+        if myvar not in self.vars:
+            self.vars[myvar]=ChunkedVar(self,myvar)
+        return self.vars[myvar]
+
+    def chunk(self,myvar,c):
+        #Mapped chunk c of myvar (converted from the netCDF file if needed)
+        key=(myvar,c)
+        data=self.chunks.get(key)
+        if data is not None:
+            self.chunks.move_to_end(key)
+            return data
+        chunkfile=os.path.join(self.cachedir,'%s.%05d.npy' %(myvar,c))
+        if not os.path.exists(chunkfile):
+            ts=slice(c*self.chunksteps,(c+1)*self.chunksteps)
+            var=self.simbody[myvar]
+            data=var[ts,1] if myvar=='ALG' else var[ts]
+            data=np.ma.filled(np.ma.asarray(data,dtype=np.float32),np.nan)
+            tmpfile=chunkfile+'.tmp.npy'
+            np.save(tmpfile,data)
+            os.replace(tmpfile,chunkfile)
+        data=np.load(chunkfile,mmap_mode='r')
+        self.chunks[key]=data
+        if len(self.chunks)>self.maxchunks:
+            self.chunks.popitem(last=False)
+        return data
+
+
+class StoreCache:
+    '''Variables of a body store built by util/body_prep.py.
+    Each variable is a float32 .npy file laid out (CELL,TIME,KC) so the time series of a
+    cell are contiguous. They are opened with np.memmap and returned as (TIME,KC,CELL) views,
+    so they are indexed as the netCDF variables. Variables not in the store return None.'''
+
+    def __init__(self, storedir, myvars):
+        self.storedir=storedir
+        self.vars=set(myvars)                   #Variables in the store
+        self.data={}
+
+    def get(self,myvar):
+        if myvar not in self.vars:
+            return None
+        data=self.data.get(myvar)
+        if data is None:
+            data=np.load(os.path.join(self.storedir,myvar+'.npy'),mmap_mode='r')
+            data=np.moveaxis(data,0,-1)         #(CELL,TIME,KC) -> (TIME,KC,CELL)
+            self.data[myvar]=data
+        return data
+
+
+#Variables read by the sensors of ModelBeatrizTFM
+STOREVARS=('NOX','DOX','ALG','temperature','U','V','sun','wind_x','wind_y')
+#Geometry arrays of a body store (SimBody6 attributes)
+STOREARRAYS=('latc','lonc','lat','lon','nv','time','belv','wsel','layers','blayer','sigma','sigmatab')
+
+
+def storepath(bodyfile):
+    '''Folder of the store of bodyfile (see util/body_prep.py).'''
+    return bodyfile+'.store'
+
+
+def storemeta(bodyfile):
+    '''Metadata of the store of bodyfile, or None if there is no store or it is out of date.'''
+    metafile=os.path.join(storepath(bodyfile),'meta.json')
+    if not os.path.exists(metafile):
+        return None
+    with open(metafile) as f:
+        meta=json.load(f)
+    stat=os.stat(bodyfile)
+    if meta.get('size')!=stat.st_size or meta.get('mtime')!=stat.st_mtime:
+        return None
+    return meta
+
+
+class SharedBody:
+    '''Handle of a SimBody6 published in shared memory (SimBody6.share).
+    It only holds the names, shapes and dtypes of the shared blocks and the scalars of
+    the body, so it can be pickled to the workers, which call SimBody6.attach(handle) to get
+    a body with read-only views of the same arrays. The publisher must keep the handle
+    until the workers end and then call unlink().'''
+
+    def __init__(self, name, bodyfile, attrs):
+        self.name=name
+        self.bodyfile=bodyfile
+        self.attrs=attrs                        #Scalars of the body (dtini, dtend, T, ...)
+        self.arrays={}                          #{array: (block name, shape, dtype)}
+        self.myvars=[]                          #Shared variables (TIME,KC,CELL)
+        self.blocks=[]                          #Blocks of the publisher (not pickled)
+
+    def create(self,key,shape,dtype):
+        #New shared block for the array key, returned as a writable view
+        dtype=np.dtype(dtype)
+        shm=shared_memory.SharedMemory(create=True,size=max(int(np.prod(shape))*dtype.itemsize,1))
+        self.blocks.append(shm)
+        self.arrays[key]=(shm.name,tuple(shape),dtype.str)
+        return np.ndarray(shape,dtype=dtype,buffer=shm.buf)
+
+    def publish(self,key,data):
+        #Copy data into a new shared block
+        data=np.asarray(data)
+        self.create(key,data.shape,data.dtype)[...]=data
+
+    def views(self):
+        '''Attach the blocks and return the blocks and the read-only views {array: ndarray}.'''
+        blocks=[]
+        views={}
+        for key,(shmname,shape,dtype) in self.arrays.items():
+            shm=attachblock(shmname)
+            blocks.append(shm)
+            views[key]=np.ndarray(shape,dtype=dtype,buffer=shm.buf)
+            views[key].flags.writeable=False
+        return blocks,views
+
+    def unlink(self):
+        '''Release the shared blocks (publisher only).'''
+        for shm in self.blocks:
+            shm.close()
+            #A worker of the same resource tracker may have unregistered the block (attachblock)
+            resource_tracker.register(shm._name,'shared_memory')
+            shm.unlink()
+        self.blocks=[]
+
+    def __getstate__(self):
+        state=self.__dict__.copy()
+        state['blocks']=[]
+        return state
+
+
+def attachblock(shmname):
+    '''Attach a shared memory block without tracking it in this process.
+    Otherwise the resource tracker of a worker unlinks the block when the worker ends.'''
+    try:
+        return shared_memory.SharedMemory(name=shmname,track=False)    #Python>=3.13
+    except TypeError:
+        shm=shared_memory.SharedMemory(name=shmname)
+        resource_tracker.unregister(shm._name,'shared_memory')
+        return shm
+
+
+class SharedCache:
+    '''Variables of a SimBody6 attached to a SharedBody (read-only (TIME,KC,CELL) views).'''
+
+    def __init__(self, views):
+        self.vars=views                         #{var: ndarray}
+
+    def get(self,myvar):
+        return self.vars.get(myvar)
+
+
+class ChunkedVar:
+    '''A variable of a ChunkCache. Indexing maps only the chunks of the requested times.'''
+
+    def __init__(self, cache, myvar):
+        self.cache=cache
+        self.myvar=myvar
+        var=cache.simbody[myvar]
+        self.shape=var.shape[:1]+var.shape[2:] if myvar=='ALG' else var.shape
+
+    def __getitem__(self,index):
+        index=index if isinstance(index,tuple) else (index,)
+        n=self.cache.chunksteps
+        t=np.asarray(index[0])
+        if t.ndim==0:
+            c,k=divmod(int(t),n)
+            return self.cache.chunk(self.myvar,c)[(k,)+index[1:]]
+        #Array of times: the other indices are arrays (or ints) broadcast with them
+        index=np.broadcast_arrays(*index)
+        c,k=np.divmod(index[0],n)
+        out=np.empty(index[0].shape+self.shape[len(index):],dtype=np.float32)
+        for cu in np.unique(c):
+            m=c==cu
+            out[m]=self.cache.chunk(self.myvar,int(cu))[(k[m],)+tuple(i[m] for i in index[1:])]
+        return out
+
+
+class FileVar:
+    '''Body attribute read from the netCDF file the first time it is used.'''
+
+    def __init__(self, varname):
+        self.varname=varname
+
+    def __set_name__(self, owner, name):
+        self.name=name
+
+    def __get__(self, body, owner=None):
+        if body is None:
+            return self
+        data=np.array(body.simbody[self.varname])
+        body.__dict__[self.name]=data
+        return data
+
+
+def layertable(sigma,blayer,layers):
+    '''Sigma table (CELL,KC) of the active layers of each cell, NaN for inactive layers.
+    The depth of layer l in cell ij is depthrange-sigmatab[ij,l]*depthrange.'''
+    kc=np.arange(sigma.shape[1])
+    active=(kc>=blayer[:,None]-1) & (kc<blayer[:,None]+layers[:,None]-1)
+    return np.where(active,sigma,np.nan).astype(sigma.dtype)
+
+
+def nearestlayer(sigmatab,ij,depthrange,mydepth):
+    '''Nearest active layer to mydepth in cells ij with water column depthrange.
+    ij, depthrange and mydepth are scalars or arrays of the same shape. It returns -1
+    for the cells without active layers.'''
+    depthrange=np.asarray(depthrange)[...,None]
+    return nearestdepth(depthrange-sigmatab[ij]*depthrange,mydepth)
+
+
+def nearestdepth(depth,mydepth):
+    '''Index of the nearest layer to mydepth in the layer depths depth (...,KC) (NaN for
+    inactive layers). It returns -1 when there are no active layers.'''
+    dist=np.absolute(depth-np.asarray(mydepth)[...,None])
+    dist=np.where(np.isnan(dist),np.inf,dist)
+    l=np.argmin(dist,axis=-1)
+    return np.where(np.isinf(np.min(dist,axis=-1)),-1,l)
+
+
+def blend(vals,w,axis):
+    '''Weighted sum of vals along axis; the terms of weight 0 are left out, so a
+    missing (NaN) value with no weight does not turn the result into NaN.'''
+    w=np.broadcast_to(w,np.shape(vals))
+    return np.sum(np.where(w>0,vals,0)*w,axis=axis)
+
+
+def idwweights(dd):
+    '''Normalized inverse distance weights of the neighbour distances dd (...,K).
+    A neighbour at distance 0 takes all the weight (no division by zero).'''
+    dd=np.asarray(dd,dtype=float)
+    zero=dd==0
+    with np.errstate(divide='ignore'):
+        w=np.where(zero.any(axis=-1,keepdims=True),zero,1/dd)
+    return w/np.sum(w,axis=-1,keepdims=True)
+
+
+class TimeIndex:
+    '''Time index service of a body: nearest time step of the (increasing) time vector.
+    On a regular grid the step is found with arithmetic, otherwise with a bisection
+    (np.searchsorted). As the simulation time only moves forward, the last step found is
+    kept as a cursor and checked first. Ties are resolved to the lower index, as np.argmin.'''
+
+    def __init__(self, time, rtol=1e-6):
+        self.time=np.asarray(time,dtype=float)  #Time vector (any unit)
+        self.n=len(self.time)
+        self.t0=self.time[0]
+        self.T=self.time[1]-self.time[0] if self.n>1 else 0.0   #Period
+        self.regular=self.n>1 and bool(np.allclose(np.diff(self.time),self.T,rtol=rtol,atol=0))
+        self.cursor=0                           #Last step [cursor,cursor+1] found
+
+    def step(self,mytime):
+        #Index i of the step time[i]<=mytime<time[i+1] (clipped to [0,n-2])
+        if self.regular:
+            k=(mytime-self.t0)//self.T
+            return min(max(int(k),0),self.n-2) if k==k else 0    #NaN time as np.argmin
+        i=self.cursor
+        if self.time[i]<=mytime<self.time[i+1]:
+            return i
+        if i+2<self.n and self.time[i+1]<=mytime<self.time[i+2]:  #Next step (forward-only case)
+            i+=1
+        else:
+            i=min(max(int(np.searchsorted(self.time,mytime,side='right'))-1,0),self.n-2)
+        self.cursor=i
+        return i
+
+    def nearest(self,mytime):
+        '''Index of the nearest time to mytime.'''
+        if self.n==1:
+            return 0
+        i=self.step(mytime)
+        return i if mytime-self.time[i]<=self.time[i+1]-mytime else i+1
+
+    def next(self,mytime):
+        '''Index of the first time >= mytime (the last one after the end).'''
+        if self.n==1:
+            return 0
+        i=self.step(mytime)
+        return i if self.time[i]>=mytime else i+1
+
+    def nearest_many(self,mytimes):
+        '''Index of the nearest time for each time in mytimes.'''
+        mytimes=np.asarray(mytimes,dtype=float)
+        if self.n==1:
+            return np.zeros(mytimes.shape,dtype=int)
+        if self.regular:
+            i=np.clip(np.nan_to_num(np.floor((mytimes-self.t0)/self.T)),0,self.n-2).astype(int)
+        else:
+            i=np.clip(np.searchsorted(self.time,mytimes,side='right')-1,0,self.n-2)
+        before=(mytimes-self.time[i])<=(self.time[i+1]-mytimes)
+        return np.where(before,i,i+1)
+
+
+class NeighbourCache:
+    '''LRU memo of the spatial lookup of a body around (lon,lat) positions.
+    Positions are quantized to quantum degrees, so the sensors that read the body at
+    the same place share one KDTree query. Each entry keeps the k nearest cells, their
+    distances and IDW weights, and the layer depths of the nearest cell for the last
+    time step it was used at. hits and misses count the lookups.'''
+
+    def __init__(self, tree, maxsize=1024, quantum=1e-6, k=4):
+        self.tree=tree                          #KDTree of the cells (lon,lat)
+        self.maxsize=maxsize                    #Max number of positions
+        self.quantum=quantum                    #Position resolution (deg)
+        self.k=k                                #Nearest cells
+        self.entries=OrderedDict()
+        self.hits=0
+        self.misses=0
+
+    def get(self,lon,lat):
+        key=(round(lon/self.quantum),round(lat/self.quantum))
+        entry=self.entries.get(key)
+        if entry is not None:
+            self.hits+=1
+            self.entries.move_to_end(key)
+            return entry
+        self.misses+=1
+        dd,ij=self.tree.query([lon,lat],self.k)
+        entry=Neighbours(dd,ij,idwweights(dd))
+        self.entries[key]=entry
+        if len(self.entries)>self.maxsize:
+            self.entries.popitem(last=False)
+        return entry
+
+
+class Neighbours:
+    '''Entry of a NeighbourCache: nearest cells of a position and depth profile at time t.'''
+
+    def __init__(self, dd, ij, w):
+        self.dd=dd                              #Distances (deg)
+        self.ij=ij                              #Cell indices
+        self.w=w                                #IDW weights
+        self.t=None                             #Time index of the depth profile
+        self.depthrange=np.nan                  #Water column of the nearest cell at t
+        self.depth=None                         #Layer depths of the nearest cell at t
+
+
 class SimBody5:
     '''Body Simulated in NetHFC4 with new UGRID format.
     It allow to read simulated data at t,lat,lon,depth (t are seconds from init of BodySim)
     It returns the value and the index used to find the value on the file'''
 
-    def __init__(self, name, bodyfile,log=False):       
+    def __init__(self, name, bodyfile,log=False,cachevars=(),cachebytes=0):       
         #Load the file and prpair the time vector [0..end] seconds 
         self.name=name
         self.simbody   = netCDF4.Dataset(bodyfile)    
@@ -32,6 +435,7 @@ class SimBody5:
         self.cuv       = np.array(self.simbody['CUV'])
         self.blayer    = np.array(self.simbody['bottom_layer']) # int8 bottom_layer(CELL)
         self.sigma     = np.array(self.simbody['sigma'])        # float32 sigma(CELL, KC)
+        self.sigmatab  = layertable(self.sigma,self.blayer,self.layers)  # float32 sigma of active layers(CELL, KC)
         self.sun       = np.array(self.simbody['sun'])
         self.u         = np.array(self.simbody['U'])            # Velocidad del agua este(m/s)
         self.v         = np.array(self.simbody['V'])            # Velocidad del agua norte(m/s) 
@@ -46,6 +450,9 @@ class SimBody5:
         self.dtend=refdate+dt.timedelta(seconds=self.time[-1]*24*3600)
         self.T=(self.time[1]-self.time[0])*24*3600      #Period
         self.time=(self.time-self.time[0])*24*3600      #Time in seconds from [0..end]. 
+        self.timeindex=TimeIndex(self.time)             #Nearest time index service
+        #Variables cache (cachebytes=0 reads every value from the file)
+        self.cache=VarCache(self.simbody,cachebytes,cachevars) if cachebytes>0 else None
         if log==True:
             print('BodySim IniDateTime:',self.dtini)
             print('BodySim EndDateTime:',self.dtend)
@@ -54,6 +461,14 @@ class SimBody5:
     def __exit__(self):       
         self.simbody.close()
 
+    def _read(self,myvar,t,*index):
+        #Read myvar[t,*index] from the cache or the file. ALG is the second algae. Fill values are NaN
+        data=self.cache.get(myvar) if self.cache is not None else None
+        if data is None:
+            data=self.simbody[myvar][(t,1)+index] if myvar=='ALG' else self.simbody[myvar][(t,)+index]
+            return np.ma.filled(np.ma.asarray(data,dtype=float),np.nan)
+        return data[(t,)+index]
+
     def readvar(self,myvar,mytime,mylat=np.nan,mylon=np.nan,mydepth=np.nan):
         #To read a value of myvar
         # myvar='DOX'variable del fichero.nc
@@ -88,31 +503,23 @@ class SimBody5:
         ij=np.nan
         l=np.nan
         mytime=mytime
-        t=round(np.argmin(np.absolute(self.time-mytime)))       #Nearest time index
+        t=self.timeindex.nearest(mytime)                        #Nearest time index
         if np.absolute(self.time[t]-mytime)<=self.T*1.1:        #Time resolution 30m*60s*1.1
             if np.isnan(mylat):
-                value=float(self.simbody[myvar][t].data) 
+                value=float(self._read(myvar,t))
                 return value,t,np.nan,np.nan                    #Return Value and time index
             else:
                 dd,ij=self.lonlattree.query([mylon,mylat])
                 if dd<0.003:                                    #Spatial resolution < 0.003deg
                     #i,j=np.unravel_index(ii,(len(self.bottom),len(self.bottom[0])))
                     if np.isnan(mydepth):
-                        value=float(self.simbody[myvar][t,ij].data)    
+                        value=float(self._read(myvar,t,ij))
                         return value,t,ij,np.nan
                     else:
                         depthrange=self.wsel[t,ij] - self.belv[ij][0]
-                        if mydepth<=depthrange:                     #Depth over Bottom? 
-                            depth=np.nan*np.array(self.sigma[ij])
-                            for ly in range(self.blayer[ij]-1,self.blayer[ij]+self.layers[ij]-1):
-                                #depth[ly]=self.sigma[ij,ly]*depthrange
-                                depth[ly]= depthrange-self.sigma[ij,ly]*depthrange
-                            l =round(np.nanargmin(np.absolute(depth-mydepth),0),0)  #Nearest Depth Layer index
-                            if myvar=='ALG':
-                                value=float(self.simbody[myvar][t,1,l,ij].data)     #Read the second algae
-                            else:
-                                value=float(self.simbody[myvar][t,l,ij].data)       #Read the value              
-                            if value==self.simbody[myvar]._FillValue: value=np.nan
+                        l=int(nearestlayer(self.sigmatab,ij,depthrange,mydepth))   #Nearest Depth Layer index
+                        if mydepth<=depthrange and l>=0:            #Depth over Bottom? 
+                            value=float(self._read(myvar,t,l,ij))  #Read the value (second algae for ALG)
                             #if value==0.0: value=np.nan
                             return value,t,ij,l             #Value of var, time index, lonlat index,layer index
                         else: 
@@ -126,12 +533,62 @@ class SimBody5:
 class SimBody6:
     '''Body Simulated in NetHFC4 with new UGRID format.
     It reads an interpolated data at t,lat,lon,depth (t are seconds from init of BodySim)
-    It use the 4 nearest (lat,lon) values to interpolate the returned value'''
+    It use the 4 nearest (lat,lon) values to interpolate the returned value
+    The values are read from the file, from a VarCache (cachebytes>0) or from a
+    ChunkCache of memory-mapped time chunks (chunkdir)
+    If the body has an up to date store (util/body_prep.py) the geometry, the KDTree and
+    the stored variables are loaded from it (store=False to ignore it)
+    Precedence of the variables: chunkdir, then the store, then the VarCache, so
+    cachevars/cachebytes are ignored (with a warning) when chunkdir or a store is used
+    share() publishes the body in shared memory for the workers, that use attach(handle)
+    With interp=True the values are interpolated in time and depth too (see readvar_interp)
+    The nearest cells of the last nncache positions are kept in a NeighbourCache'''
+    temp           = FileVar('temperature')
+    rssbc          = FileVar('RSSBC')
+    cuv            = FileVar('CUV')
+    sun            = FileVar('sun')
+    u              = FileVar('U')                           # Velocidad del agua este(m/s)
+    v              = FileVar('V')                           # Velocidad del agua norte(m/s)
+    w              = FileVar('W')                           # Velocidad del agua arriba(m/s)
 
-    def __init__(self, name, bodyfile,log=False):       
+    def __init__(self, name, bodyfile,log=False,cachevars=(),cachebytes=0,chunkdir=None,chunksteps=48,interp=False,nncache=1024,store=True):       
         #Load the file and prepair the time vector [0..end] seconds 
         self.name=name
+        self.bodyfile=bodyfile
+        self.interp=interp
         self.simbody   = netCDF4.Dataset(bodyfile)    
+        #Geometry from the store of the body (util/body_prep.py) if it is up to date
+        meta=storemeta(bodyfile) if store else None
+        if meta is not None:
+            self._setup_store(storepath(bodyfile),meta)
+        else:
+            self._setup_file()
+        self.neighbours = NeighbourCache(self.lonlattree,nncache)
+        #Copute Ini/End DateTime
+        refdate=dt.datetime.fromisoformat(self.units[-19:])
+        self.dtini=refdate+dt.timedelta(seconds=self.time[0]*24*3600)
+        self.dtend=refdate+dt.timedelta(seconds=self.time[-1]*24*3600)
+        self.T=(self.time[1]-self.time[0])*24*3600      #Period
+        self.time=(self.time-self.time[0])*24*3600      #Time in seconds from [0..end]. 
+        self.timeindex=TimeIndex(self.time)             #Nearest time index service
+        #Variables cache (cachebytes=0 reads every value from the file or the store)
+        if chunkdir is not None:
+            self.cache=ChunkCache(self.simbody,bodyfile,chunkdir,chunksteps)
+        elif meta is not None:
+            self.cache=StoreCache(storepath(bodyfile),meta['vars'])
+        else:
+            self.cache=VarCache(self.simbody,cachebytes,cachevars) if cachebytes>0 else None
+        if cachebytes>0 and not isinstance(self.cache,VarCache):
+            warnings.warn('SimBody6: cachevars/cachebytes ignored, the variables are read from the '+
+                          ('chunks of chunkdir' if chunkdir is not None else 'store (store=False to use the VarCache)'))
+        if log==True:
+            print('BodySim Store:',meta is not None)
+            print('BodySim IniDateTime:',self.dtini)
+            print('BodySim EndDateTime:',self.dtend)
+            print('BodySim DeltaTime(min)',self.T/60)
+
+    def _setup_file(self):
+        #Geometry and KDTree from the netCDF file
         self.latc      = np.array(self.simbody['latc'])         # float32 latc(CELL)
         self.lonc      = np.array(self.simbody['lonc'])         # float32 lonc(CELL)
         self.lat       = np.array(self.simbody['lat'])          # float32 lat(CELL)
@@ -139,36 +596,75 @@ class SimBody6:
         self.nv        = np.array(self.simbody['nv'])           # float32 nv(CELL)
         self.time      = np.array(self.simbody['time'])         # float64 time(TIME), Dias desde 20050101
         #self.time      = np.moveaxis(self.time, 0 ,-1)
+        self.units     = self.simbody['time'].units
         self.belv      = np.array(self.simbody['BELV'])         # float32 BELV(TIME, CELL), 
         self.wsel      = np.array(self.simbody['WSEL'])         # float32 WSEL(TIME, CELL), 
         self.layers    = np.array(self.simbody['layers'])       # int8 layers(CELL)
-        self.temp      = np.array(self.simbody['temperature'])
-        self.rssbc     = np.array(self.simbody['RSSBC'])
-        self.cuv       = np.array(self.simbody['CUV'])
         self.blayer    = np.array(self.simbody['bottom_layer']) # int8 bottom_layer(CELL)
         self.sigma     = np.array(self.simbody['sigma'])        # float32 sigma(CELL, KC)
-        self.sun       = np.array(self.simbody['sun'])
-        self.u         = np.array(self.simbody['U'])            # Velocidad del agua este(m/s)
-        self.v         = np.array(self.simbody['V'])            # Velocidad del agua norte(m/s) 
-        self.w         = np.array(self.simbody['W'])            # Velocidad del agua arriba(m/s)        
+        self.sigmatab  = layertable(self.sigma,self.blayer,self.layers)  # float32 sigma of active layers(CELL, KC)
         #Prepare KDtree
         llc = np.c_[self.lonc.ravel(), self.latc.ravel()] 
         self.lonlattree = KDTree(llc)
-        #Copute Ini/End DateTime
-        refstr=self.simbody['time'].units
-        refdate=dt.datetime.fromisoformat(refstr[-19:])
-        self.dtini=refdate+dt.timedelta(seconds=self.time[0]*24*3600)
-        self.dtend=refdate+dt.timedelta(seconds=self.time[-1]*24*3600)
-        self.T=(self.time[1]-self.time[0])*24*3600      #Period
-        self.time=(self.time-self.time[0])*24*3600      #Time in seconds from [0..end]. 
-        if log==True:
-            print('BodySim IniDateTime:',self.dtini)
-            print('BodySim EndDateTime:',self.dtend)
-            print('BodySim DeltaTime(min)',self.T/60)
+
+    def _setup_store(self,storedir,meta):
+        #Geometry (memory-mapped) and KDTree from the store
+        for attr in STOREARRAYS:
+            setattr(self,attr,np.load(os.path.join(storedir,attr+'.npy'),mmap_mode='r'))
+        self.time      = np.array(self.time)
+        self.units     = meta['units']
+        with open(os.path.join(storedir,'kdtree.pkl'),'rb') as f:
+            self.lonlattree = pickle.load(f)
+
+    def share(self,myvars=STOREVARS,chunksteps=48):
+        '''Publish the geometry and the variables myvars (float32, fill values as NaN, second
+        algae for ALG) in shared memory. It returns the SharedBody handle for SimBody6.attach.'''
+        attrs={'interp':self.interp,'units':self.units,'dtini':self.dtini,'dtend':self.dtend,'T':self.T}
+        handle=SharedBody(self.name,self.bodyfile,attrs)
+        for attr in STOREARRAYS:
+            handle.publish(attr,getattr(self,attr))
+        #KDTree pickled once, so the workers do not rebuild it
+        handle.publish('lonlattree',np.frombuffer(pickle.dumps(self.lonlattree,protocol=pickle.HIGHEST_PROTOCOL),dtype=np.uint8))
+        for myvar in myvars:
+            var=self.simbody[myvar]
+            shape=var.shape[:1]+var.shape[2:] if myvar=='ALG' else var.shape
+            data=handle.create(myvar,shape,np.float32)
+            for t0 in range(0,shape[0],chunksteps):         #Copied by time chunks
+                ts=slice(t0,t0+chunksteps)
+                chunk=var[ts,1] if myvar=='ALG' else var[ts]
+                data[ts]=np.ma.filled(np.ma.asarray(chunk,dtype=np.float32),np.nan)
+            handle.myvars.append(myvar)
+        return handle
+
+    @classmethod
+    def attach(cls,handle,nncache=1024):
+        '''Body with read-only views of a SimBody6 published with share().
+        The variables not shared are read from the netCDF file.'''
+        self=cls.__new__(cls)
+        self.name=handle.name
+        self.bodyfile=handle.bodyfile
+        self.simbody=netCDF4.Dataset(handle.bodyfile)
+        self.__dict__.update(handle.attrs)
+        self.blocks,views=handle.views()                #Blocks kept open with the body
+        for attr in STOREARRAYS:
+            setattr(self,attr,views[attr])
+        self.lonlattree = pickle.loads(views['lonlattree'].tobytes())
+        self.neighbours = NeighbourCache(self.lonlattree,nncache)
+        self.timeindex=TimeIndex(self.time)
+        self.cache=SharedCache({myvar:views[myvar] for myvar in handle.myvars})
+        return self
       
     def __exit__(self):       
         self.simbody.close()
 
+    def _read(self,myvar,t,*index):
+        #Read myvar[t,*index] from the cache or the file. ALG is the second algae. Fill values are NaN
+        data=self.cache.get(myvar) if self.cache is not None else None
+        if data is None:
+            data=self.simbody[myvar][(t,1)+index] if myvar=='ALG' else self.simbody[myvar][(t,)+index]
+            return np.ma.filled(np.ma.asarray(data,dtype=float),np.nan)
+        return data[(t,)+index]
+
     def readvar(self,myvar,mytime,mylat=np.nan,mylon=np.nan,mydepth=np.nan):
         #To read a value of myvar
         # myvar='DOX'variable del fichero.nc
@@ -198,48 +694,227 @@ class SimBody6:
         # float32 SAA(TIME, KC, CELL), Sodio...
         # float32 COD(TIME, KC, CELL), Carbono organico
 
-        value=np.nan
-        t=np.nan
-        ij=np.nan
-        l=np.nan
-        mytime=mytime
-        t=round(np.argmin(np.absolute(self.time-mytime)))       #Nearest time index
+        values,t,ij,l=self.readvars((myvar,),mytime,mylat,mylon,mydepth)
+        return values[0],t,ij,l
+
+    def readvars(self,myvars,mytime,mylat=np.nan,mylon=np.nan,mydepth=np.nan):
+        '''Read several variables at the same time, position and depth.
+        The time step, the nearest cells and the layer are resolved once and every variable
+        in myvars is read at the same indices. It returns the list of values (NaN as in readvar)
+        and the time index, lonlat indices and layer index shared by all of them.'''
+        if self.interp:
+            reads=[self.readvar_interp(myvar,mytime,mylat,mylon,mydepth) for myvar in myvars]
+            _,t,ij,l=reads[0]
+            return [read[0][0] for read in reads],t[0],ij[0],l[0]
+        nans=[np.nan]*len(myvars)
+        t=self.timeindex.nearest(mytime)                        #Nearest time index
         if np.absolute(self.time[t]-mytime)<=self.T*1.1:        #Time resolution 30m*60s*1.1
             if np.isnan(mylat):
-                value=float(self.simbody[myvar][t].data) 
-                return value,t,np.nan,np.nan                    #Return Value and time index
+                values=[float(self._read(myvar,t)) for myvar in myvars]
+                return values,t,np.nan,np.nan                   #Return Values and time index
             else:
-                dd,ij=self.lonlattree.query([mylon,mylat],4)
+                nn=self.neighbours.get(mylon,mylat)             #4 nearest cells (shared by sensors)
+                dd,ij=nn.dd,nn.ij
                 if dd[0]<0.003:                                 #Spatial resolution < 0.003deg
                     #i,j=np.unravel_index(ii,(len(self.bottom),len(self.bottom[0])))
                     if np.isnan(mydepth):
-                        value=np.average(self.simbody[myvar][t,ij].data,weights=1/dd)    
+                        values=[np.sum(self._read(myvar,t,ij)*nn.w) for myvar in myvars]
                         #value=float(self.simbody[myvar][t,ij].data)    
-                        return value,t,ij,np.nan
+                        return values,t,ij,np.nan
                     else:
-                        depthrange=self.wsel[t,ij[0]] - self.belv[ij[0]][0]
-                        #depthrange=self.wsel[t,ij] - self.belv[ij][0]
-                        if mydepth<=depthrange:                     #Depth over Bottom? 
-                            depth=np.nan*np.array(self.sigma[ij[0]])
-                            for ly in range(self.blayer[ij[0]]-1,self.blayer[ij[0]]+self.layers[ij[0]]-1):
-                                #depth[ly]=self.sigma[ij,ly]*depthrange
-                                depth[ly]= depthrange-self.sigma[ij[0],ly]*depthrange
-                            l =round(np.nanargmin(np.absolute(depth-mydepth),0),0)  #Nearest Depth Layer index
-                            if myvar=='ALG':
-                                value=np.average(self.simbody[myvar][t,1,l,ij].data,weights=1/dd)     #Read the second algae
-                                #value=float(self.simbody[myvar][t,1,l,ij].data)     #Read the second algae
-                            else:
-                                value=np.average(self.simbody[myvar][t,l,ij].data,weights=1/dd)       #Read the value              
-                                #value=float(self.simbody[myvar][t,l,ij].data)       #Read the value              
-                            if value==self.simbody[myvar]._FillValue: value=np.nan
+                        if nn.t!=t:                             #Depth profile of the nearest cell at t
+                            nn.t=t
+                            nn.depthrange=self.wsel[t,ij[0]] - self.belv[ij[0]][0]
+                            nn.depth=nn.depthrange-self.sigmatab[ij[0]]*nn.depthrange
+                        depthrange=nn.depthrange
+                        l=int(nearestdepth(nn.depth,mydepth))   #Nearest Depth Layer index
+                        if mydepth<=depthrange and l>=0:            #Depth over Bottom? 
+                            values=[np.sum(self._read(myvar,t,l,ij)*nn.w) for myvar in myvars]  #Read the values (second algae for ALG)
                             #if value==0.0: value=np.nan
-                            return value,t,ij,l             #Value of var, time index, lonlat index,layer index
+                            return values,t,ij,l            #Values of vars, time index, lonlat index,layer index
                         else: 
-                            return np.nan,t,ij,np.nan
+                            return nans,t,ij,np.nan
                 else:
-                    return np.nan,t,np.nan,np.nan
-        else: 
-            return np.nan,np.nan,np.nan,np.nan
+                    return nans,t,np.nan,np.nan
+        else:
+            return nans,np.nan,np.nan,np.nan
+
+    def readvar_batch(self,myvar,mytimes,mylats=np.nan,mylons=np.nan,mydepths=np.nan):
+        '''Vectorized version of readvar for many queries of myvar at once.
+        mytimes, mylats, mylons and mydepths are broadcast to a common shape (N,).
+        It returns the arrays value(N), t(N), ij(N,4) and l(N). As in readvar, the
+        indices not resolved are NaN (ij is float for this reason).'''
+        if self.interp:
+            return self.readvar_interp(myvar,mytimes,mylats,mylons,mydepths)
+        mytimes,mylats,mylons,mydepths=np.broadcast_arrays(
+            np.atleast_1d(np.asarray(mytimes,dtype=float)),np.asarray(mylats,dtype=float),
+            np.asarray(mylons,dtype=float),np.asarray(mydepths,dtype=float))
+        n=len(mytimes)
+        value=np.full(n,np.nan)
+        t=np.full(n,np.nan)
+        ij=np.full((n,4),np.nan)
+        l=np.full(n,np.nan)
+        #Nearest time index
+        ti=self.timeindex.nearest_many(mytimes)
+        okt=np.absolute(self.time[ti]-mytimes)<=self.T*1.1          #Time resolution 30m*60s*1.1
+        t[okt]=ti[okt]
+        #Variables without position (sun)
+        sel=okt & np.isnan(mylats)
+        if sel.any():
+            value[sel]=self._gather(myvar,ti[sel])
+        #Spatial resolution < 0.003deg, 4 nearest cells for all the points
+        sel=okt & ~np.isnan(mylats)
+        if sel.any():
+            dd=np.full((n,4),np.inf)
+            ii=np.zeros((n,4),dtype=int)
+            dd[sel],ii[sel]=self.lonlattree.query(np.c_[mylons[sel],mylats[sel]],4)
+            sel=sel & (dd[:,0]<0.003)
+            ij[sel]=ii[sel]
+            #Variables without depth (wind)
+            sel2d=sel & np.isnan(mydepths)
+            if sel2d.any():
+                vals=self._gather(myvar,ti[sel2d],ij=ii[sel2d])
+                value[sel2d]=np.average(vals,axis=1,weights=idwweights(dd[sel2d]))
+            #Variables with depth: nearest sigma layer of the nearest cell
+            sel3d=sel & ~np.isnan(mydepths)
+            if sel3d.any():
+                i0=ii[sel3d,0]
+                depthrange=self.wsel[ti[sel3d],i0] - self.belv[i0,0]
+                ly=nearestlayer(self.sigmatab,i0,depthrange,mydepths[sel3d])   #Nearest Depth Layer index
+                found=(mydepths[sel3d]<=depthrange) & (ly>=0)                   #Depth over Bottom?
+                rows=np.flatnonzero(sel3d)[found]
+                l[rows]=ly[found]
+                vals=self._gather(myvar,ti[rows],l=ly[found],ij=ii[rows])
+                value[rows]=np.average(vals,axis=1,weights=idwweights(dd[rows]))
+        return value,t,ij,l
+
+    def readvar_interp(self,myvar,mytimes,mylats=np.nan,mylons=np.nan,mydepths=np.nan):
+        '''Interpolated version of readvar_batch. The value is linear between the two
+        time steps around mytime, linear between the two sigma layers around mydepth
+        (in each of the 4 nearest cells) and IDW between the 4 nearest cells. Cells
+        where mydepth is below the bottom are left out of the IDW.
+        It returns value(N), t(N), ij(N,4) and l(N); t is the time step before mytime
+        and l the layer over mydepth in the nearest cell.'''
+        mytimes,mylats,mylons,mydepths=np.broadcast_arrays(
+            np.atleast_1d(np.asarray(mytimes,dtype=float)),np.asarray(mylats,dtype=float),
+            np.asarray(mylons,dtype=float),np.asarray(mydepths,dtype=float))
+        n=len(mytimes)
+        value=np.full(n,np.nan)
+        t=np.full(n,np.nan)
+        ij=np.full((n,4),np.nan)
+        l=np.full(n,np.nan)
+        #Time steps around mytime and their weights (N,2)
+        t0=np.clip(np.searchsorted(self.time,mytimes,side='right')-1,0,len(self.time)-2)
+        a=np.clip((mytimes-self.time[t0])/(self.time[t0+1]-self.time[t0]),0,1)
+        tt=np.c_[t0,t0+1]
+        wt=np.c_[1-a,a]
+        okt=np.absolute(self.time[self.timeindex.nearest_many(mytimes)]-mytimes)<=self.T*1.1
+        t[okt]=t0[okt]
+        #Variables without position (sun)
+        sel=okt & np.isnan(mylats)
+        if sel.any():
+            vals=self._gather(myvar,tt[sel].ravel()).reshape(-1,2)
+            value[sel]=blend(vals,wt[sel],axis=1)
+        sel=okt & ~np.isnan(mylats)
+        if not sel.any():
+            return value,t,ij,l
+        dd=np.full((n,4),np.inf)
+        ii=np.zeros((n,4),dtype=int)
+        dd[sel],ii[sel]=self.lonlattree.query(np.c_[mylons[sel],mylats[sel]],4)
+        sel=sel & (dd[:,0]<0.003)                                   #Spatial resolution < 0.003deg
+        ij[sel]=ii[sel]
+        #Variables without depth (wind): (N,2 times,4 cells)
+        sel2d=sel & np.isnan(mydepths)
+        if sel2d.any():
+            cells=np.broadcast_to(ii[sel2d,None,:],(sel2d.sum(),2,4))
+            times=np.broadcast_to(tt[sel2d,:,None],cells.shape)
+            vals=self._gather(myvar,times.ravel(),ij=cells.reshape(-1,1)).reshape(cells.shape)
+            vals=blend(vals,wt[sel2d,:,None],axis=1)
+            value[sel2d]=self._idw(vals,dd[sel2d])
+        #Variables with depth: (N,2 times,4 cells,2 layers)
+        sel3d=sel & ~np.isnan(mydepths)
+        if sel3d.any():
+            m=sel3d.sum()
+            cells=np.broadcast_to(ii[sel3d,None,:],(m,2,4))
+            times=np.broadcast_to(tt[sel3d,:,None],cells.shape)
+            depthrange=self.wsel[times,cells] - self.belv[cells,0]
+            depth=depthrange[...,None]-self.sigmatab[cells]*depthrange[...,None]
+            dist=depth-mydepths[sel3d,None,None,None]
+            up=np.where(dist<=0,dist,-np.inf)                       #Layers over mydepth
+            down=np.where(dist>=0,dist,np.inf)                      #Layers under mydepth
+            lu=np.argmax(up,axis=-1)
+            ld=np.argmin(down,axis=-1)
+            du=np.max(up,axis=-1)
+            ddown=np.min(down,axis=-1)
+            hasu=np.isfinite(du)
+            hasd=np.isfinite(ddown)
+            #Linear weight of the layer under mydepth (clamped to the nearest layer out of range)
+            with np.errstate(invalid='ignore',divide='ignore'):
+                b=np.where(hasu & hasd,-du/(ddown-du),np.where(hasd,1.0,0.0))
+            b=np.where(np.isfinite(b),b,0.0)
+            lu=np.where(hasu,lu,ld)
+            ld=np.where(hasd,ld,lu)
+            layers=np.stack([lu,ld],axis=-1)
+            wl=np.stack([1-b,b],axis=-1)
+            valid=(hasu | hasd) & (mydepths[sel3d,None,None]<=depthrange)   #Depth over Bottom?
+            shape=layers.shape
+            vals=self._gather(myvar,np.broadcast_to(times[...,None],shape).ravel(),
+                              l=layers.ravel(),ij=np.broadcast_to(cells[...,None],shape).reshape(-1,1)).reshape(shape)
+            vals=blend(vals,wl,axis=-1)
+            vals=np.where(valid,vals,np.nan)
+            vals=blend(vals,wt[sel3d,:,None],axis=1)
+            value[sel3d]=self._idw(vals,dd[sel3d])
+            rows=np.flatnonzero(sel3d)
+            l[rows]=np.where(valid[:,0,0],lu[:,0,0],np.nan)
+        return value,t,ij,l
+
+    def _idw(self,vals,dd):
+        #IDW of the cell values vals (M,4) leaving out the NaN values
+        w=idwweights(dd)*~np.isnan(vals)
+        with np.errstate(invalid='ignore'):
+            return np.sum(np.nan_to_num(vals)*w,axis=1)/np.sum(w,axis=1)
+
+    def _gather(self,myvar,t,l=None,ij=None):
+        #Read myvar at the time indices t (M), layers l (M) and cells ij (M,K).
+        #Without cache every time step is read from the file only once. Fill values are NaN.
+        slab=self.cache.get(myvar) if self.cache is not None else None
+        if slab is None:
+            tu,inv=np.unique(t,return_inverse=True)
+            slab=self._read(myvar,tu)
+        else:
+            inv=t
+        if ij is None:
+            return slab[inv]
+        if l is None:
+            return slab[inv[:,None],ij]
+        return slab[inv[:,None],l[:,None],ij]
+
+
+def benchmark_layers(body,n=10000,seed=0):
+    '''Time the nearest layer search of n random queries: loop over the layers of
+    each cell (former readvar) against the precomputed sigma table.'''
+    rng=np.random.default_rng(seed)
+    t=rng.integers(0,len(body.time),n)
+    ij=rng.integers(0,len(body.latc),n)
+    mydepth=rng.uniform(0,10,n)
+    depthrange=body.wsel[t,ij] - body.belv[ij,0]
+    ok=body.layers[ij]>0
+    t0=perf_counter()
+    l0=np.full(n,-1)
+    for k in np.flatnonzero(ok):
+        depth=np.nan*np.array(body.sigma[ij[k]])
+        for ly in range(body.blayer[ij[k]]-1,body.blayer[ij[k]]+body.layers[ij[k]]-1):
+            depth[ly]= depthrange[k]-body.sigma[ij[k],ly]*depthrange[k]
+        l0[k]=round(np.nanargmin(np.absolute(depth-mydepth[k]),0),0)
+    t1=perf_counter()
+    l1=np.array([nearestlayer(body.sigmatab,ij[k],depthrange[k],mydepth[k]) for k in range(n)])
+    t2=perf_counter()
+    l2=nearestlayer(body.sigmatab,ij,depthrange,mydepth)
+    t3=perf_counter()
+    print('Layer loop:   %.4fs' %(t1-t0))
+    print('Sigma table:  %.4fs (x%.1f)' %(t2-t1,(t1-t0)/(t2-t1)))
+    print('Sigma batch:  %.4fs (x%.1f)' %(t3-t2,(t1-t0)/(t3-t2)))
+    print('Same layers:',np.array_equal(l0[ok],l1[ok]) and np.array_equal(l0[ok],l2[ok]))
 
 if __name__ == "__main__":
     print('BodySim Loading')
@@ -285,6 +960,7 @@ if __name__ == "__main__":
     var='wind_x'
     value=simbody6.readvar(var,myts,47.64,-122.250)
     print(var,value)
+    benchmark_layers(simbody6)
     print('End')
 
 
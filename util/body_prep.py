@@ -0,0 +1,79 @@
+'''Preprocess a NetHFC4-UGRID body file into a store that SimBody6 loads in milliseconds.
+
+The store is written next to the body file (<bodyfile>.store) and contains:
+ * The sampled variables as float32 .npy files laid out (CELL,TIME,KC), fill values as NaN
+   (for ALG only the second algae).
+ * The geometry arrays of SimBody6 (STOREARRAYS) and the sigma table of the active layers.
+ * The pickled KDTree of the cell centers.
+ * meta.json with the size and mtime of the body file, written last, so a store is only
+   used when it is complete and up to date.
+
+Usage: python -m util.body_prep dataedge/Washington-1m-2008-09_UGRID.nc [--vars DOX NOX ...]
+'''
+import argparse
+import json
+import os
+import pickle
+import netCDF4
+import numpy as np
+from scipy.spatial import KDTree
+from util.body import STOREARRAYS, STOREVARS, layertable, storepath
+
+
+def build(bodyfile,myvars=STOREVARS,chunksteps=48,log=False):
+    '''Write the store of bodyfile with the variables myvars. It returns the store folder.'''
+    storedir=storepath(bodyfile)
+    os.makedirs(storedir,exist_ok=True)
+    metafile=os.path.join(storedir,'meta.json')
+    if os.path.exists(metafile):
+        os.remove(metafile)
+    simbody=netCDF4.Dataset(bodyfile)
+    #Geometry
+    arrays={'latc':simbody['latc'],'lonc':simbody['lonc'],'lat':simbody['lat'],'lon':simbody['lon'],
+            'nv':simbody['nv'],'time':simbody['time'],'belv':simbody['BELV'],'wsel':simbody['WSEL'],
+            'layers':simbody['layers'],'blayer':simbody['bottom_layer'],'sigma':simbody['sigma']}
+    arrays={attr:np.array(var) for attr,var in arrays.items()}
+    arrays['sigmatab']=layertable(arrays['sigma'],arrays['blayer'],arrays['layers'])
+    for attr in STOREARRAYS:
+        np.save(os.path.join(storedir,attr+'.npy'),arrays[attr])
+    lonlattree=KDTree(np.c_[arrays['lonc'].ravel(),arrays['latc'].ravel()])
+    with open(os.path.join(storedir,'kdtree.pkl'),'wb') as f:
+        pickle.dump(lonlattree,f,protocol=pickle.HIGHEST_PROTOCOL)
+    #Variables (CELL,TIME,KC), converted by time chunks
+    for myvar in myvars:
+        var=simbody[myvar]
+        shape=var.shape[:1]+var.shape[2:] if myvar=='ALG' else var.shape
+        shape=shape[-1:]+shape[:-1] if len(shape)>1 else shape
+        out=np.lib.format.open_memmap(os.path.join(storedir,myvar+'.npy'),mode='w+',dtype=np.float32,shape=shape)
+        for t0 in range(0,var.shape[0],chunksteps):
+            ts=slice(t0,t0+chunksteps)
+            data=var[ts,1] if myvar=='ALG' else var[ts]
+            data=np.ma.filled(np.ma.asarray(data,dtype=np.float32),np.nan)
+            if data.ndim>1:
+                out[:,ts]=np.moveaxis(data,-1,0)
+            else:
+                out[ts]=data
+        out.flush()
+        del out
+        if log==True:
+            print('BodyPrep',myvar,shape)
+    stat=os.stat(bodyfile)
+    meta={'size':stat.st_size,'mtime':stat.st_mtime,'units':simbody['time'].units,'vars':list(myvars)}
+    simbody.close()
+    with open(metafile,'w') as f:
+        json.dump(meta,f)
+    return storedir
+
+
+def main(argv=None):
+    parser=argparse.ArgumentParser(description='Build the SimBody6 store of a NetHFC4-UGRID body file.')
+    parser.add_argument('bodyfile',help='netCDF body file')
+    parser.add_argument('--vars',nargs='+',default=list(STOREVARS),help='variables to store')
+    parser.add_argument('--chunksteps',type=int,default=48,help='time steps converted at once')
+    args=parser.parse_args(argv)
+    storedir=build(args.bodyfile,args.vars,args.chunksteps,log=True)
+    print('BodyPrep store:',storedir)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,192 @@
+"""Fichero con el almacén columnar de los datos de los sensores (Fog y Cloud)."""
+
+import numbers
+import numpy as np
+import pandas as pd
+try:
+    import pyarrow as pa
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError:
+    pa = None
+
+
+class ColumnStore:
+    """
+    Almacén columnar de solo inserción.
+
+    Cada columna es un array de NumPy reservado de antemano que dobla su tamaño
+    cuando se llena, de forma que añadir una fila cuesta O(1) amortizado. El tipo
+    de cada columna se fija con el primer valor (numérica o 'object'), y pasa a
+    'object' si luego llega un valor que no cabe en ella. Solo se convierte a
+    DataFrame cuando hace falta (al guardar, en los informes o en las consultas).
+    Las filas ya guardadas se pueden descartar (discard) para acotar la memoria;
+    los índices de fila son siempre globales (desde la primera fila añadida).
+    """
+
+    def __init__(self, columns: list, capacity: int = 1024):
+        """Función de inicialización."""
+        self.columns: list = list(columns)
+        self.capacity: int = capacity
+        self.size: int = 0                  # Filas en memoria
+        self.offset: int = 0                # Filas descartadas
+        self.data: dict = {}
+
+    def __len__(self):
+        """Número de filas añadidas."""
+        return self.offset + self.size
+
+    def append(self, row):
+        """Añade una fila con un valor por columna, en el orden de self.columns."""
+        if len(self.data) == 0:
+            self._create([[value] for value in row])
+        elif self.size == len(self.data[self.columns[0]]):
+            self._grow(self.size + 1)
+        for column, value in zip(self.columns, row):
+            if not fits(self.data[column].dtype, value):
+                kind = self.data[column].dtype.kind
+                dtype = np.float64 if kind in "iu" and isinstance(value, numbers.Real) else object
+                self.data[column] = self.data[column].astype(dtype)
+            self.data[column][self.size] = value
+        self.size += 1
+
+    def extend(self, columns: dict):
+        """Añade varias filas de una vez a partir de un array por columna."""
+        values = [np.asarray(columns[column]) for column in self.columns]
+        n = len(values[0])
+        if n == 0:
+            return
+        if len(self.data) == 0:
+            self._create(values)
+        elif self.size + n > len(self.data[self.columns[0]]):
+            self._grow(self.size + n)
+        for column, value in zip(self.columns, values):
+            target = self.data[column]
+            if target.dtype != object and np.result_type(target.dtype, value.dtype) != target.dtype:
+                numeric = value.dtype.kind in "biuf" and target.dtype.kind in "biuf"
+                dtype = np.result_type(target.dtype, value.dtype) if numeric else object
+                target = self.data[column] = target.astype(dtype)
+            target[self.size:self.size + n] = value
+        self.size += n
+
+    def column(self, column: str) -> np.ndarray:
+        """Vista de los valores en memoria de una columna."""
+        if len(self.data) == 0:
+            return np.empty(0, dtype=object)
+        return self.data[column][:self.size]
+
+    def to_dataframe(self, start: int = None, stop: int = None) -> pd.DataFrame:
+        """Devuelve las filas en memoria [start, stop) como DataFrame (índice global)."""
+        start = self.offset if start is None else max(start, self.offset)
+        stop = len(self) if stop is None else min(stop, len(self))
+        if len(self.data) == 0 or start >= stop:
+            return pd.DataFrame(columns=self.columns)
+        rows = slice(start - self.offset, stop - self.offset)
+        return pd.DataFrame({column: self.data[column][rows] for column in self.columns},
+                            columns=self.columns, index=pd.RangeIndex(start, stop))
+
+    def discard(self, stop: int):
+        """Descarta de la memoria las filas anteriores a stop (índice global)."""
+        n = min(max(stop - self.offset, 0), self.size)
+        if n == 0:
+            return
+        for column in self.columns:
+            self.data[column][:self.size - n] = self.data[column][n:self.size]
+        self.size -= n
+        self.offset += n
+
+    def _create(self, values):
+        # Reserva las columnas con el tipo de los primeros valores
+        capacity = max(self.capacity, len(values[0]))
+        for column, value in zip(self.columns, values):
+            dtype = np.asarray(value).dtype
+            if dtype.kind not in "biuf":
+                dtype = object
+            self.data[column] = np.empty(capacity, dtype=dtype)
+
+    def _grow(self, size: int):
+        # Dobla la capacidad hasta que quepan size filas
+        capacity = len(self.data[self.columns[0]])
+        while capacity < size:
+            capacity *= 2
+        for column in self.columns:
+            data = np.empty(capacity, dtype=self.data[column].dtype)
+            data[:self.size] = self.data[column][:self.size]
+            self.data[column] = data
+
+
+class StreamWriter:
+    """
+    Escritor incremental de las filas de un ColumnStore.
+
+    Cada llamada a write añade un bloque de filas al fichero: CSV (mismo formato
+    que DataFrame.to_csv, con el índice global de la fila), Parquet o Arrow IPC
+    ('parquet' y 'arrow' necesitan pyarrow). El fichero se crea con el primer bloque;
+    un bloque vacío crea el CSV sólo con la cabecera, y close crea el fichero Parquet
+    o Arrow vacío si no llegó ninguna fila, de modo que siempre hay fichero.
+    """
+
+    extensions = {"csv": ".csv", "parquet": ".parquet", "arrow": ".arrow"}
+
+    def __init__(self, path: str, fmt: str = "csv"):
+        """Función de inicialización (path sin extensión)."""
+        if fmt not in self.extensions:
+            raise ValueError("Unknown format: " + fmt)
+        if fmt != "csv" and pa is None:
+            raise ImportError("pyarrow is required to write " + fmt + " files")
+        self.path: str = path + self.extensions[fmt]
+        self.fmt: str = fmt
+        self.rows: int = 0
+        self.schema = None
+        self.writer = None
+        self.created: bool = False      # Fichero CSV creado (aunque sea sin filas)
+        self.empty = None               # Bloque vacío con las columnas (Parquet y Arrow)
+
+    def write(self, df: pd.DataFrame):
+        """Añade las filas de df al fichero."""
+        if len(df) == 0:
+            if self.fmt == "csv" and not self.created:
+                df.to_csv(self.path, mode="w", header=True)
+                self.created = True
+            elif self.fmt != "csv" and self.empty is None:
+                self.empty = df
+            return
+        if self.fmt == "csv":
+            df.to_csv(self.path, mode="a" if self.created else "w", header=not self.created)
+            self.created = True
+        else:
+            table = pa.Table.from_pandas(df, preserve_index=True)
+            if self.writer is None:
+                # El esquema del primer bloque se mantiene en todo el fichero
+                self.schema = table.schema
+                if self.fmt == "parquet":
+                    self.writer = pa.parquet.ParquetWriter(self.path, self.schema)
+                else:
+                    self.writer = pa.ipc.new_file(self.path, self.schema)
+            self.writer.write_table(table.cast(self.schema))
+        self.rows += len(df)
+
+    def close(self):
+        """Cierra el fichero (Parquet y Arrow escriben aquí su pie)."""
+        if self.writer is None and self.fmt != "csv" and self.empty is not None:
+            # Ninguna fila: fichero vacío con las columnas
+            table = pa.Table.from_pandas(self.empty, preserve_index=True)
+            if self.fmt == "parquet":
+                pa.parquet.write_table(table, self.path)
+            else:
+                with pa.ipc.new_file(self.path, table.schema) as writer:
+                    writer.write_table(table)
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+
+def fits(dtype, value) -> bool:
+    """Indica si value se puede guardar en una columna de tipo dtype sin perder información."""
+    if dtype.kind == "f":
+        return isinstance(value, numbers.Real) and not isinstance(value, (bool, np.bool_))
+    if dtype.kind in "iu":
+        return isinstance(value, numbers.Integral) and not isinstance(value, (bool, np.bool_))
+    if dtype.kind == "b":
+        return isinstance(value, (bool, np.bool_))
+    return True
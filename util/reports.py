@@ -1,14 +1,17 @@
-import math
+import matplotlib as mpl
 import matplotlib.pyplot as plt
-import matplotlib.animation as animation
 from matplotlib.animation import FuncAnimation
-from functools import partial
-from matplotlib.patches import Polygon
 from matplotlib.patches import Circle
-from matplotlib.collections import PatchCollection
+from matplotlib.collections import PolyCollection
 import pandas as pd
 import numpy as np
 import logging
+import multiprocessing
+import os
+import shutil
+import subprocess
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
 import plotly.express as px
 import netCDF4 as nc
 from xdevs import get_logger
@@ -19,9 +22,18 @@ logger = get_logger(__name__, logging.DEBUG)
 class FogReportService:
     """Class to generate fog reports."""
 
-    def __init__(self, base_folder: str = 'output', emms_file: str = 'dataedge/Washington-1m-2008-09_UGRID.nc'):
+    def __init__(self, base_folder: str = 'output', emms_file: str = 'dataedge/Washington-1m-2008-09_UGRID.nc',
+                 frames: int = 100, fps: int = 5, figsize: tuple = None, dpi: float = None, workers: int = 1):
         self.base_folder = base_folder
+        self.data_folder = base_folder      # Folder of the CSV files (see snapshot)
         self.emms_file = emms_file
+        # Figure 1 animation: frames, frame rate, size (inches) and resolution, and the
+        # processes that render the frames
+        self.frames = frames
+        self.fps = fps
+        self.figsize = figsize
+        self.dpi = dpi
+        self.workers = workers
         self.html_title = "Fog Report"
 
     def run(self):
@@ -36,185 +48,11 @@ class FogReportService:
         self.prepare_figure4()
         self.prepare_figure5()
 
-    def update(self, ax, color_bars, usv_data, num_frames_usv, emms_data, num_frames_emms, step):
-        logger.debug("Generating figure 1: current frame is: " +
-                     str(step) + "/100")
-
-        # Preparing the index:
-        size_step_usv = num_frames_usv/100
-        curr_indx_usv = int(step*size_step_usv)
-        size_step_emms = num_frames_emms/100
-        curr_indx_emms = int(step*size_step_emms)
-
-        plt.suptitle(usv_data["timestamp"][curr_indx_usv].strftime(
-            "%d/%m/%Y, %H:%M"), x=0.2, y=1, fontsize='small')
-
-        # GRAPHIC 1
-        # ----------------------
-        # Water temperature
-        ax[0][0].clear()
-        ax[0][0].tick_params(axis='y', colors='red')
-        ax[0][0].plot(usv_data["timestamp"][0:curr_indx_usv], usv_data["water_temp"]
-                      [0:curr_indx_usv], color="red", label="Water Temperature (ºC)")
-        ax[0][0].plot(usv_data["timestamp"][curr_indx_usv],
-                      usv_data["water_temp"][curr_indx_usv], marker="o", color="red")
-        # ----------------------
-
-        # GRAPHIC 2
-        # ----------------------
-        # Water speed
-        ax[0][1].clear()
-        ax[0][1].set_xlim([-122.25, -122.2])
-        ax[0][1].set_ylim([47.5, 47.55])
-        ax[0][1].quiver(emms_data["zonal_lon"], emms_data["zonal_lat"], emms_data["water_x"]
-                        [curr_indx_emms][54][:]/10, emms_data["water_y"][curr_indx_emms][54][:]/10, color='b')
-        # ----------------------
-
-        # GRAPHIC 3
-        # ----------------------
-        # Wind speed
-        ax[0][2].clear()
-        ax[0][2].set_xlim([-122.25, -122.2])
-        ax[0][2].set_ylim([47.5, 47.55])
-        ax[0][2].quiver(emms_data["zonal_lon"], emms_data["zonal_lat"], emms_data["wind_x"]
-                        [curr_indx_emms][:]/10, emms_data["wind_y"][curr_indx_emms][:]/10, color='b')
-        # ----------------------
-
-        # GRAPHIC 4
-        # ----------------------
-        # Algae concentration
-        ax[1][0].clear()
-        ax[1][0].add_collection(color_bars["collection1"])
-        ax[1][0].set_xlim([-122.25, -122.2])
-        ax[1][0].set_ylim([47.5, 47.55])
-        ax[1][0].set_title(
-            "Sim. Bloom, Inf. Bloom & Ship Pos.", fontsize='small')
-        ax[1][0].set_xlabel("Longitude")
-        ax[1][0].set_ylabel("Latitude")
-        alg = np.array(
-            list(map(color_bars["norm1"], emms_data["algae"][curr_indx_emms][1][54][:])))
-        colors1 = color_bars["cmap1"](alg)
-        color_bars["collection1"].set_color(colors1)
-        # USV trajectory
-        ax[1][0].plot(usv_data["usv_lon"][curr_indx_usv], usv_data["usv_lat"]
-                      [curr_indx_usv], color="black", marker='d', markersize=5)
-        # Infected bloom
-        # TODO: This boolean has a initial blank space. Fix it at the inference service.
-        if (usv_data["bloom_detection"][curr_indx_usv] == " True"):
-            circle = Circle((usv_data["bloom_lon"][curr_indx_usv], usv_data["bloom_lat"][curr_indx_usv]),
-                            radius=0.05 * math.sqrt(usv_data["bloom_size"][curr_indx_usv]), fill=False, color="red")
-            ax[1][0].add_patch(circle)
-        ax[1][0].autoscale_view()
-
-        # GRAPHIC 5
-        # ----------------------
-        # Disolved Oxygen
-        ax[1][1].clear()
-        ax[1][1].add_collection(color_bars["collection2"])
-        ax[1][1].set_xlim([-122.25, -122.2])
-        ax[1][1].set_ylim([47.5, 47.55])
-        ax[1][1].set_title("Disolved Oxygen", fontsize='small')
-        ax[1][1].set_xlabel("Longitude")
-        ax[1][1].set_ylabel("Latitude")
-        disox = np.array(
-            list(map(color_bars["norm2"], emms_data["dox"][curr_indx_emms][54][:])))
-        colors2 = color_bars["cmap2"](disox)
-        color_bars["collection2"].set_color(colors2)
-        ax[1][1].autoscale_view()
-
-        # GRAPHIC 5
-        # ----------------------
-        # Disolved Oxygen
-        ax[1][2].clear()
-        ax[1][2].add_collection(color_bars["collection3"])
-        ax[1][2].set_xlim([-122.25, -122.2])
-        ax[1][2].set_ylim([47.5, 47.55])
-        ax[1][2].set_title("Nitrate", fontsize='small')
-        ax[1][2].set_xlabel("Longitude")
-        ax[1][2].set_ylabel("Latitude")
-        nit = np.array(
-            list(map(color_bars["norm3"], emms_data["nox"][curr_indx_emms][54][:])))
-        colors3 = color_bars["cmap3"](nit)
-        color_bars["collection3"].set_color(colors3)
-        line = ax[1][2].autoscale_view()
-
-        return line
-
     def prepare_figure1(self):
-        # Prepare the interval and important data
-        # USV
-        usv_data = pd.read_csv(
-            self.base_folder + "/FogServer.InferenceService.csv")
-        usv_data['timestamp'] = pd.to_datetime(usv_data['timestamp'])
-        # EMMS
-        emms_df = nc.Dataset(self.emms_file)
-        emms_data = {}
-        # Zonal longitude
-        emms_data["zonal_lon"] = emms_df.variables["lonc"][:]
-        # Zonal latitude
-        emms_data["zonal_lat"] = emms_df.variables["latc"][:]
-        # Wind speed x axis
-        emms_data["wind_x"] = emms_df.variables["wind_x"][:]
-        # Wind speed y axis
-        emms_data["wind_y"] = emms_df.variables["wind_y"][:]
-        # Water speed x axis
-        emms_data["water_x"] = emms_df.variables["U"][:]
-        # Water speed y axis
-        emms_data["water_y"] = emms_df.variables["V"][:]
-        # Algae concentration
-        emms_data["algae"] = emms_df.variables["ALG"][:]
-        # Dissolved oxygen
-        emms_data["dox"] = emms_df.variables["DOX"][:]
-        # Nitrate nitrogen
-        emms_data["nox"] = emms_df.variables["NOX"][:]
-
-        # Prepare the figure
-        fig, ax = plt.subplots(2, 3)
-        fig.tight_layout(h_pad=0.5)
-
-        # Prepare the color bars
-        color_bars = {}
-        # subplot 1
-        color_bars["cmap1"] = plt.get_cmap('viridis')
-        color_bars["norm1"] = plt.Normalize(0, 10)
-        sm1 = plt.cm.ScalarMappable(cmap=color_bars["cmap1"])
-        sm1.set_clim(vmin=0, vmax=10)
-        cbar1 = plt.colorbar(sm1, ax=ax[1][0])
-        cbar1.set_label('Algae (mg/L)')
-        # subplot 2
-        color_bars["cmap2"] = plt.get_cmap('viridis')
-        color_bars["norm2"] = plt.Normalize(0, 25)
-        sm2 = plt.cm.ScalarMappable(cmap=color_bars["cmap2"])
-        sm2.set_clim(vmin=0, vmax=25)
-        cbar2 = plt.colorbar(sm2, ax=ax[1][1])
-        cbar2.set_label('Disolved Oxygen (mg/L)')
-        # subplot 3
-        color_bars["cmap3"] = plt.get_cmap('viridis')
-        color_bars["norm3"] = plt.Normalize(0, 0.2)
-        sm3 = plt.cm.ScalarMappable(cmap=color_bars["cmap3"])
-        sm3.set_clim(vmin=0, vmax=0.2)
-        cbar3 = plt.colorbar(sm3, ax=ax[1][2])
-        cbar3.set_label('Nitrate (mg/L)')
-
-        # Color map
-        nodal_lon = emms_df.variables["lon"][:]
-        nodal_lat = emms_df.variables["lat"][:]
-        nodes = emms_df.variables["nv"][:]
-        longitude = nodal_lon[nodes-1]
-        latitude = nodal_lat[nodes-1]
-        patches = []
-        for i in range(len(longitude)):
-            verts = np.column_stack((longitude[i], latitude[i]))
-            polygon = Polygon(verts, closed=True)
-            patches.append(polygon)
-        color_bars["collection1"] = PatchCollection(patches)
-        color_bars["collection2"] = PatchCollection(patches)
-        color_bars["collection3"] = PatchCollection(patches)
-
-        ani = FuncAnimation(fig, partial(self.update, ax, color_bars, usv_data, len(usv_data['timestamp']), emms_data, len(emms_data["wind_x"])),
-                            repeat=False, blit=False)
-        ani.save(self.base_folder + "/figure1.mp4",
-                 writer=animation.FFMpegWriter(fps=5))
+        save_figure1(self.base_folder + "/figure1.mp4",
+                     (self.data_folder + "/FogServer.InferenceService.csv", self.emms_file,
+                      self.frames, self.figsize, self.dpi),
+                     fps=self.fps, workers=self.workers)
 
     def prepare_figure3(self):
         fig, ax = plt.subplots(5, 1)
@@ -222,7 +60,7 @@ class FogReportService:
         fig.set_figheight(10)
 
         # Sun radiation
-        df = pd.read_csv(self.base_folder + "/FogServer.SimSenS.csv")
+        df = pd.read_csv(self.data_folder + "/FogServer.SimSenS.csv")
         df['timestamp'] = pd.to_datetime(df['timestamp'])
         # data_sun.info()
         ax[0].set_title('Normalized Sun Radiation')
@@ -230,30 +68,30 @@ class FogReportService:
         ax[0].tick_params(labelrotation=20, labelsize=7)
 
         # Water temperature
-        df = pd.read_csv(self.base_folder + "/FogServer.SimSenT.csv")
+        df = pd.read_csv(self.data_folder + "/FogServer.SimSenT.csv")
         df['timestamp'] = pd.to_datetime(df['timestamp'])
         ax[1].set_title('Water Temperature (ºC)')
         ax[1].plot(df["timestamp"], df["WTE"])
         ax[1].tick_params(labelrotation=20, labelsize=7)
 
         # Nitrate
-        df = pd.read_csv(self.base_folder + "/FogServer.SimSenN.csv")
+        df = pd.read_csv(self.data_folder + "/FogServer.SimSenN.csv")
         df['timestamp'] = pd.to_datetime(df['timestamp'])
         ax[2].set_title('Nitrate (mg/L)')
         ax[2].plot(df["timestamp"], df["NOX"])
         ax[2].tick_params(labelrotation=20, labelsize=7)
 
         # Disolved oxygen
-        df = pd.read_csv(self.base_folder + "/FogServer.SimSenO.csv")
+        df = pd.read_csv(self.data_folder + "/FogServer.SimSenO.csv")
         df['timestamp'] = pd.to_datetime(df['timestamp'])
         ax[3].set_title('Disolved Oxygen (mg/L)')
         ax[3].plot(df["timestamp"], df["DOX"])
         ax[3].tick_params(labelrotation=20, labelsize=7)
 
         # Water speed
-        df1 = pd.read_csv(self.base_folder + "/FogServer.SimSenU.csv")
+        df1 = pd.read_csv(self.data_folder + "/FogServer.SimSenU.csv")
         df1['timestamp'] = pd.to_datetime(df1['timestamp'])
-        df2 = pd.read_csv(self.base_folder + "/FogServer.SimSenV.csv")
+        df2 = pd.read_csv(self.data_folder + "/FogServer.SimSenV.csv")
         df2['timestamp'] = pd.to_datetime(df2['timestamp'])
         ax[4].set_title('Water Speed (m/s)')
         ax[4].plot(df["timestamp"], np.sqrt(df1["WFU"]**2+df2["WFV"]**2))
@@ -264,6 +102,7 @@ class FogReportService:
         # plt.show()
         plt.savefig(self.base_folder + "/figure3.png",
                     dpi=400, bbox_inches='tight')
+        plt.close(fig)
 
     def prepare_figure4(self):
         fig, ax = plt.subplots(4, 1)
@@ -271,7 +110,7 @@ class FogReportService:
         fig.set_figheight(10)
 
         # Bloom detection
-        df = pd.read_csv(self.base_folder + "/FogServer.InferenceService.csv")
+        df = pd.read_csv(self.data_folder + "/FogServer.InferenceService.csv")
         df['timestamp'] = pd.to_datetime(df['timestamp'])
         ax[0].set_title('Detection (bool)')
         ax[0].set_ylim([-0.1, 1.1])
@@ -296,6 +135,7 @@ class FogReportService:
         fig.suptitle('Inferred Bloom', x=0.2, y=1)
         plt.savefig(self.base_folder + "/figure4.png",
                     dpi=400, bbox_inches='tight')
+        plt.close(fig)
 
     def prepare_figure5(self):
         fig, ax = plt.subplots(4, 1)
@@ -303,7 +143,7 @@ class FogReportService:
         fig.set_figheight(10)
 
         # USV Power
-        df = pd.read_csv(self.base_folder + "/FogServer.InferenceService.csv")
+        df = pd.read_csv(self.data_folder + "/FogServer.InferenceService.csv")
         df['timestamp'] = pd.to_datetime(df['timestamp'])
         ax[0].set_title('Normalized electric power')
         ax[0].plot(df["timestamp"], df["usv_power"], label='Battery')
@@ -329,6 +169,7 @@ class FogReportService:
         fig.suptitle('USV', x=0.2, y=1)
         plt.savefig(self.base_folder + "/figure5.png",
                     dpi=400, bbox_inches='tight')
+        plt.close(fig)
 
     def prepare_html_code(self):
         html = f'''
@@ -387,15 +228,254 @@ class FogReportService:
         return html
 
 
+class Figure1:
+    """
+    Figure 1 of the fog report: USV data and surface of the water body, animated.
+
+    Only the surface layer of the frames that are drawn is read from the body, and the
+    colours of the maps are computed for every frame in one pass. The artists are
+    created once and each frame only updates their data. Animation.save does not blit,
+    so save draws the static part of the figure once and blits the artists of each
+    frame onto it, piping the RGBA buffers to FFmpeg (animation() gives the blitted
+    FuncAnimation to show it).
+    """
+
+    # Layer of the body drawn in the maps (surface)
+    SURFACE_LAYER = 54
+    XLIM = [-122.25, -122.2]
+    YLIM = [47.5, 47.55]
+
+    def __init__(self, usv_file: str, emms_file: str, frames: int = 100, figsize: tuple = None, dpi: float = None):
+        self.frames = frames
+        self.figsize = figsize
+        self.dpi = dpi
+        # USV
+        usv_data = pd.read_csv(usv_file)
+        self.timestamp = pd.to_datetime(usv_data["timestamp"]).to_numpy()
+        self.water_temp = usv_data["water_temp"].to_numpy()
+        self.usv_lon = usv_data["usv_lon"].to_numpy()
+        self.usv_lat = usv_data["usv_lat"].to_numpy()
+        self.bloom_detection = as_bool(usv_data["bloom_detection"]).to_numpy()
+        self.bloom_lon = usv_data["bloom_lon"].to_numpy()
+        self.bloom_lat = usv_data["bloom_lat"].to_numpy()
+        self.bloom_radius = 0.05 * np.sqrt(usv_data["bloom_size"].to_numpy())
+        self.usv_index = frame_index(len(usv_data), frames)
+        # EMMS: surface layer of the time steps drawn
+        emms_df = nc.Dataset(emms_file)
+        steps, self.emms_index = np.unique(frame_index(len(emms_df.variables["wind_x"]), frames),
+                                           return_inverse=True)
+        layer = self.SURFACE_LAYER
+        self.zonal_lon = emms_df.variables["lonc"][:]
+        self.zonal_lat = emms_df.variables["latc"][:]
+        self.wind_x = emms_df.variables["wind_x"][steps, :]/10
+        self.wind_y = emms_df.variables["wind_y"][steps, :]/10
+        self.water_x = emms_df.variables["U"][steps, layer, :]/10
+        self.water_y = emms_df.variables["V"][steps, layer, :]/10
+        # Colours of the maps (algae, disolved oxygen and nitrate) for all the frames
+        self.maps = (
+            ("ALG", 10, "Sim. Bloom, Inf. Bloom & Ship Pos.", 'Algae (mg/L)'),
+            ("DOX", 25, "Disolved Oxygen", 'Disolved Oxygen (mg/L)'),
+            ("NOX", 0.2, "Nitrate", 'Nitrate (mg/L)'),
+        )
+        self.cmap = plt.get_cmap('viridis')
+        self.colors = []
+        for var, vmax, title, label in self.maps:
+            if var == "ALG":
+                data = emms_df.variables[var][steps, 1, layer, :]
+            else:
+                data = emms_df.variables[var][steps, layer, :]
+            self.colors.append(self.cmap(plt.Normalize(0, vmax)(data)))
+        # Cells of the mesh
+        nodes = emms_df.variables["nv"][:]
+        self.cells = np.stack((emms_df.variables["lon"][:][nodes-1],
+                               emms_df.variables["lat"][:][nodes-1]), axis=-1)
+        emms_df.close()
+        self.prepare()
+
+    def prepare(self):
+        """Create the figure and its artists."""
+        self.fig, ax = plt.subplots(2, 3, figsize=self.figsize, dpi=self.dpi)
+        self.fig.tight_layout(h_pad=0.5)
+        self.title = self.fig.suptitle("", x=0.2, y=1, fontsize='small')
+        # Water temperature (the whole series fixes the limits of the axes)
+        ax[0][0].tick_params(axis='y', colors='red')
+        self.temp_line, = ax[0][0].plot(self.timestamp, self.water_temp, color="red",
+                                        label="Water Temperature (ºC)")
+        self.temp_point, = ax[0][0].plot(self.timestamp[:1], self.water_temp[:1],
+                                         marker="o", color="red")
+        # Water and wind speed
+        for axes in ax[0][1:]:
+            axes.set_xlim(self.XLIM)
+            axes.set_ylim(self.YLIM)
+        self.water = ax[0][1].quiver(self.zonal_lon, self.zonal_lat,
+                                     self.water_x[0], self.water_y[0], color='b')
+        self.wind = ax[0][2].quiver(self.zonal_lon, self.zonal_lat,
+                                    self.wind_x[0], self.wind_y[0], color='b')
+        # Maps
+        self.collections = []
+        for axes, (var, vmax, title, label) in zip(ax[1], self.maps):
+            sm = plt.cm.ScalarMappable(cmap=self.cmap)
+            sm.set_clim(vmin=0, vmax=vmax)
+            cbar = plt.colorbar(sm, ax=axes)
+            cbar.set_label(label)
+            collection = PolyCollection(self.cells)
+            axes.add_collection(collection)
+            axes.set_xlim(self.XLIM)
+            axes.set_ylim(self.YLIM)
+            axes.set_title(title, fontsize='small')
+            axes.set_xlabel("Longitude")
+            axes.set_ylabel("Latitude")
+            self.collections.append(collection)
+        # USV position and inferred bloom
+        self.usv, = ax[1][0].plot(self.usv_lon[:1], self.usv_lat[:1], color="black",
+                                  marker='d', markersize=5)
+        self.bloom = Circle((self.bloom_lon[0], self.bloom_lat[0]), radius=self.bloom_radius[0],
+                            fill=False, color="red", visible=False)
+        ax[1][0].add_patch(self.bloom)
+        self.artists = [self.temp_line, self.temp_point, self.water, self.wind,
+                        *self.collections, self.usv, self.bloom]
+
+    def init(self):
+        """Initial frame of the animation (FuncAnimation init_func)."""
+        return self.update(0)
+
+    def update(self, step: int):
+        """Update the artists to the frame step. It returns the updated artists of the axes
+        (FuncAnimation only blits those, so the title is not refreshed when the animation is shown)."""
+        logger.debug("Generating figure 1: current frame is: " +
+                     str(step) + "/" + str(self.frames))
+        i = self.usv_index[step]
+        t = self.emms_index[step]
+        self.title.set_text(pd.Timestamp(self.timestamp[i]).strftime("%d/%m/%Y, %H:%M"))
+        self.temp_line.set_data(self.timestamp[:i], self.water_temp[:i])
+        self.temp_point.set_data(self.timestamp[i:i+1], self.water_temp[i:i+1])
+        # Arrows are scaled to the speeds of each frame
+        self.water.scale = None
+        self.water.set_UVC(self.water_x[t], self.water_y[t])
+        self.wind.scale = None
+        self.wind.set_UVC(self.wind_x[t], self.wind_y[t])
+        for collection, colors in zip(self.collections, self.colors):
+            collection.set_color(colors[t])
+        self.usv.set_data(self.usv_lon[i:i+1], self.usv_lat[i:i+1])
+        self.bloom.set_visible(bool(self.bloom_detection[i]))
+        self.bloom.set_center((self.bloom_lon[i], self.bloom_lat[i]))
+        self.bloom.set_radius(self.bloom_radius[i])
+        return self.artists
+
+    def animation(self) -> FuncAnimation:
+        """Blitted animation of the figure."""
+        return FuncAnimation(self.fig, self.update, frames=self.frames, init_func=self.init,
+                             repeat=False, blit=True)
+
+    def draw_background(self):
+        """Draw the figure without the animated artists and keep it as background."""
+        for artist in self.artists + [self.title]:
+            artist.set_animated(True)
+        self.fig.canvas.draw()
+        self.background = self.fig.canvas.copy_from_bbox(self.fig.bbox)
+
+    def render(self, step: int) -> bytes:
+        """RGBA buffer of the frame step."""
+        self.update(step)
+        self.fig.canvas.restore_region(self.background)
+        for artist in self.artists + [self.title]:
+            self.fig.draw_artist(artist)
+        return bytes(self.fig.canvas.buffer_rgba())
+
+    def save(self, path: str, fps: int = 5):
+        """Render all the frames to an MP4 file."""
+        self.draw_background()
+        with FFMpegPipe(path, self.fig.canvas.get_width_height(physical=True), fps) as pipe:
+            for step in range(self.frames):
+                pipe.write(self.render(step))
+
+
+class FFMpegPipe:
+    """FFmpeg process that encodes the RGBA frames written to it (as FFMpegWriter)."""
+
+    def __init__(self, path: str, size: tuple, fps: int = 5):
+        self.args = [mpl.rcParams['animation.ffmpeg_path'], '-f', 'rawvideo', '-vcodec', 'rawvideo',
+                     '-s', '%dx%d' % size, '-pix_fmt', 'rgba', '-framerate', str(fps),
+                     '-loglevel', 'error', '-i', 'pipe:', '-vcodec', mpl.rcParams['animation.codec'],
+                     '-pix_fmt', 'yuv420p', '-vf', 'pad=ceil(iw/2)*2:ceil(ih/2)*2', '-y', path]
+
+    def __enter__(self):
+        self.proc = subprocess.Popen(self.args, stdin=subprocess.PIPE)
+        return self
+
+    def write(self, frame: bytes):
+        self.proc.stdin.write(frame)
+
+    def __exit__(self, *exc):
+        self.proc.stdin.close()
+        if self.proc.wait() != 0 and exc[0] is None:
+            raise subprocess.CalledProcessError(self.proc.returncode, self.args)
+
+# Process of a parallel render of figure 1 (see save_figure1)
+figure1_worker: Figure1 = None
+
+
+def start_figure1_worker(*args):
+    """Build the figure of a render process and draw its background."""
+    global figure1_worker
+    mpl.use('Agg')      # Off-screen rendering, whatever the default backend is
+    figure1_worker = Figure1(*args)
+    figure1_worker.draw_background()
+
+
+def render_figure1_frames(steps) -> list:
+    """RGBA buffers of the frames steps, rendered in a render process."""
+    return [figure1_worker.render(step) for step in steps]
+
+
+def save_figure1(path: str, args: tuple, fps: int = 5, workers: int = 1, chunk: int = 8):
+    """
+    Render figure 1 (Figure1(*args)) to an MP4 file.
+
+    With several workers, the frames are rendered by a pool of processes in slices of
+    chunk frames, and written in order to a single FFmpeg pipe. Every process draws the
+    same background and frames, so the video is the same as the serial one.
+    """
+    figure = Figure1(*args)
+    if workers <= 1:
+        figure.save(path, fps)
+        plt.close(figure.fig)
+        return
+    size = figure.fig.canvas.get_width_height(physical=True)
+    plt.close(figure.fig)
+    steps = [range(start, min(start + chunk, figure.frames)) for start in range(0, figure.frames, chunk)]
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'),
+                             initializer=start_figure1_worker, initargs=args) as pool:
+        with FFMpegPipe(path, size, fps) as pipe:
+            for frames in pool.map(render_figure1_frames, steps):
+                for frame in frames:
+                    pipe.write(frame)
+
+
+def frame_index(n: int, frames: int) -> np.ndarray:
+    """Index of the row of n rows shown in each of the frames."""
+    return np.array([int(step*(n/frames)) for step in range(frames)])
+
+
+def as_bool(values: pd.Series) -> pd.Series:
+    """Booleans read from a CSV column (True/False, written as text or bool, with or without spaces)."""
+    if values.dtype == bool:
+        return values
+    return values.astype(str).str.strip().str.lower() == "true"
+
+
 class CloudReportService:
     """
     Class to generate cloud reports. In the future, it should provide support for several water bodies. 
     Currently, it manages one single water body.
     """
 
-    def __init__(self, base_folder: str = 'output', emms_file: str = 'dataedge/Washington-1m-2008-09_UGRID.nc'):
+    def __init__(self, base_folder: str = 'output', emms_file: str = 'dataedge/Washington-1m-2008-09_UGRID.nc',
+                 resolution: float = None):
         self.base_folder = base_folder
+        self.data_folder = base_folder      # Folder of the CSV files (see snapshot)
         self.emms_file = emms_file
+        self.resolution = resolution        # Grid of the bloom map (degrees), None for the exact positions
         self.html_title = "Cloud Report"
 
     def run(self):
@@ -405,39 +485,38 @@ class CloudReportService:
             f.write(self.prepare_html_code())
 
     def prepare_data(self):
+        # The inference results are read once for all the reports
+        self.df = pd.read_csv(self.data_folder + "/FogServer.InferenceService.csv")
+        self.df["bloom_detection"] = as_bool(self.df["bloom_detection"])
         self.prepare_report1()
         self.prepare_report2()
         self.prepare_report3()
 
     def prepare_report1(self):
         """Prepare report 1: general statistics."""
-        df = pd.read_csv(self.base_folder + "/FogServer.InferenceService.csv")
-        self.report1 = df.describe()
+        self.report1 = self.df.describe()
 
     def prepare_report2(self):
         """Prepare report 2: number of blooms detected."""
-        df = pd.read_csv(self.base_folder + "/FogServer.InferenceService.csv")
+        detection = self.df.bloom_detection
         self.report2 = pd.DataFrame(columns=["Title", "Value"])
-        n_blooms = (df.bloom_detection & ~df.bloom_detection.shift(
+        n_blooms = (detection & ~detection.shift(
             periods=1, fill_value=False)).sum()
         self.report2.loc[len(self.report2)] = {
             "Title": "Number of blooms detected", "Value": n_blooms}
 
     def prepare_report3(self):
-        """Prepare report 3: heat map of detected blooms."""
-        df = pd.read_csv(self.base_folder + "/FogServer.InferenceService.csv")
-        self.report3 = pd.DataFrame(
-            columns=["latitude", "longitude", "density"])
-        for index, row in df.iterrows():
-            density: int = 0
-            if row.bloom_detection is True:
-                density = 1.0
-            if self.report3.loc[(self.report3['latitude'] == row.bloom_lat) & (self.report3['longitude'] == row.bloom_lon)].empty:
-                self.report3.loc[len(self.report3)] = {
-                    "latitude": row.bloom_lat, "longitude": row.bloom_lon, "density": density}
-            else:
-                self.report3.loc[(self.report3['latitude'] == row.bloom_lat) & (
-                    self.report3['longitude'] == row.bloom_lon), 'density'] += density
+        """Prepare report 3: heat map of detected blooms (detections per position or grid cell)."""
+        latitude = self.df.bloom_lat
+        longitude = self.df.bloom_lon
+        if self.resolution:
+            latitude = (latitude / self.resolution).round() * self.resolution
+            longitude = (longitude / self.resolution).round() * self.resolution
+        self.report3 = pd.DataFrame({
+            "latitude": latitude, "longitude": longitude,
+            "density": self.df.bloom_detection.astype(float)})
+        self.report3 = self.report3.groupby(["latitude", "longitude"], sort=False,
+                                            as_index=False)["density"].sum()
         fig = px.density_mapbox(self.report3, lat='latitude', zoom=12,
                                 lon='longitude', z='density', mapbox_style="stamen-terrain")
         fig.write_html(self.base_folder + "/cloud-report3.html")
@@ -467,3 +546,50 @@ class CloudReportService:
                 </body>
             </html>'''
         return html
+
+
+# Background reports: the services run in a pool of processes from a snapshot of
+# the CSV files, so the simulation goes on while the figures are rendered. The pool
+# uses spawn, so the script that runs the simulation needs an
+# `if __name__ == '__main__':` guard; shutdown_reports releases the pool.
+report_pool: ProcessPoolExecutor = None
+
+
+def snapshot(base_folder: str) -> str:
+    """Copy the CSV files of base_folder into a new folder of the system temp directory.
+    Only CSV files can be read while they are written: a Parquet or Arrow file gets its
+    footer when it is closed, so the reports of those formats run in the simulation."""
+    folder = tempfile.mkdtemp(prefix='devs-bloom-snapshot-')
+    for name in os.listdir(base_folder):
+        if name.endswith('.csv'):
+            shutil.copy2(os.path.join(base_folder, name), folder)
+    return folder
+
+
+def submit_report(service, max_workers: int = 2):
+    """Run a report service in the background pool. It returns the Future of the report."""
+    global report_pool
+    if report_pool is None:
+        report_pool = ProcessPoolExecutor(max_workers=max_workers,
+                                          mp_context=multiprocessing.get_context('spawn'))
+    folder = service.data_folder = snapshot(service.base_folder)
+    report = report_pool.submit(service.run)
+    report.add_done_callback(lambda report: shutil.rmtree(folder, ignore_errors=True))
+    return report
+
+
+def wait_reports(reports: list):
+    """Wait for the reports submitted with submit_report, logging the failed ones."""
+    for report in reports:
+        try:
+            report.result()
+        except Exception:
+            logger.exception("Report failed")
+
+
+def shutdown_reports():
+    """Wait for the background reports and release the pool of processes."""
+    global report_pool
+    if report_pool is not None:
+        report_pool.shutdown(wait=True)
+        report_pool = None
@@ -1,29 +1,114 @@
+import io
+import json
 import requests
+import numpy as np
 from datetime import datetime
-from time import perf_counter 
+from time import perf_counter
+try:
+  import msgpack
+except ImportError:
+  msgpack = None
+
+# Encodings of the /batch endpoint (edge/body_rest.py). 'npy' is only used in the
+# responses: the values are sent as the raw buffer of a float64 NumPy array.
+CONTENT_TYPES = {
+  'json': 'application/json',
+  'msgpack': 'application/msgpack',
+  'npy': 'application/x-npy',
+}
+
+QUERY = ('var', 'time', 'lat', 'lon', 'depth')
+
+
+def encode(obj, content_type: str) -> bytes:
+  '''Encode obj (a dict, or an array for npy) with the given content type.'''
+  if content_type == CONTENT_TYPES['msgpack']:
+    return msgpack.packb(obj)
+  if content_type == CONTENT_TYPES['npy']:
+    buffer = io.BytesIO()
+    np.save(buffer, np.asarray(obj, dtype=np.float64), allow_pickle=False)
+    return buffer.getvalue()
+  return json.dumps(obj).encode()
+
+
+def decode(data: bytes, content_type: str):
+  '''Decode data encoded by encode.'''
+  if content_type == CONTENT_TYPES['msgpack']:
+    return msgpack.unpackb(data)
+  if content_type == CONTENT_TYPES['npy']:
+    return np.load(io.BytesIO(data), allow_pickle=False)
+  return json.loads(data)
+
 
 class RestBody:
+  '''Client of a remote body (edge/body_rest.py).
+
+  It reuses one HTTP session and reads through the /batch endpoint. Reads can be
+  announced with submit: every pending read is sent in one request the first time
+  one of them is read, so the sensors that share the body and measure in the same
+  tick pay a single round trip. The encoding ('json', 'msgpack' or 'npy') selects
+  the format of the exchange; msgpack needs the msgpack package.'''
 
-  def __init__(self, host: str='http://localhost:5000', file: str=''):
+  def __init__(self, host: str='http://localhost:5000', file: str='', encoding: str='json'):
+    if encoding not in CONTENT_TYPES:
+      raise ValueError(f'Unknown encoding: {encoding}')
+    if encoding == 'msgpack' and msgpack is None:
+      raise ImportError('msgpack is required for the msgpack encoding')
     self.host = host
+    self.encoding = encoding
+    self.session = requests.Session()
+    self.pending = []       # Queries to send in the next request
+    self.results = {}       # Measurements not read yet
+    self.refs = {}          # Pending reads of each query
+
+  def submit(self, var: str, time: float, lat: float, lon: float, layer: int) -> None:
+    '''Announce a read that will be done with readvar.'''
+    query = (var, time, lat, lon, layer)
+    if query not in self.results and query not in self.refs:
+      self.pending.append(query)
+    self.refs[query] = self.refs.get(query, 0) + 1
+
+  def flush(self) -> None:
+    '''Send the pending queries in one request.'''
+    if len(self.pending):
+      queries, self.pending = self.pending, []
+      try:
+        self.results.update(zip(queries, self.readvars(queries)))
+      except Exception:
+        # The queries are sent again in the next request
+        self.pending = queries + self.pending
+        raise
 
   def readvar(self, var: str, time: float, lat: float, lon: float, layer: int) -> dict:
-    data = {
-      'timestamp': time,
-      'payload': {
-        'var': var,
-        'time': time,
-        'lat': lat,
-        'lon': lon,
-        'depth': layer
-      }
-    }
-    return requests.post(self.host, json=data).json()
+    query = (var, time, lat, lon, layer)
+    if query not in self.refs:
+      self.submit(*query)
+    if query not in self.results:
+      self.flush()
+    self.refs[query] -= 1
+    if self.refs[query] == 0:
+      del self.refs[query]
+      return self.results.pop(query)
+    return self.results[query]
+
+  def readvars(self, queries: list) -> list:
+    '''Read a list of (var, time, lat, lon, layer) queries in one request.'''
+    columns = {k: [query[i] for query in queries] for i, k in enumerate(QUERY)}
+    content_type = CONTENT_TYPES['msgpack' if self.encoding == 'msgpack' else 'json']
+    response = self.session.post(self.host + '/batch', data=encode(columns, content_type), headers={
+      'Content-Type': content_type,
+      'Accept': CONTENT_TYPES[self.encoding],
+    })
+    response.raise_for_status()
+    values = decode(response.content, CONTENT_TYPES[self.encoding])
+    values = values.tolist() if self.encoding == 'npy' else values['values']
+    # The query plus the values of var: value, t, ij[4], l (NaN where not resolved)
+    return [dict(zip(QUERY, query), **{query[0]: list(value)}) for query, value in zip(queries, values)]
 
 if __name__ == "__main__":
   body = RestBody(host='http://pc-iscar.dacya.ucm.es:5000', file='Washington....')
 
-  t_start = perf_counter()    
+  t_start = perf_counter()
   measurement = body.readvar('WQ_O', datetime(2008, 9, 12, 5, 28, 49).timestamp(), 47.64, -122.250, 2)
   t_stop = perf_counter()
   print(f'The simulation ran in {t_stop-t_start} seconds')